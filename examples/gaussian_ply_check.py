@@ -0,0 +1,34 @@
+# Check that read_gaussian_ply and parse_gaussian_splatting_data return the same data, on a small synthetic PLY file with degree 3 spherical harmonics.
+
+import os
+import tempfile
+import numpy as np
+from taichi_volume_renderer.io import read_gaussian_ply, parse_gaussian_splatting_data
+
+# Synthetic PLY file, with the properties in the order 3D Gaussian splatting writes them
+names = ['x', 'y', 'z', 'nx', 'ny', 'nz', 'f_dc_0', 'f_dc_1', 'f_dc_2'] + ['f_rest_' + str(i) for i in range(45)] + ['opacity', 'scale_0', 'scale_1', 'scale_2', 'rot_0', 'rot_1', 'rot_2', 'rot_3']
+vertices = np.zeros(100, dtype=[(name, '<f4') for name in names])
+rng = np.random.default_rng(0)
+for name in names:
+    vertices[name] = rng.normal(size=len(vertices))
+
+path = os.path.join(tempfile.mkdtemp(), 'synthetic.ply')
+with open(path, 'wb') as file:
+    file.write(b'ply\nformat binary_little_endian 1.0\nelement vertex %d\n' % len(vertices))
+    for name in names:
+        file.write(b'property float %s\n' % name.encode())
+    file.write(b'end_header\n')
+    file.write(vertices.tobytes())
+
+# parse_gaussian_splatting_data takes what plyfile returns. A dictionary of columns stands in for it here.
+parsed = parse_gaussian_splatting_data({'vertex': {name: vertices[name] for name in names}})
+read = read_gaussian_ply(path, sh_degree=None)
+for key in parsed:
+    assert parsed[key].shape == read[key].shape, key
+    assert np.allclose(parsed[key], read[key]), key
+
+# f_rest_* holds all coefficients of the red channel first, then green, then blue
+assert np.allclose(read['sh_coeffs'][:, 1, 1], 1 / (1 + np.exp(-vertices['f_rest_15'])))
+assert np.allclose(read_gaussian_ply(path)['sh_coeffs'], read['sh_coeffs'][:, :1])  # sh_degree=0 only loads the base color
+os.remove(path)
+print("read_gaussian_ply and parse_gaussian_splatting_data agree")
@@ -1,40 +1,43 @@
-from plyfile import PlyData
 import numpy as np
 import taichi as ti
 import taichi_volume_renderer
 import taichi_volume_renderer.canvas as canvas
-from taichi_volume_renderer.io import parse_gaussian_splatting_data
+from taichi_volume_renderer.io import read_gaussian_ply, Cache
 
 ti.init(arch=ti.gpu)
 
 file_path = "D:/Gaussian_spot_test/your_gaussian_splatting_data_file.ply"
-ply_data = PlyData.read(file_path)
-data = parse_gaussian_splatting_data(ply_data)
-
 N = 400
-smoke, smoke_color = canvas.empty_canvas(N)
-
-ranges = np.array([[np.percentile(e, 10), np.percentile(e, 90)] for e in data['positions'].T])
-center = np.mean(ranges, axis=-1)
-scaling = N / np.max(ranges[:, 1] - ranges[:, 0]) * 1.
-
-data['positions'] -= center
-canvas.gaussian_splatting(
-    smoke,
-    smoke_color,
-    data,
-    offset=0.5 * np.array(smoke.shape),
-    y_upward=True,
-    scaling=scaling)
-
-canvas.clip(smoke, max=0.5)
-canvas.gamma(smoke_color, 1.3)
-canvas.multiply(smoke_color, 1.5)
-canvas.clip(smoke_color, max=1)
+
+def voxelize():  # Parse and splat the data. The result is cached on disk, so later runs start right away.
+    data = read_gaussian_ply(file_path)  # Only loads the base colors. Binary PLY files only; for ASCII ones, use plyfile and parse_gaussian_splatting_data.
+
+    smoke, smoke_color = canvas.empty_canvas(N)
+
+    ranges = np.array([[np.percentile(e, 10), np.percentile(e, 90)] for e in data['positions'].T])
+    center = np.mean(ranges, axis=-1)
+    scaling = N / np.max(ranges[:, 1] - ranges[:, 0]) * 1.
+
+    data['positions'] -= center
+    canvas.gaussian_splatting(
+        smoke,
+        smoke_color,
+        data,
+        offset=0.5 * np.array(smoke.shape),
+        y_upward=True,
+        scaling=scaling)
+
+    canvas.clip(smoke, max=0.5)
+    canvas.gamma(smoke_color, 1.3)
+    canvas.multiply(smoke_color, 1.5)
+    canvas.clip(smoke_color, max=1)
+    return {'smoke': smoke, 'smoke_color': smoke_color}
+
+volume = Cache().fetch(voxelize, file_path, resolution=N)  # Pass everything voxelize() depends on besides the file.
 
 taichi_volume_renderer.plot_volume(
-    smoke,
-    smoke_color,
+    volume['smoke'],
+    volume['smoke_color'],
     lighting=False,
     init_taichi=False,
     smoke_density_factor=600,
@@ -0,0 +1,43 @@
+# Render a turntable animation without opening a window. Works on headless machines without a display server.
+# Saving the GIF needs imageio: pip install imageio, or pip install taichi-volume-renderer[examples].
+
+import numpy as np
+import taichi as ti
+import imageio
+from taichi_volume_renderer import Scene
+
+ti.init(arch=ti.cpu)
+
+# Volume
+x, y, z = np.mgrid[-0.5:0.5:100j, -0.5:0.5:100j, -0.5:0.5:100j]
+smoke_density_numpy = np.zeros_like(x)
+for x_0 in [-0.25, 0.25]:  # 8 spheres
+    for y_0 in [-0.25, 0.25]:
+        for z_0 in [-0.25, 0.25]:
+            if x_0 > 0 and y_0 < 0 and z_0 > 0:
+                continue
+            smoke_density_numpy[(x - x_0) ** 2 + (y - y_0) ** 2 + (z - z_0) ** 2 < 0.25 ** 2] = 6
+smoke_density_taichi = ti.field(dtype=ti.f32, shape=smoke_density_numpy.shape)
+smoke_density_taichi.from_numpy(smoke_density_numpy)
+smoke_color_numpy = np.ones(list(x.shape) + [3])
+smoke_color_numpy[np.logical_and(x > 0, np.logical_and(y > 0, z > 0))] = 0
+smoke_color_taichi = ti.Vector.field(3, dtype=ti.f32, shape=smoke_color_numpy.shape[:-1])
+smoke_color_taichi.from_numpy(smoke_color_numpy)
+
+# Light
+point_lights_pos_taichi = ti.Vector.field(3, dtype=ti.f32, shape=2)
+point_lights_pos_taichi.from_numpy(np.array([[0, 4, 7], [0, 0, 8]], dtype=float))
+point_lights_intensity_taichi = ti.Vector.field(3, dtype=ti.f32, shape=2)
+point_lights_intensity_taichi.from_numpy(np.array([[100, 50, 0], [0, 0, 100]], dtype=float))
+
+scene = Scene(
+    smoke_density_taichi=smoke_density_taichi,
+    smoke_color_taichi=smoke_color_taichi,
+    point_lights_pos_taichi=point_lights_pos_taichi,
+    point_lights_intensity_taichi=point_lights_intensity_taichi)
+scene.update_light()  # Calculate light and shadow once. The volume is static.
+
+cameras = [{'phi': phi, 'theta': 20} for phi in range(0, 360, 10)]
+frames = scene.render_frames(cameras, resolution=(400, 400))  # uint8 array of shape (36, 400, 400, 3)
+imageio.mimsave('turntable.gif', frames, duration=0.1, loop=0)
+print("Animation saved")
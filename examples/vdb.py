@@ -0,0 +1,29 @@
+import numpy as np
+import taichi as ti
+import taichi_volume_renderer
+from taichi_volume_renderer.io import read_vdb
+
+ti.init(arch=ti.gpu)
+
+# Import VDB file. Blosc compressed files need 'pip install blosc'.
+density = read_vdb("data/cloud.vdb", axes=(0, 2, 1), sparse=True)  # In Houdini, the vertical axis is the Y-axis.
+
+# Illuminate the cloud from within, like cloud-to-cloud lightning
+point_lights_pos_numpy = np.array([
+    [0, 0, 8],
+    [0.1, 0.1, 0.09],
+    [0.1, 0.2, 0.07],
+    [-0.25, -0.15, -0.1]], dtype=float)
+point_lights_intensity_numpy = np.array([
+    np.array([8., 8., 15.]) * 2,
+    np.array([0.008, 0.01, 0.012]) * 6,
+    np.array([0.008, 0.01, 0.012]) * 2,
+    np.array([0.008, 0.01, 0.012]) * 5], dtype=float)
+
+taichi_volume_renderer.plot_volume(
+    density,
+    point_lights_pos=point_lights_pos_numpy,
+    point_lights_intensity=point_lights_intensity_numpy,
+    smoke_density_factor=6,
+    empty_space_skipping=True,  # The cloud is static and mostly empty.
+    init_taichi=False)
@@ -1,277 +1,1078 @@
+import time
+import weakref
 import numpy as np
 import taichi as ti
+from .math import ray_box_intersection, load_color
+from .io import upload, as_array, is_sparse, sparse_layout, volume_shape
 
 __version__ = "1.6.0"
 
+@ti.kernel
+def _to_image(
+    pixels: ti.template(),  # type: ignore
+    image: ti.template()  # type: ignore
+):  # Tone map and transpose the rendering result into the row-major, top-down layout used by image files.
+    for i, j in pixels:
+        if ti.static(image.dtype == ti.u8):
+            image[pixels.shape[1] - 1 - j, i] = ti.cast(ti.math.clamp(pixels[i, j] * 256, 0, 255.9), ti.u8)
+        else:
+            image[pixels.shape[1] - 1 - j, i] = pixels[i, j]
+
+@ti.kernel
+def _upscale(
+    pixels_low_resolution: ti.template(),  # type: ignore
+    pixels: ti.template()  # type: ignore
+):  # Bilinear upscaling
+    for i, j in pixels:
+        x = ti.math.clamp((i + 0.5) * pixels_low_resolution.shape[0] / pixels.shape[0] - 0.5, 0., pixels_low_resolution.shape[0] - 1.)
+        y = ti.math.clamp((j + 0.5) * pixels_low_resolution.shape[1] / pixels.shape[1] - 0.5, 0., pixels_low_resolution.shape[1] - 1.)
+        x_int = ti.min(int(x), ti.max(pixels_low_resolution.shape[0] - 2, 0))
+        y_int = ti.min(int(y), ti.max(pixels_low_resolution.shape[1] - 2, 0))
+        x_fraction = x - x_int
+        y_fraction = y - y_int
+        x_int_1 = ti.min(x_int + 1, pixels_low_resolution.shape[0] - 1)
+        y_int_1 = ti.min(y_int + 1, pixels_low_resolution.shape[1] - 1)
+        pixels[i, j] = (
+            pixels_low_resolution[x_int, y_int] * (1 - x_fraction) * (1 - y_fraction) +
+            pixels_low_resolution[x_int_1, y_int] * x_fraction * (1 - y_fraction) +
+            pixels_low_resolution[x_int, y_int_1] * (1 - x_fraction) * y_fraction +
+            pixels_low_resolution[x_int_1, y_int_1] * x_fraction * y_fraction)
+
+@ti.kernel
+def _accumulate(
+    pixels: ti.template(),  # type: ignore
+    accumulated_pixels: ti.template(),  # type: ignore
+    n: int  # Number of frames already accumulated
+):  # Running average of frames. The average is also written back to pixels.
+    for I in ti.grouped(pixels):
+        accumulated_pixels[I] = (accumulated_pixels[I] * n + pixels[I]) / (n + 1)
+        pixels[I] = accumulated_pixels[I]
+
+def _program():  # The current Taichi program. Fields from an earlier ti.init cannot be used after a new one.
+    return ti.lang.impl.get_runtime().prog
+
+class _StoragePool():  # Scene-owned fields such as light and macrocells, handed on to later scenes once a scene is garbage collected. Kernels are compiled per field, so later scenes reuse the compiled kernels as well.
+    def __init__(self):
+        self._free = []  # Storage of collected scenes, each a dict of (shape, storage) pairs
+        self._program = None
+
+    def take(self, keys):  # The storage of a collected scene with exactly these keys, or an empty dict. A scene takes all of it, so the combination of fields kernels were compiled for is kept.
+        if not self._program is _program():
+            self._free = []
+            self._program = _program()
+        for i, storage in enumerate(self._free):
+            if storage.keys() == keys:
+                return self._free.pop(i)
+        return {}
+
+    def give(self, storage, program):
+        if program is self._program and storage:
+            self._free.append(storage)
+
+_storage_pool = _StoragePool()
+
+class _Volume():  # The fields a Scene renders and its compile-time settings. Kernels take it as a template argument. Equal _Volumes share compiled kernels.
+    def _key(self):
+        return tuple((name, value if isinstance(value, (bool, int, float, type(None))) else id(value)) for name, value in sorted(vars(self).items()))
+
+    def __eq__(self, other):
+        return isinstance(other, _Volume) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+_SceneParameters = ti.types.struct(  # Per-scene settings, passed to kernels by value so scenes do not compile their own kernels.
+    shape=ti.math.ivec3,  # Shape of the volume in voxels. The fields may be larger.
+    light_shape=ti.math.ivec3,  # Shape of the light field in light voxels
+    smoke_density_factor=ti.f32,
+    step_length=ti.f32,
+    step_length_light=ti.f32,
+    stop_threshold=ti.f32,  # Terminate ray tracing when the accumulated transparency of the view ray falls below this value.
+    jitter=ti.i32,  # Start each view ray at a random offset within one step. Turns banding into noise, which averages out over frames.
+    camera_distance=ti.f32,
+    camera_phi=ti.f32,
+    camera_theta=ti.f32,
+    fov=ti.f32,  # 2 * tan(vertical field of view / 2)
+    background=ti.math.vec3
+)
+
+_Lights = ti.types.ndarray(dtype=ti.math.vec3, ndim=1)  # Point light positions or intensities
+
+@ti.func
+def _load_smoke_color(volume: ti.template(), I):  # type: ignore
+    color = ti.Vector([1., 1., 1.])
+    if ti.static(not volume.uniform_color):
+        color = load_color(volume.smoke_color, I)
+    return color
+
+# Empty space skipping. Each macrocell stores the maximum density of the voxels it covers. Scenes that do not skip empty space leave them untouched.
+@ti.kernel
+def _update_macrocells(volume: ti.template(), p: _SceneParameters):  # type: ignore
+    macrocells_shape = (p.shape + volume.macrocell_size - 1) // volume.macrocell_size
+    if ti.static(not volume.empty_space_skipping or volume.refraction):
+        pass
+    elif ti.static(volume.sparse):  # Only visit active voxels
+        for I in ti.grouped(ti.ndrange(macrocells_shape.x, macrocells_shape.y, macrocells_shape.z)):
+            volume.macrocells[I] = 0.
+        for I in ti.grouped(volume.smoke_density):
+            if (I < p.shape).all():  # Sparse fields are rounded up to whole blocks.
+                ti.atomic_max(volume.macrocells[I // volume.macrocell_size], volume.smoke_density[I])
+    else:
+        for I in ti.grouped(ti.ndrange(macrocells_shape.x, macrocells_shape.y, macrocells_shape.z)):
+            start = I * volume.macrocell_size
+            end = ti.min(start + volume.macrocell_size, p.shape)
+            max_density = 0.
+            for J in ti.grouped(ti.ndrange((start.x, end.x), (start.y, end.y), (start.z, end.z))):
+                max_density = ti.max(max_density, volume.smoke_density[J])
+            volume.macrocells[I] = max_density
+
+@ti.func
+def _skip_empty_macrocell(volume: ti.template(), p, pos, d):  # type: ignore # Returns the number of steps that can be skipped from pos without missing any nonzero density.
+    steps = 0
+    pos_maped = (pos + 0.5) * p.shape
+    I = int(pos_maped)
+    if I.x >= 0 and I.x < p.shape[0] and I.y >= 0 and I.y < p.shape[1] and I.z >= 0 and I.z < p.shape[2]:
+        cell = I // volume.macrocell_size
+        if volume.macrocells[cell] <= 0:
+            # Distance to the exit of this macrocell along d, then round up to the step lattice
+            cell_start = cell * volume.macrocell_size
+            cell_end = ti.min(cell_start + volume.macrocell_size, p.shape)
+            distance = np.inf
+            for a in ti.static(range(3)):
+                if d[a] > 0:
+                    distance = ti.min(distance, (cell_end[a] - pos_maped[a]) / (p.shape[a] * d[a]))
+                elif d[a] < 0:
+                    distance = ti.min(distance, (cell_start[a] - pos_maped[a]) / (p.shape[a] * d[a]))
+            steps = ti.max(1, int(ti.ceil(distance / p.step_length)))
+    return steps
+
+# Light density in volume, stored at 1 / light_resolution_factor of the volume resolution per axis. Sparse volumes only
+# store light around active smoke voxels, and kernels visit the active light voxels. Dense ones visit the first
+# light_shape voxels of their light field.
+@ti.kernel
+def _activate_light(volume: ti.template(), p: _SceneParameters):  # type: ignore # Activate the light voxels needed to shade nonzero smoke voxels. Newly activated ones start at 1, like dense light fields.
+    for I in ti.grouped(volume.smoke_density):
+        if volume.smoke_density[I] != 0:
+            for offset in ti.static(ti.grouped(ti.ndrange(*[(-1, 2) if volume.light_resolution_factor > 1 else (0, 1)] * 3))):  # Trilinear interpolation also reads the neighbours.
+                J = ti.math.clamp(I // volume.light_resolution_factor + offset, 0, p.light_shape - 1)
+                if not ti.is_active(volume.light_cells, J):
+                    volume.light_density[J] = ti.Vector([1., 1., 1.])
+
+@ti.kernel
+def _deactivate_all(blocks: ti.template()):  # type: ignore
+    for I in ti.grouped(blocks):
+        ti.deactivate(blocks, I)
+
+@ti.func
+def _downsample_voxel(volume: ti.template(), p, I):  # type: ignore
+    start = I * volume.light_resolution_factor
+    end = ti.min(start + volume.light_resolution_factor, p.shape)
+    total = 0.
+    for J in ti.grouped(ti.ndrange((start.x, end.x), (start.y, end.y), (start.z, end.z))):
+        total += volume.smoke_density[J]
+    volume.light_smoke_density[I] = total / volume.light_resolution_factor ** 3
+
+@ti.kernel
+def _downsample_smoke_density(volume: ti.template(), p: _SceneParameters):  # type: ignore
+    if ti.static(volume.sparse):
+        for I in ti.grouped(volume.light_smoke_density):
+            _downsample_voxel(volume, p, I)
+    else:
+        for I in ti.grouped(ti.ndrange(p.light_shape.x, p.light_shape.y, p.light_shape.z)):
+            _downsample_voxel(volume, p, I)
+
+@ti.func
+def _light_voxel_pos(volume: ti.template(), p, I):  # type: ignore # Center of a light voxel
+    return (I + 0.5) * volume.light_resolution_factor / p.shape - 0.5
+
+@ti.func
+def _sample_light(volume: ti.template(), p, pos_maped, x_int, y_int, z_int):  # type: ignore # Light at pos_maped, given in voxel units. x_int, y_int and z_int are the indices of the voxel containing it.
+    light = ti.Vector([0., 0., 0.])
+    if ti.static(volume.light_resolution_factor == 1):
+        light = volume.light_density[x_int, y_int, z_int]
+    else:  # Trilinear interpolation
+        shape = p.light_shape
+        q = ti.math.clamp(pos_maped / volume.light_resolution_factor - 0.5, 0., shape - 1.)
+        q_int = ti.min(int(q), ti.max(shape - 2, 0))
+        f = q - q_int
+        for offset in ti.static(ti.grouped(ti.ndrange(2, 2, 2))):
+            weight = (f.x if offset.x else 1 - f.x) * (f.y if offset.y else 1 - f.y) * (f.z if offset.z else 1 - f.z)
+            light += volume.light_density[ti.min(q_int + offset, shape - 1)] * weight
+    return light
+
+@ti.func
+def _shadow_ray_transmittance(volume: ti.template(), p, pos, light_pos):  # type: ignore # March a shadow ray from pos towards a point light.
+    d = light_pos - pos
+    distance_squared = ti.math.dot(d, d)
+    d = d.normalized()
+    _, t_exit = ray_box_intersection(pos, d, ti.Vector([-0.5, -0.5, -0.5]), ti.Vector([0.5, 0.5, 0.5]))
+    t_exit = ti.min(t_exit, ti.sqrt(distance_squared))  # Stop at the light if it is inside the volume.
+    transmittance = 1.
+    for step in range(int(ti.ceil(t_exit / p.step_length_light))):
+        pos_2 = pos + d * (p.step_length_light * step)
+        pos_maped = (pos_2 + 0.5) * p.shape
+        x_int = int(pos_maped.x)
+        y_int = int(pos_maped.y)
+        z_int = int(pos_maped.z)
+        if x_int >= 0 and x_int < p.shape[0] and y_int >= 0 and y_int < p.shape[1] and z_int >= 0 and z_int < p.shape[2]:
+            transmittance *= 1 - p.smoke_density_factor * volume.smoke_density[x_int, y_int, z_int] * p.step_length_light
+    return transmittance, distance_squared
+
+@ti.func
+def _march_light_voxel(volume: ti.template(), p, lights_pos: ti.template(), lights_intensity: ti.template(), I, l):  # type: ignore # Add the light of light l reaching light voxel I, marching a shadow ray.
+    transmittance, distance_squared = _shadow_ray_transmittance(volume, p, _light_voxel_pos(volume, p, I), lights_pos[l])
+    volume.light_density[I] += lights_intensity[l] * (transmittance / distance_squared)
+
+@ti.func
+def _relight_voxel(volume: ti.template(), p, lights_pos: ti.template(), lights_intensity: ti.template(), I, box_min, box_max):  # type: ignore
+    pos = _light_voxel_pos(volume, p, I)
+    affected = False
+    for l in range(lights_pos.shape[0]):
+        t_enter, t_exit = ray_box_intersection(pos, lights_pos[l] - pos, box_min, box_max)
+        if t_enter <= t_exit and t_exit >= 0 and t_enter <= 1:
+            affected = True
+    if affected:
+        volume.light_density[I] = ti.Vector([0., 0., 0.])
+        for l in range(lights_pos.shape[0]):
+            _march_light_voxel(volume, p, lights_pos, lights_intensity, I, l)
+
+@ti.kernel
+def _relight_region(
+    volume: ti.template(),  # type: ignore
+    p: _SceneParameters,  # type: ignore
+    lights_pos: _Lights,  # type: ignore
+    lights_intensity: _Lights,  # type: ignore
+    start: ti.math.ivec3,  # type: ignore
+    end: ti.math.ivec3  # type: ignore
+):  # Recompute the light voxels whose shadow rays towards any light cross the region [start, end) given in voxels.
+    box_min = (start - volume.light_resolution_factor) / p.shape - 0.5  # Pad by one light voxel
+    box_max = (end + volume.light_resolution_factor) / p.shape - 0.5
+    if ti.static(volume.sparse):
+        for I in ti.grouped(volume.light_density):
+            _relight_voxel(volume, p, lights_pos, lights_intensity, I, box_min, box_max)
+    else:
+        for I in ti.grouped(ti.ndrange(p.light_shape.x, p.light_shape.y, p.light_shape.z)):
+            _relight_voxel(volume, p, lights_pos, lights_intensity, I, box_min, box_max)
+
+@ti.kernel
+def _clear_light(volume: ti.template(), p: _SceneParameters):  # type: ignore
+    if ti.static(volume.sparse):
+        for I in ti.grouped(volume.light_density):
+            volume.light_density[I] = ti.Vector([0., 0., 0.])
+    else:
+        for I in ti.grouped(ti.ndrange(p.light_shape.x, p.light_shape.y, p.light_shape.z)):
+            volume.light_density[I] = ti.Vector([0., 0., 0.])
+
+@ti.kernel
+def _march_light(volume: ti.template(), p: _SceneParameters, lights_pos: _Lights, lights_intensity: _Lights, l: int):  # type: ignore # Per-voxel shadow rays for a single light. Used for lights inside the volume.
+    if ti.static(volume.sparse):
+        for I in ti.grouped(volume.light_density):
+            _march_light_voxel(volume, p, lights_pos, lights_intensity, I, l)
+    else:
+        for I in ti.grouped(ti.ndrange(p.light_shape.x, p.light_shape.y, p.light_shape.z)):
+            _march_light_voxel(volume, p, lights_pos, lights_intensity, I, l)
+
+@ti.kernel
+def _march_all_lights(volume: ti.template(), p: _SceneParameters, lights_pos: _Lights, lights_intensity: _Lights):  # type: ignore # Reference implementation marching a shadow ray from every voxel to every light.
+    if ti.static(volume.sparse):
+        for I in ti.grouped(volume.light_density):
+            volume.light_density[I] = ti.Vector([0., 0., 0.])
+            for l in ti.ndrange(lights_pos.shape[0]):
+                _march_light_voxel(volume, p, lights_pos, lights_intensity, I, l)
+    else:
+        for I in ti.grouped(ti.ndrange(p.light_shape.x, p.light_shape.y, p.light_shape.z)):
+            volume.light_density[I] = ti.Vector([0., 0., 0.])
+            for l in ti.ndrange(lights_pos.shape[0]):
+                _march_light_voxel(volume, p, lights_pos, lights_intensity, I, l)
+
+@ti.kernel
+def _sweep_light_slice(
+    volume: ti.template(),  # type: ignore
+    p: _SceneParameters,  # type: ignore
+    lights_pos: _Lights,  # type: ignore
+    lights_intensity: _Lights,  # type: ignore
+    l: int,
+    axis: ti.template(),  # type: ignore
+    s: int,  # Slice to update
+    s_previous: int  # Slice between s and the light, already updated. -1 if s is the slice closest to the light.
+):  # Propagate the transmittance towards light l by one slice.
+    shape = p.light_shape
+    u_axis = ti.static(min((axis + 1) % 3, (axis + 2) % 3))
+    v_axis = ti.static(max((axis + 1) % 3, (axis + 2) % 3))  # The inner loop runs along the axis with the smaller memory stride.
+    for u in range(shape[u_axis]):
+        for v in range(shape[v_axis]):
+            I = ti.Vector([0, 0, 0])
+            I[axis] = s
+            I[u_axis] = u
+            I[v_axis] = v
+            pos = _light_voxel_pos(volume, p, I)
+            d = lights_pos[l] - pos
+            distance_squared = ti.math.dot(d, d)
+            t = volume.light_resolution_factor / (p.shape[axis] * ti.abs(d[axis]))  # Ray parameter of the previous slice plane
+            transmittance = 1.
+            if s_previous >= 0:
+                # Bilinearly interpolate the transmittance where the shadow ray crosses the previous slice.
+                pos_maped = (pos + d * t + 0.5) * p.shape / volume.light_resolution_factor - 0.5
+                x = pos_maped[u_axis]
+                y = pos_maped[v_axis]
+                if x > -0.5 and x < shape[u_axis] - 0.5 and y > -0.5 and y < shape[v_axis] - 0.5:  # Otherwise the shadow ray entered through a side face.
+                    x = ti.math.clamp(x, 0., shape[u_axis] - 1.)
+                    y = ti.math.clamp(y, 0., shape[v_axis] - 1.)
+                    x_int = ti.min(int(x), ti.max(shape[u_axis] - 2, 0))
+                    y_int = ti.min(int(y), ti.max(shape[v_axis] - 2, 0))
+                    x_fraction = x - x_int
+                    y_fraction = y - y_int
+                    previous = s_previous % 2
+                    transmittance = (
+                        volume.light_transmittance[previous, x_int, y_int] * (1 - x_fraction) * (1 - y_fraction) +
+                        volume.light_transmittance[previous, x_int + 1, y_int] * x_fraction * (1 - y_fraction) +
+                        volume.light_transmittance[previous, x_int, y_int + 1] * (1 - x_fraction) * y_fraction +
+                        volume.light_transmittance[previous, x_int + 1, y_int + 1] * x_fraction * y_fraction)
+            segment_length = t * ti.sqrt(distance_squared)
+            transmittance *= ti.max(0., 1 - p.smoke_density_factor * volume.light_smoke_density[I] * segment_length)
+            volume.light_transmittance[s % 2, u, v] = transmittance
+            if ti.static(volume.sparse):
+                if ti.is_active(volume.light_cells, I):  # Do not activate empty space
+                    volume.light_density[I] += lights_intensity[l] * (transmittance / distance_squared)
+            else:
+                volume.light_density[I] += lights_intensity[l] * (transmittance / distance_squared)
+
+@ti.func
+def _ray_tracing_one_step(volume: ti.template(), p, pos, d, pixels_color, transmittance):  # type: ignore
+    pos_maped = (pos + 0.5) * p.shape
+    x_int = int(pos_maped.x)
+    y_int = int(pos_maped.y)
+    z_int = int(pos_maped.z)
+    to_break = False
+    if x_int >= 0 and x_int < p.shape[0] and y_int >= 0 and y_int < p.shape[1] and z_int >= 0 and z_int < p.shape[2]:
+        transmittance *= 1 - p.smoke_density_factor * volume.smoke_density[x_int, y_int, z_int] * p.step_length
+        pixels_color += p.smoke_density_factor * volume.smoke_density[x_int, y_int, z_int] * _load_smoke_color(volume, ti.Vector([x_int, y_int, z_int])) * p.step_length * _sample_light(volume, p, pos_maped, x_int, y_int, z_int) * transmittance
+
+        if ti.static(volume.refraction):
+            if x_int >= 1 and x_int < p.shape[0] - 1 and y_int >= 1 and y_int < p.shape[1] - 1 and z_int >= 1 and z_int < p.shape[2] - 1:
+                index_of_refraction = volume.index_of_refraction[x_int, y_int, z_int]
+                index_of_refraction_grad = ti.Vector([
+                    (volume.index_of_refraction[x_int + 1, y_int, z_int] - volume.index_of_refraction[x_int - 1, y_int, z_int]),
+                    (volume.index_of_refraction[x_int, y_int + 1, z_int] - volume.index_of_refraction[x_int, y_int - 1, z_int]),
+                    (volume.index_of_refraction[x_int, y_int, z_int + 1] - volume.index_of_refraction[x_int, y_int, z_int - 1])
+                ]) * (ti.max(p.shape.x, p.shape.y, p.shape.z) / 2.)  # Central difference over two voxels
+                index_of_refraction_change = ti.math.dot(d, index_of_refraction_grad) * p.step_length
+                if index_of_refraction_change != 0.:
+                    normal = index_of_refraction_grad.normalized()
+                    relative_index_of_refraction = (index_of_refraction + index_of_refraction_change * 0.5) / (index_of_refraction - index_of_refraction_change * 0.5)
+                    d_n = ti.math.dot(d, normal) * normal
+                    d_t = d - d_n
+                    cos_old = ti.abs(ti.math.dot(d, normal))
+                    sin_old = (1 - cos_old ** 2) ** 0.5
+                    sin_new = sin_old / relative_index_of_refraction
+                    if sin_new > 1.:
+                        to_break = True
+                    else:
+                        cos_new = (1 - sin_new ** 2) ** 0.5
+                        d_n *= cos_new / cos_old
+                        d_t *= sin_new / sin_old
+                        d = d_n + d_t
+                        d = d.normalized()
+
+    pos += d * p.step_length
+    return pos, d, pixels_color, transmittance, to_break
+
+@ti.func
+def _ray_tracing(volume: ti.template(), p, pos, d):  # type: ignore
+    pixels_color = ti.Vector([0., 0., 0.])
+    transmittance = 1.
+    t_enter, t_exit = ray_box_intersection(pos, d, ti.Vector([-0.5, -0.5, -0.5]), ti.Vector([0.5, 0.5, 0.5]))
+    t_enter = ti.max(t_enter, 0.)
+    if t_enter < t_exit:  # Rays missing the volume get the background straight away.
+        if p.jitter:
+            t_enter += ti.random() * p.step_length
+        pos += d * t_enter
+        if ti.static(not volume.refraction):  # Straight rays. March a counted number of steps from entry to exit.
+            steps = int(ti.ceil((t_exit - t_enter) / p.step_length))
+            i = 0
+            while i < steps:
+                if transmittance < p.stop_threshold:
+                    break
+
+                if ti.static(volume.empty_space_skipping):
+                    skipped_steps = _skip_empty_macrocell(volume, p, pos, d)
+                    if skipped_steps > 0:
+                        pos += d * (p.step_length * skipped_steps)
+                        i += skipped_steps
+                        continue
+
+                pos, d, pixels_color, transmittance, _ = _ray_tracing_one_step(volume, p, pos, d, pixels_color, transmittance)
+                i += 1
+        else:  # Rays may bend. Check the bounds every step.
+            i = volume.ray_tracing_max_steps
+            while i > 0:
+                if (pos.x > 0.5 and d.x > 0 or pos.x < -0.5 and d.x < 0) or (pos.y > 0.5 and d.y > 0 or pos.y < -0.5 and d.y < 0) or (pos.z > 0.5 and d.z > 0 or pos.z < -0.5 and d.z < 0):
+                    break
+                if transmittance < p.stop_threshold:
+                    break
+
+                pos, d, pixels_color, transmittance, to_break = _ray_tracing_one_step(volume, p, pos, d, pixels_color, transmittance)
+                if to_break:
+                    break
+
+                i -= 1
+
+    pixels_color += p.background * transmittance
+    return pixels_color
+
+@ti.func
+def _camera_basis(phi, theta, distance):  # Camera position, right and up vectors and viewing direction of an orbit camera
+    camera_pos = distance * ti.Vector([
+        ti.cos(phi) * ti.cos(theta),
+        ti.sin(phi) * ti.cos(theta),
+        ti.sin(theta)
+    ])
+    camera_u_vector = ti.Vector([
+        -ti.sin(phi),
+        ti.cos(phi),
+        0
+    ])
+    camera_v_vector = ti.Vector([
+        -ti.cos(phi) * ti.sin(theta),
+        -ti.sin(phi) * ti.sin(theta),
+        ti.cos(theta)
+    ])
+    camera_direction = -camera_pos / distance
+    return camera_pos, camera_u_vector, camera_v_vector, camera_direction
+
+@ti.func
+def _view_ray_direction(camera_u_vector, camera_v_vector, camera_direction, fov, i, j, width, height):  # Direction of the view ray through pixel (i, j)
+    d = camera_direction + camera_u_vector * (fov * (i - width / 2) / height) + camera_v_vector * (fov * (j / height - 0.5))
+    return d.normalized()
+
+@ti.kernel
+def _render_kernel(volume: ti.template(), p: _SceneParameters, pixels: ti.template()):  # type: ignore
+    camera_pos, camera_u_vector, camera_v_vector, camera_direction = _camera_basis(p.camera_phi, p.camera_theta, p.camera_distance)
+    for i, j in pixels:
+        d = _view_ray_direction(camera_u_vector, camera_v_vector, camera_direction, p.fov, i, j, pixels.shape[0], pixels.shape[1])
+        pixels[i, j] = _ray_tracing(volume, p, camera_pos, d)
+
+@ti.kernel
+def _render_views_kernel(
+    volume: ti.template(),  # type: ignore
+    p: _SceneParameters,  # type: ignore
+    cameras: ti.types.ndarray(dtype=ti.math.vec4, ndim=1),  # type: ignore # phi, theta, distance and fov of each view, in radians
+    pixels: ti.template()  # type: ignore # Shape (views, width, height)
+):  # All views in one launch, parallel over views and pixels
+    for view, i, j in pixels:
+        camera = cameras[view]
+        camera_pos, camera_u_vector, camera_v_vector, camera_direction = _camera_basis(camera[0], camera[1], camera[2])
+        d = _view_ray_direction(camera_u_vector, camera_v_vector, camera_direction, camera[3], i, j, pixels.shape[1], pixels.shape[2])
+        pixels[view, i, j] = _ray_tracing(volume, p, camera_pos, d)
+
+_image_pool = {}  # Offscreen rendering buffers shared by all scenes, keyed by resolution and image dtype
+
+def _get_image_buffers(resolution, dtype):
+    resolution = tuple(int(e) for e in resolution)
+    dtype = np.dtype(dtype)
+    if dtype == np.uint8:
+        image_dtype = ti.u8
+    elif dtype == np.float32:
+        image_dtype = ti.f32
+    else:
+        raise ValueError("Unsupported image dtype: " + str(dtype))
+    if not _image_pool.get('program') is _program():  # Buffers of an earlier Taichi program are unusable.
+        _image_pool.clear()
+        _image_pool['program'] = _program()
+    key = (resolution, dtype)
+    if not key in _image_pool:
+        pixels = ti.Vector.field(3, dtype=ti.f32, shape=resolution)
+        image = ti.Vector.field(3, dtype=image_dtype, shape=(resolution[1], resolution[0]))
+        _image_pool[key] = (pixels, image)
+    return _image_pool[key]
+
+def _get_views_buffer(views, resolution):  # Pixels of shape (views, width, height), shared by all scenes
+    _get_image_buffers(resolution, np.float32)  # Drops buffers of an earlier Taichi program.
+    key = ('views', int(views)) + tuple(int(e) for e in resolution)
+    if not key in _image_pool:
+        _image_pool[key] = ti.Vector.field(3, dtype=ti.f32, shape=key[1:])
+    return _image_pool[key]
+
+def _camera_rows(cameras, n, degrees, distance, fov):  # Cameras as float32 rows of phi, theta, distance and fov in radians. Rows of 2 or 3 values take distance and fov from the arguments.
+    cameras = np.asarray(cameras, dtype=np.float64)
+    if cameras.ndim == 1:
+        cameras = np.broadcast_to(cameras, (n, len(cameras)))
+    if cameras.ndim != 2 or len(cameras) == 0 or not 2 <= cameras.shape[1] <= 4:
+        raise ValueError("cameras must have shape (views, 2), (views, 3) or (views, 4), with at least one view")
+    scale = np.pi / 180 if degrees else 1
+    rows = np.empty((cameras.shape[0], 4), dtype=np.float32)
+    rows[:, 0] = cameras[:, 0] * scale
+    rows[:, 1] = np.clip(cameras[:, 1] * scale, np.pi * -0.5, np.pi * 0.5)
+    rows[:, 2] = cameras[:, 2] if cameras.shape[1] > 2 else distance
+    rows[:, 3] = 2 * np.tan(cameras[:, 3] * scale / 2) if cameras.shape[1] > 3 else fov
+    return rows
+
 class Scene():
     def __init__(
         self,
-        smoke_density_taichi,
-        smoke_color_taichi,
-        point_lights_pos_taichi,
-        point_lights_intensity_taichi,
-        lighting=True,
+        smoke_density_taichi,  # Taichi field, or a NumPy array uploaded like in set_volume
+        smoke_color_taichi,  # Taichi vector field, or a NumPy array uploaded like in set_volume. None means uniform white.
+        point_lights_pos_taichi,  # Taichi vector field or NumPy array of shape (lights, 3). Read by update_light().
+        point_lights_intensity_taichi,  # Taichi vector field or NumPy array of shape (lights, 3). Read by update_light().
+        lighting=True,  # True or "march" marches a shadow ray from every voxel to every light. "sweep" propagates light slice by slice, which is much faster. False disables shadows.
         index_of_refraction_taichi=None,
         ray_tracing_stop_threshold=0.01,  # 0 ~ 1
         background=[0.2, 0.2, 0.2],
         smoke_density_factor=1.,
         ray_tracing_step_size_factor=1.,  # The smaller the value here, the higher the ray tracing quality.
         light_ray_tracing_step_size_factor=3.,  # The smaller the value here, the higher the shadow quality.
-        ray_tracing_max_steps=10000  # This only takes effect in scenes where light rays may bend, such as those containing refractive materials.
+        ray_tracing_max_steps=10000,  # This only takes effect in scenes where light rays may bend, such as those containing refractive materials.
+        empty_space_skipping=False,  # Let view rays leap over empty macrocells. Has no effect in scenes with refraction. Off by default because macrocells are only rebuilt by update_light(), set_volume() and after mark_volume_dirty(), so density written between those calls would be skipped; rebuilding them on every render costs about as much as skipping saves on large volumes. Worth turning on for mostly empty or sparse volumes.
+        macrocell_size=8,  # Edge length of a macrocell in voxels.
+        light_resolution_factor=1,  # Edge length of a light voxel in voxels. 2 or 4 makes lighting much cheaper. Light is trilinearly interpolated when this is above 1.
+        light_dtype=ti.f32  # ti.f32 or ti.f16. ti.f16 halves the memory of the light field.
     ):
-        # Volume data
-        self.smoke_density = smoke_density_taichi  # Smoke density
-        self._smoke_density_factor = ti.field(dtype=ti.f32, shape=())
-        self._smoke_density_factor[None] = smoke_density_factor
-        self.smoke_color = smoke_color_taichi  # Smoke color
-        self.index_of_refraction = index_of_refraction_taichi
+        # Kernels are defined at module level and take the fields to render as a template argument (a _Volume) and the
+        # settings below by value. Scenes on the same fields share compiled kernels, and scene-owned fields are handed on
+        # to later scenes, so only the first scene of a kind compiles.
+        self._smoke_density_factor = smoke_density_factor
 
         # Light
         self.point_lights_pos = point_lights_pos_taichi
         self.point_lights_intensity = point_lights_intensity_taichi
-    
+
         # Camera
-        self._fov = ti.field(dtype=ti.f32, shape=())
-        self._fov[None] = 0.5924  # 2 * tan(vertical field of view / 2)
-        self._camera_distance = ti.field(dtype=ti.f32, shape=())
-        self._camera_distance[None] = 3
-        self._camera_phi = ti.field(dtype=ti.f32, shape=())
-        self._camera_theta = ti.field(dtype=ti.f32, shape=())
-        self._background = ti.Vector.field(3, dtype=ti.f32, shape=())
-        self._background[None] = ti.Vector(background)
+        self._fov = 0.5924  # 2 * tan(vertical field of view / 2)
+        self._camera_distance = 3.
+        self._camera_phi = 0.
+        self._camera_theta = 0.
+        self._background = list(background)
 
         # Ray tracing
-        self._step_length = ti.field(dtype=ti.f32, shape=())
-        pixel_size = 1 / np.max(smoke_density_taichi.shape)
-        self._step_length[None] = pixel_size * ray_tracing_step_size_factor
-        self._step_length_light = ti.field(dtype=ti.f32, shape=())
-        self._step_length_light[None] = pixel_size * light_ray_tracing_step_size_factor
-        self._stop_threshold = ti.field(dtype=ti.f32, shape=())
-        self._stop_threshold[None] = ray_tracing_stop_threshold  # Terminate ray tracing when the accumulated transparency of the view ray falls below this value.
-
-        # Light density in volume
-        self.light_density = ti.Vector.field(3, dtype=ti.f32, shape=smoke_density_taichi.shape)
-        self.light_density.from_numpy(np.ones(list(smoke_density_taichi.shape) + [3]))
-
-        if lighting:
-            @ti.kernel
-            def update_light():  # Update shadow.
-                for i, j, k in self.light_density:
-                    self.light_density[i, j, k] = ti.Vector([0., 0., 0.])
-                    pos = ti.Vector([i + 0.5, j + 0.5, k + 0.5]) / self.smoke_density.shape - 0.5
-                    for l in ti.ndrange(self.point_lights_pos.shape[0]):
-                        d = self.point_lights_pos[l] - pos
-                        distance_squared = ti.math.dot(d, d)
-                        transmittance = 1.
-                        d = d.normalized()
-                        pos_2 = pos
-                        # pos_2 += d * (pixel_size * 0.5)
-                        while True:
-                            if pos_2.x > 0.5 and d.x > 0 or pos_2.x < -0.5 and d.x < 0:
-                                break
-                            if pos_2.y > 0.5 and d.y > 0 or pos_2.y < -0.5 and d.y < 0:
-                                break
-                            if pos_2.z > 0.5 and d.z > 0 or pos_2.z < -0.5 and d.z < 0:
-                                break
-                            pos_maped = (pos_2 + 0.5) * self.smoke_density.shape
-                            x_int = int(pos_maped.x)
-                            y_int = int(pos_maped.y)
-                            z_int = int(pos_maped.z)
-                            if x_int >= 0 and x_int < self.smoke_density.shape[0] and y_int >= 0 and y_int < self.smoke_density.shape[1] and z_int >= 0 and z_int < self.smoke_density.shape[2]:
-                                transmittance *= 1 - self._smoke_density_factor[None] * self.smoke_density[x_int, y_int, z_int] * self._step_length_light[None]
-                            pos_2 += d * self._step_length_light[None]
-                        self.light_density[i, j, k] += self.point_lights_intensity[l] * (transmittance / distance_squared)
-            self.update_light = update_light
+        self._step_length = ray_tracing_step_size_factor  # In voxels until the first volume is set
+        self._step_length_light = light_ray_tracing_step_size_factor
+        self._stop_threshold = ray_tracing_stop_threshold  # Terminate ray tracing when the accumulated transparency of the view ray falls below this value.
+        self._jitter = False  # Start each view ray at a random offset within one step. Turns banding into noise, which averages out over frames.
+
+        # Scene-owned storage: light, macrocells and uploaded volumes. Reused by set_volume while large enough, and
+        # returned to a shared pool when the scene is garbage collected.
+        self._lighting = lighting
+        self._settings = dict(
+            macrocell_size=macrocell_size,
+            light_resolution_factor=int(light_resolution_factor),
+            empty_space_skipping=bool(empty_space_skipping),
+            ray_tracing_max_steps=int(ray_tracing_max_steps))
+        self._light_dtype = light_dtype
+        self._storage = _storage_pool.take(self._storage_keys(smoke_density_taichi, smoke_color_taichi, index_of_refraction_taichi))
+        weakref.finalize(self, _storage_pool.give, self._storage, _program())
+        for key, (shape, storage) in self._storage.items():  # Clear the light left by an earlier scene.
+            if key[0] == 'light_density':
+                storage.fill(1)
+            elif key[0] == 'sparse_light':
+                _deactivate_all(storage[2].parent())
+
+        # Change tracking. version increases whenever anything affecting the rendering result changes.
+        self.version = 0
+        self._macrocells_dirty = True
+
+        smoke_density_taichi, smoke_color_taichi, index_of_refraction_taichi, shape = self._upload_volume(smoke_density_taichi, smoke_color_taichi, index_of_refraction_taichi)
+        self._use_volume(smoke_density_taichi, smoke_color_taichi, index_of_refraction_taichi, shape)
+
+    def _parameters(self):
+        return _SceneParameters(
+            shape=self._shape,
+            light_shape=self._light_shape,
+            smoke_density_factor=self._smoke_density_factor,
+            step_length=self._step_length,
+            step_length_light=self._step_length_light,
+            stop_threshold=self._stop_threshold,
+            jitter=int(self._jitter),
+            camera_distance=self._camera_distance,
+            camera_phi=self._camera_phi,
+            camera_theta=self._camera_theta,
+            fov=self._fov,
+            background=self._background)
+
+    def _lights(self):  # Light positions and intensities as float32 arrays of shape (lights, 3)
+        return [np.ascontiguousarray(e.to_numpy() if isinstance(e, ti.Field) else e, dtype=np.float32).reshape(-1, 3) for e in (self.point_lights_pos, self.point_lights_intensity)]
+
+    def update_light(self, region=None):  # Update shadow.
+        # update_light(region=((x_start, y_start, z_start), (x_end, y_end, z_end))) only recomputes the light voxels whose
+        # shadow rays cross the given region, in voxels, such as the regions returned by the canvas functions. Partial
+        # updates always use shadow rays.
+        volume = self._volume
+        p = self._parameters()
+        if volume.sparse:
+            if region is None:
+                _deactivate_all(volume.light_blocks)
+            _activate_light(volume, p)
+        _update_macrocells(volume, p)
+        self._macrocells_dirty = False
+        self.version += 1
+        if not self._lighting:
+            return
+        lights_pos, lights_intensity = self._lights()
+        if not region is None:
+            _relight_region(volume, p, lights_pos, lights_intensity, *region)
+        elif self._lighting == "sweep":  # Propagate transmittance slice by slice along the dominant direction of each light.
+            if volume.light_resolution_factor > 1:
+                _downsample_smoke_density(volume, p)
+            _clear_light(volume, p)
+            for l, light_pos in enumerate(lights_pos):
+                axis = int(np.argmax(np.abs(light_pos)))
+                if abs(light_pos[axis]) <= 0.5:  # Light inside the volume. Fall back to shadow rays.
+                    _march_light(volume, p, lights_pos, lights_intensity, l)
+                    continue
+                n = self._light_shape[axis]
+                s_previous = -1
+                for s in (range(n - 1, -1, -1) if light_pos[axis] > 0 else range(n)):
+                    _sweep_light_slice(volume, p, lights_pos, lights_intensity, l, axis, s, s_previous)
+                    s_previous = s
         else:
-            @ti.kernel
-            def update_light():  # Update shadow.
-                pass
-            self.update_light = update_light
-
-        if self.index_of_refraction is None:
-            @ti.func
-            def ray_tracing_one_step(pos, d, pixels_color, transmittance):
-                pos_maped = (pos + 0.5) * self.smoke_density.shape
-                x_int = int(pos_maped.x)
-                y_int = int(pos_maped.y)
-                z_int = int(pos_maped.z)
-                if x_int >= 0 and x_int < self.smoke_density.shape[0] and y_int >= 0 and y_int < self.smoke_density.shape[1] and z_int >= 0 and z_int < self.smoke_density.shape[2]:
-                    transmittance *= 1 - self._smoke_density_factor[None] * self.smoke_density[x_int, y_int, z_int] * self._step_length[None]
-                    pixels_color += self._smoke_density_factor[None] * self.smoke_density[x_int, y_int, z_int] * self.smoke_color[x_int, y_int, z_int] * self._step_length[None] * self.light_density[x_int, y_int, z_int] * transmittance
-                pos += d * self._step_length[None]
-                return pos, d, pixels_color, transmittance, False
-            self.ray_tracing_one_step = ray_tracing_one_step
+            _march_all_lights(volume, p, lights_pos, lights_intensity)
+
+    def update_macrocells(self):  # Called by render() after mark_volume_dirty(), and by update_light().
+        _update_macrocells(self._volume, self._parameters())
+
+    def _prepare_render(self):  # Update macrocells changed since mark_volume_dirty(). Returns the kernel parameters.
+        p = self._parameters()
+        if self._macrocells_dirty:
+            _update_macrocells(self._volume, p)
+            if self._volume.sparse:
+                _activate_light(self._volume, p)
+            self._macrocells_dirty = False
+        return p
+
+    def render(self, pixels):
+        _render_kernel(self._volume, self._prepare_render(), pixels)
+
+    def _storage_keys(self, smoke_density, smoke_color, index_of_refraction):  # Keys of the storage a volume needs
+        keys = {('macrocells', ti.f32, 0)}
+        keys.update((name, ti.f32, n) for name, array, n in [('smoke_density', smoke_density, 0), ('smoke_color', smoke_color, 3), ('index_of_refraction', index_of_refraction, 0)] if not array is None and not isinstance(array, ti.Field))
+        if isinstance(smoke_density, ti.Field) and is_sparse(smoke_density):
+            keys.add(('sparse_light', self._light_dtype, self._settings['light_resolution_factor'] > 1))
         else:
-            @ti.func
-            def ray_tracing_one_step(pos, d, pixels_color, transmittance):
-                pos_maped = (pos + 0.5) * self.smoke_density.shape
-                x_int = int(pos_maped.x)
-                y_int = int(pos_maped.y)
-                z_int = int(pos_maped.z)
-                to_break = False
-                if x_int >= 0 and x_int < self.smoke_density.shape[0] and y_int >= 0 and y_int < self.smoke_density.shape[1] and z_int >= 0 and z_int < self.smoke_density.shape[2]:
-                    transmittance *= 1 - self._smoke_density_factor[None] * self.smoke_density[x_int, y_int, z_int] * self._step_length[None]
-                    pixels_color += self._smoke_density_factor[None] * self.smoke_density[x_int, y_int, z_int] * self.smoke_color[x_int, y_int, z_int] * self._step_length[None] * self.light_density[x_int, y_int, z_int] * transmittance
-
-                    if x_int >= 1 and x_int < self.smoke_density.shape[0] - 1 and y_int >= 1 and y_int < self.smoke_density.shape[1] - 1 and z_int >= 1 and z_int < self.smoke_density.shape[2] - 1:
-                        index_of_refraction = self.index_of_refraction[x_int, y_int, z_int]
-                        index_of_refraction_grad = ti.Vector([
-                            (self.index_of_refraction[x_int + 1, y_int, z_int] - self.index_of_refraction[x_int - 1, y_int, z_int]),
-                            (self.index_of_refraction[x_int, y_int + 1, z_int] - self.index_of_refraction[x_int, y_int - 1, z_int]),
-                            (self.index_of_refraction[x_int, y_int, z_int + 1] - self.index_of_refraction[x_int, y_int, z_int - 1])
-                        ]) / (pixel_size * 2.)
-                        index_of_refraction_change = ti.math.dot(d, index_of_refraction_grad) * self._step_length[None]
-                        if index_of_refraction_change != 0.:
-                            normal = index_of_refraction_grad.normalized()
-                            relative_index_of_refraction = (index_of_refraction + index_of_refraction_change * 0.5) / (index_of_refraction - index_of_refraction_change * 0.5)
-                            d_n = ti.math.dot(d, normal) * normal
-                            d_t = d - d_n
-                            cos_old = ti.abs(ti.math.dot(d, normal))
-                            sin_old = (1 - cos_old ** 2) ** 0.5
-                            sin_new = sin_old / relative_index_of_refraction
-                            if sin_new > 1.:
-                                to_break = True
-                            else:
-                                cos_new = (1 - sin_new ** 2) ** 0.5
-                                d_n *= cos_new / cos_old
-                                d_t *= sin_new / sin_old
-                                d = d_n + d_t
-                                d = d.normalized()
-
-                pos += d * self._step_length[None]
-                return pos, d, pixels_color, transmittance, to_break
-            self.ray_tracing_one_step = ray_tracing_one_step
-
-        @ti.func
-        def ray_tracing(pos, d):
-            pixels_color = ti.Vector([0., 0., 0.])
-            transmittance = 1.
-            distance_to_sphere = self._camera_distance[None] - 0.866025  # The constant here is 0.5 * 2 ** 0.5
-            if distance_to_sphere > 0:
-                pos += d * distance_to_sphere
-            i = ray_tracing_max_steps
-            while i > 0:
-                if (pos.x > 0.5 and d.x > 0 or pos.x < -0.5 and d.x < 0) or (pos.y > 0.5 and d.y > 0 or pos.y < -0.5 and d.y < 0) or (pos.z > 0.5 and d.z > 0 or pos.z < -0.5 and d.z < 0):
-                    break
-                if transmittance < self._stop_threshold[None]:
-                    break
+            keys.add(('light_density', self._light_dtype, 3))
+            if self._settings['light_resolution_factor'] > 1:
+                keys.add(('light_smoke_density', ti.f32, 0))
+        if self._lighting == "sweep":
+            keys.add(('light_transmittance', ti.f32, 0))
+        return keys
 
-                pos, d, pixels_color, transmittance, to_break = self.ray_tracing_one_step(pos, d, pixels_color, transmittance)
-                if to_break:
-                    break
+    def _storage_item(self, key, shape, allocate):  # Scene-owned storage covering shape, reallocated only when too small
+        item = self._storage.get(key)
+        if item is None or any(a < b for a, b in zip(item[0], shape)):
+            if not item is None:
+                shape = tuple(max(a, b) for a, b in zip(item[0], shape))
+            item = (tuple(shape), allocate(shape))
+            self._storage[key] = item
+            if key[0] == 'light_density':  # Light starts at 1, which is also what scenes without lighting use.
+                item[1].fill(1)
+        return item[1]
+
+    def _storage_field(self, name, dtype, n, shape):  # A dense Scene-owned field covering shape
+        return self._storage_item((name, dtype, n), shape, lambda shape: ti.field(dtype, shape=shape) if n == 0 else ti.Vector.field(n, dtype, shape=shape))
+
+    def _sparse_light_storage(self, light_shape):  # Sparse light field and the light smoke density sharing its layout
+        def allocate(light_shape):
+            light_density = ti.Vector.field(3, dtype=self._light_dtype)
+            light_cells = sparse_layout(light_shape)
+            light_cells.place(light_density)
+            light_smoke_density = None
+            if self._settings['light_resolution_factor'] > 1:
+                light_smoke_density = ti.field(dtype=ti.f32)  # Mean smoke density of each light voxel
+                light_cells.place(light_smoke_density)
+            return light_density, light_smoke_density, light_cells
+        return self._storage_item(('sparse_light', self._light_dtype, self._settings['light_resolution_factor'] > 1), light_shape, allocate)
+
+    def _upload_volume(self, smoke_density, smoke_color, index_of_refraction, density_dtype=ti.f32, color_dtype=ti.f32):  # Copy arrays into scene-owned storage. Returns the fields and the shape of the volume, which uploaded storage may exceed.
+        if not isinstance(smoke_density, (ti.Field, np.ndarray)):
+            smoke_density = as_array(smoke_density)
+        shape = volume_shape(smoke_density) if isinstance(smoke_density, ti.Field) else tuple(smoke_density.shape[:3])
+        fields = []
+        for name, array, dtype, n in [('smoke_density', smoke_density, density_dtype, 0), ('smoke_color', smoke_color, color_dtype, 3), ('index_of_refraction', index_of_refraction, ti.f32, 0)]:
+            if array is None or isinstance(array, ti.Field):
+                fields.append(array)
+                continue
+            field = self._storage_field(name, dtype, n, shape)
+            upload(field, array)
+            fields.append(field)
+        return fields + [shape]
+
+    def _use_volume(self, smoke_density_taichi, smoke_color_taichi, index_of_refraction_taichi, shape):  # Render these fields from now on, allocating light and macrocells as needed.
+        light_resolution_factor = self._settings['light_resolution_factor']
+        light_shape = tuple(-(-n // light_resolution_factor) for n in shape)
+        volume = _Volume()
+        vars(volume).update(self._settings)
+        volume.smoke_density = smoke_density_taichi
+        volume.smoke_color = smoke_color_taichi
+        volume.index_of_refraction = index_of_refraction_taichi
+        volume.uniform_color = smoke_color_taichi is None
+        volume.refraction = not index_of_refraction_taichi is None
+        volume.sparse = is_sparse(smoke_density_taichi)  # Sparse volumes, built on pointer or bitmasked SNodes, only store active voxels. Inactive voxels read as 0.
+        volume.macrocells = self._storage_field('macrocells', ti.f32, 0, [-(-n // volume.macrocell_size) for n in shape])
+        if volume.sparse:  # Light is only stored around active smoke voxels.
+            volume.light_density, volume.light_smoke_density, volume.light_cells = self._sparse_light_storage(light_shape)
+            volume.light_blocks = volume.light_cells.parent()
+        else:
+            volume.light_density = self._storage_field('light_density', self._light_dtype, 3, light_shape)
+            if light_resolution_factor > 1:
+                volume.light_smoke_density = self._storage_field('light_smoke_density', ti.f32, 0, light_shape)  # Mean smoke density of each light voxel
+        if light_resolution_factor == 1:
+            volume.light_smoke_density = smoke_density_taichi
+        if self._lighting == "sweep":  # Transmittance towards the light currently being swept, for the current and the previous slice
+            volume.light_transmittance = self._storage_field('light_transmittance', ti.f32, 0, (2, max(light_shape), max(light_shape)))
+        scale = max(getattr(self, '_shape', [1])) / max(shape)  # Keep the step lengths relative to the voxel size.
+        self._step_length *= scale
+        self._step_length_light *= scale
+        self._volume = volume
+        self._shape = shape
+        self._light_shape = light_shape
+
+        self.smoke_density = smoke_density_taichi  # Smoke density
+        self.smoke_color = smoke_color_taichi  # Smoke color. None means uniform white.
+        self.index_of_refraction = index_of_refraction_taichi
+        self.light_density = volume.light_density
+        self.macrocells = volume.macrocells
+        self._macrocells_dirty = True
+        self.version += 1
+
+    def set_volume(  # Show another volume, of any shape, without rebuilding kernels. Updates the light.
+        self,
+        smoke_density,  # NumPy array or anything accepted by io.upload, copied into storage that is reused while large enough. Taichi fields are rendered in place.
+        smoke_color=None,  # Same types as smoke_density, with a trailing axis of 3. None means uniform white.
+        index_of_refraction=None,  # Same types as smoke_density. None disables refraction.
+        density_dtype=ti.f32,  # For uploaded arrays
+        color_dtype=ti.f32  # For uploaded arrays. ti.u8 quantizes colors to 256 levels.
+    ):
+        self._use_volume(*self._upload_volume(smoke_density, smoke_color, index_of_refraction, density_dtype, color_dtype))
+        self.update_light()
+
+    def mark_volume_dirty(self):  # Call after changing the smoke density, color or index of refraction without calling update_light().
+        self._macrocells_dirty = True
+        self.version += 1
+
+    def render_to_array(
+        self,
+        camera=None,  # Can be None (keep current camera), a dict of set_camera arguments or a tuple (phi, theta, distance).
+        resolution=(720, 720),
+        dtype=np.uint8  # np.uint8 or np.float32. The float32 image is linear and unclamped.
+    ):  # Render without a window. Returns a NumPy array of shape (height, width, 3).
+        if not camera is None:
+            if isinstance(camera, dict):
+                self.set_camera(**camera)
+            else:
+                self.set_camera(*camera)
+        pixels, image = _get_image_buffers(resolution, dtype)
+        self.render(pixels)
+        _to_image(pixels, image)
+        return image.to_numpy()
+
+    def render_views(  # Render many views in one kernel launch, without changing the camera. Returns a Taichi vector field of shape (views, width, height), each view laid out like the pixels of render(). The field is shared, and overwritten by the next call of the same shape.
+        self,
+        cameras,  # Array of shape (views, 2), (views, 3) or (views, 4) holding phi, theta, and optionally distance and vertical field of view of each view. Missing columns take the current camera.
+        resolution=(720, 720),
+        degrees=True
+    ):
+        views = _camera_rows(cameras, 1, degrees, self._camera_distance, self._fov)
+        pixels = _get_views_buffer(len(views), resolution)
+        _render_views_kernel(self._volume, self._prepare_render(), views, pixels)
+        return pixels
+
+    def render_frames(
+        self,
+        cameras,  # Iterable of cameras. See render_to_array.
+        resolution=(720, 720),
+        dtype=np.uint8
+    ):  # Render a sequence of views. Returns a NumPy array of shape (frames, height, width, 3).
+        return np.stack([self.render_to_array(camera, resolution, dtype) for camera in cameras])
 
-                i -= 1
-            
-            pixels_color += self._background[None] * transmittance
-            return pixels_color
-        self.ray_tracing = ray_tracing
-
-        @ti.kernel
-        def render(pixels: ti.template()):  # type: ignore
-            camera_pos = self._camera_distance[None] * ti.Vector([
-                ti.cos(self._camera_phi[None]) * ti.cos(self._camera_theta[None]),
-                ti.sin(self._camera_phi[None]) * ti.cos(self._camera_theta[None]),
-                ti.sin(self._camera_theta[None])
-            ])
-            camera_u_vector = ti.Vector([
-                -ti.sin(self._camera_phi[None]),
-                ti.cos(self._camera_phi[None]),
-                0
-            ])
-            camera_v_vector = ti.Vector([
-                -ti.cos(self._camera_phi[None]) * ti.sin(self._camera_theta[None]),
-                -ti.sin(self._camera_phi[None]) * ti.sin(self._camera_theta[None]),
-                ti.cos(self._camera_theta[None])
-            ])
-            camera_direction = -camera_pos / self._camera_distance[None]
-
-            for i, j in pixels:
-                pos = camera_pos
-                d = camera_direction + camera_u_vector * (self._fov[None] * (i - pixels.shape[0] / 2) / pixels.shape[1]) + camera_v_vector * (self._fov[None] * (j / pixels.shape[1] - 0.5))
-                d = d.normalized()
-                
-                pixels[i, j] = self.ray_tracing(pos, d)
-        self.render = render
-    
     @property
     def smoke_density_factor(self):
-        return self._smoke_density_factor[None]
+        return self._smoke_density_factor
 
     @smoke_density_factor.setter
     def smoke_density_factor(self, value):
-        self._smoke_density_factor[None] = value
+        self._smoke_density_factor = value
+        self.version += 1
 
     def get_vertical_field_of_view(self, degrees=True):  # Get vertical field of view. Default is 33°.
-        return np.atan(self._fov[None] / 2) * 2 * (180 / np.pi if degrees else 1)
+        return np.atan(self._fov / 2) * 2 * (180 / np.pi if degrees else 1)
 
     def set_vertical_field_of_view(self, angle, degrees=True):  # Set vertical field of view. Default is 33°.
-        self._fov[None] = 2 * np.tan(angle * (np.pi / 180 if degrees else 1) / 2)
+        self._fov = 2 * np.tan(angle * (np.pi / 180 if degrees else 1) / 2)
+        self.version += 1
 
     def get_camera_phi(self, degrees=True):
-        return self._camera_phi[None] * (180 / np.pi if degrees else 1)
+        return self._camera_phi * (180 / np.pi if degrees else 1)
 
     def set_camera_phi(self, angle, degrees=True):
-        self._camera_phi[None] = angle * (np.pi / 180 if degrees else 1)
+        self._camera_phi = angle * (np.pi / 180 if degrees else 1)
+        self.version += 1
 
     def get_camera_theta(self, degrees=True):
-        return self._camera_theta[None] * (180 / np.pi if degrees else 1)
+        return self._camera_theta * (180 / np.pi if degrees else 1)
 
     def set_camera_theta(self, angle, degrees=True):
-        self._camera_theta[None] = angle * (np.pi / 180 if degrees else 1)
-        if self._camera_theta[None] < np.pi * -0.5:
-            self._camera_theta[None] = np.pi * -0.5
-        if self._camera_theta[None] > np.pi * 0.5:
-            self._camera_theta[None] = np.pi * 0.5
-    
+        self._camera_theta = min(max(angle * (np.pi / 180 if degrees else 1), np.pi * -0.5), np.pi * 0.5)
+        self.version += 1
+
+    def set_camera(self, phi=None, theta=None, distance=None, vertical_field_of_view=None, degrees=True):
+        if not phi is None:
+            self.set_camera_phi(phi, degrees)
+        if not theta is None:
+            self.set_camera_theta(theta, degrees)
+        if not distance is None:
+            self.camera_distance = distance
+        if not vertical_field_of_view is None:
+            self.set_vertical_field_of_view(vertical_field_of_view, degrees)
+
+    def get_camera_state(self):  # Everything about the camera that affects the rendering result
+        return (self._camera_phi, self._camera_theta, self._camera_distance, self._fov)
+
     @property
     def camera_distance(self):
-        return self._camera_distance[None]
+        return self._camera_distance
 
     @camera_distance.setter
     def camera_distance(self, value):
-        self._camera_distance[None] = value
-    
+        self._camera_distance = value
+        self.version += 1
+
     @property
     def background(self):
-        return list(self._background[None])
+        return list(self._background)
 
     @background.setter
     def background(self, value):
-        self._background[None] = ti.Vector(value)
-    
+        self._background = list(value)
+        self.version += 1
+
     @property
     def step_length(self):
-        return self._step_length[None]
+        return self._step_length
 
     @step_length.setter
     def step_length(self, value):
-        self._step_length[None] = value
-    
+        self._step_length = value
+        self.version += 1
+
     @property
     def step_length_light(self):
-        return self._step_length_light[None]
+        return self._step_length_light
 
     @step_length_light.setter
     def step_length_light(self, value):
-        self._step_length_light[None] = value
-    
+        self._step_length_light = value
+        self.version += 1
+
+    @property
+    def jitter(self):
+        return self._jitter
+
+    @jitter.setter
+    def jitter(self, value):
+        self._jitter = bool(value)
+        self.version += 1
+
     @property
     def stop_threshold(self):
-        return self._stop_threshold[None]
+        return self._stop_threshold
 
     @stop_threshold.setter
     def stop_threshold(self, value):
-        self._stop_threshold[None] = value
+        self._stop_threshold = value
+        self.version += 1
+
+def warmup(  # Compile the kernels for common Scene variants ahead of time. Later scenes whose volumes are NumPy arrays fitting in shape reach their first frame without compiling, as do scenes rendering at resolution with render_to_array.
+    shape=(64, 64, 64),  # Largest volume shape to prepare for
+    resolution=(720, 720),
+    lighting=(True, False),  # Lighting modes to compile. See Scene.
+    refraction=(False, True),
+    **scene_arguments  # Other Scene arguments, such as light_resolution_factor, which select kernel variants as well
+):
+    shape = tuple(shape)
+    for lighting_mode in lighting:
+        for with_refraction in refraction:
+            scenes = [Scene(  # Two of each, so that a scene can be created while the previous one is still alive.
+                np.zeros(shape, dtype=np.float32),
+                np.ones(shape + (3,), dtype=np.float32),
+                np.array([[0, 0, 5]], dtype=np.float32),
+                np.array([[50, 50, 50]], dtype=np.float32),
+                lighting=lighting_mode,
+                index_of_refraction_taichi=np.ones(shape, dtype=np.float32) if with_refraction else None,
+                **scene_arguments) for _ in range(2)]
+            for scene in scenes:
+                scene.update_light()
+                scene.render_to_array(resolution=resolution)
+                scene.render_to_array(resolution=resolution, dtype=np.float32)
+            del scene, scenes  # Hand the storage on to later scenes.
+    ti.sync()
+
+@ti.func
+def _batch_shadow_ray_transmittance(density: ti.template(), b, pos, light_pos, smoke_density_factor, step_length_light):  # type: ignore # March a shadow ray through volume b from pos towards a point light.
+    shape = ti.Vector([density.shape[1], density.shape[2], density.shape[3]])
+    d = light_pos - pos
+    distance_squared = ti.math.dot(d, d)
+    d = d.normalized()
+    _, t_exit = ray_box_intersection(pos, d, ti.Vector([-0.5, -0.5, -0.5]), ti.Vector([0.5, 0.5, 0.5]))
+    t_exit = ti.min(t_exit, ti.sqrt(distance_squared))  # Stop at the light if it is inside the volume.
+    transmittance = 1.
+    for step in range(int(ti.ceil(t_exit / step_length_light))):
+        I = int((pos + d * (step_length_light * step) + 0.5) * shape)
+        if I.x >= 0 and I.x < shape.x and I.y >= 0 and I.y < shape.y and I.z >= 0 and I.z < shape.z:
+            transmittance *= 1 - smoke_density_factor * density[b, I.x, I.y, I.z] * step_length_light
+    return transmittance, distance_squared
+
+@ti.kernel
+def _batch_light_kernel(
+    density: ti.types.ndarray(dtype=ti.f32, ndim=4),  # type: ignore
+    lights_pos: ti.types.ndarray(dtype=ti.math.vec3, ndim=2),  # type: ignore # (batch, lights)
+    lights_intensity: ti.types.ndarray(dtype=ti.math.vec3, ndim=2),  # type: ignore
+    light: ti.types.ndarray(dtype=ti.math.vec3, ndim=4),  # type: ignore
+    smoke_density_factor: ti.f32,  # type: ignore
+    step_length_light: ti.f32  # type: ignore
+):  # Shadow rays from every voxel of every volume to each of its lights
+    for b, x, y, z in ti.ndrange(density.shape[0], density.shape[1], density.shape[2], density.shape[3]):
+        pos = (ti.Vector([x, y, z]) + 0.5) / ti.Vector([density.shape[1], density.shape[2], density.shape[3]]) - 0.5
+        total = ti.Vector([0., 0., 0.])
+        for l in range(lights_pos.shape[1]):
+            transmittance, distance_squared = _batch_shadow_ray_transmittance(density, b, pos, lights_pos[b, l], smoke_density_factor, step_length_light)
+            total += lights_intensity[b, l] * (transmittance / distance_squared)
+        light[b, x, y, z] = total
+
+@ti.kernel
+def _batch_render_kernel(
+    density: ti.types.ndarray(dtype=ti.f32, ndim=4),  # type: ignore
+    color: ti.types.ndarray(dtype=ti.math.vec3, ndim=4),  # type: ignore
+    uniform_color: ti.template(),  # type: ignore # Ignore color and use white
+    light: ti.types.ndarray(dtype=ti.math.vec3, ndim=4),  # type: ignore
+    lighting: ti.template(),  # type: ignore # Otherwise light is ignored and taken as 1
+    cameras: ti.types.ndarray(dtype=ti.math.vec4, ndim=1),  # type: ignore # phi, theta, distance and fov of each volume, in radians
+    pixels: ti.types.ndarray(dtype=ti.math.vec3, ndim=3),  # type: ignore # (batch, width, height)
+    smoke_density_factor: ti.f32,  # type: ignore
+    step_length: ti.f32,  # type: ignore
+    stop_threshold: ti.f32,  # type: ignore
+    background: ti.math.vec3  # type: ignore
+):  # All pixels of all volumes in one launch
+    for b, i, j in ti.ndrange(pixels.shape[0], pixels.shape[1], pixels.shape[2]):
+        shape = ti.Vector([density.shape[1], density.shape[2], density.shape[3]])
+        camera = cameras[b]
+        pos, camera_u_vector, camera_v_vector, camera_direction = _camera_basis(camera[0], camera[1], camera[2])
+        d = _view_ray_direction(camera_u_vector, camera_v_vector, camera_direction, camera[3], i, j, pixels.shape[1], pixels.shape[2])
+        pixels_color = ti.Vector([0., 0., 0.])
+        transmittance = 1.
+        t_enter, t_exit = ray_box_intersection(pos, d, ti.Vector([-0.5, -0.5, -0.5]), ti.Vector([0.5, 0.5, 0.5]))
+        t_enter = ti.max(t_enter, 0.)
+        if t_enter < t_exit:
+            pos += d * t_enter
+            for _ in range(int(ti.ceil((t_exit - t_enter) / step_length))):
+                if transmittance < stop_threshold:
+                    break
+                I = int((pos + 0.5) * shape)
+                if I.x >= 0 and I.x < shape.x and I.y >= 0 and I.y < shape.y and I.z >= 0 and I.z < shape.z:
+                    voxel_density = density[b, I.x, I.y, I.z]
+                    transmittance *= 1 - smoke_density_factor * voxel_density * step_length
+                    voxel_color = ti.Vector([1., 1., 1.])
+                    if ti.static(not uniform_color):
+                        voxel_color = color[b, I.x, I.y, I.z]
+                    if ti.static(lighting):
+                        voxel_color *= light[b, I.x, I.y, I.z]
+                    pixels_color += smoke_density_factor * voxel_density * voxel_color * step_length * transmittance
+                pos += d * step_length
+        pixels[b, i, j] = pixels_color + background * transmittance
+
+class BatchRenderer():  # Light and render a batch of small volumes of one shape in one pass, for dataset generation. Kernels take arrays, so any batch size or shape reuses them.
+    def __init__(
+        self,
+        resolution=(256, 256),
+        lighting=True,  # Shadow rays from every voxel to every light. False disables shadows.
+        background=[0.2, 0.2, 0.2],
+        smoke_density_factor=1.,
+        ray_tracing_step_size_factor=1.,  # The smaller the value here, the higher the ray tracing quality.
+        light_ray_tracing_step_size_factor=3.,  # The smaller the value here, the higher the shadow quality.
+        ray_tracing_stop_threshold=0.01  # 0 ~ 1
+    ):
+        self.resolution = tuple(int(e) for e in resolution)
+        self.lighting = bool(lighting)
+        self.background = list(background)
+        self.smoke_density_factor = smoke_density_factor
+        self.ray_tracing_step_size_factor = ray_tracing_step_size_factor
+        self.light_ray_tracing_step_size_factor = light_ray_tracing_step_size_factor
+        self.ray_tracing_stop_threshold = ray_tracing_stop_threshold
+        self._arrays = {}  # Device arrays, reallocated when the batch shape changes
+
+    def _array(self, name, dtype, shape):
+        array = self._arrays.get(name)
+        if array is None or tuple(array.shape) != tuple(shape):
+            array = ti.ndarray(dtype, shape=tuple(shape))
+            self._arrays[name] = array
+        return array
+
+    def _upload(self, name, dtype, data):
+        array = self._array(name, dtype, data.shape[:4])
+        array.from_numpy(data)
+        return array
+
+    def render(  # Returns a float32 NumPy array of shape (batch, width, height, 3), each image laid out like the pixels of Scene.render().
+        self,
+        smoke_density,  # Array of shape (batch, x, y, z)
+        smoke_color=None,  # Array of shape (batch, x, y, z, 3). uint8 colors are read as 0 ~ 255. None means uniform white.
+        cameras=(0, 0),  # Row of phi, theta[, distance[, vertical field of view]] shared by all volumes, or one row per volume. See Scene.render_views.
+        point_lights_pos=[[0, 0, 5]],  # Array of shape (lights, 3) shared by all volumes, or (batch, lights, 3)
+        point_lights_intensity=[[50, 50, 50]],  # Same shapes as point_lights_pos
+        degrees=True
+    ):
+        smoke_density = np.ascontiguousarray(as_array(smoke_density), dtype=np.float32)
+        if smoke_density.ndim != 4:
+            raise ValueError("smoke_density must have shape (batch, x, y, z)")
+        batch = smoke_density.shape[0]
+        density = self._upload('density', ti.f32, smoke_density)
+        color = None
+        if not smoke_color is None:
+            smoke_color = as_array(smoke_color)
+            if np.issubdtype(smoke_color.dtype, np.integer):
+                smoke_color = smoke_color / np.float32(255)
+            color = self._upload('color', ti.math.vec3, np.ascontiguousarray(smoke_color, dtype=np.float32))
+        pixel_size = 1 / max(smoke_density.shape[1:])
+        light = None
+        if self.lighting:
+            lights_pos, lights_intensity = [np.ascontiguousarray(np.broadcast_to(np.asarray(e, dtype=np.float32), (batch,) + np.shape(e)[-2:])) for e in (point_lights_pos, point_lights_intensity)]
+            light = self._array('light', ti.math.vec3, smoke_density.shape)
+            _batch_light_kernel(density, lights_pos, lights_intensity, light, self.smoke_density_factor, pixel_size * self.light_ray_tracing_step_size_factor)
+        pixels = self._array('pixels', ti.math.vec3, (batch,) + self.resolution)
+        placeholder = self._array('placeholder', ti.math.vec3, (1, 1, 1, 1))  # Passed for unused colors or light
+        _batch_render_kernel(
+            density,
+            placeholder if color is None else color,
+            color is None,
+            placeholder if light is None else light,
+            self.lighting,
+            _camera_rows(cameras, batch, degrees, 3., 0.5924),
+            pixels,
+            self.smoke_density_factor,
+            pixel_size * self.ray_tracing_step_size_factor,
+            self.ray_tracing_stop_threshold,
+            ti.Vector(self.background))
+        return pixels.to_numpy()
+
+    def render_stream(  # Render batches from an iterable such as a generator, yielding one result per batch as it is done.
+        self,
+        batches,  # Each batch is a density array, a tuple of render() arguments or a dict of them.
+        **kwargs  # render() arguments shared by all batches
+    ):
+        for batch in batches:
+            if isinstance(batch, dict):
+                yield self.render(**{**kwargs, **batch})
+            elif isinstance(batch, tuple):
+                yield self.render(*batch, **kwargs)
+            else:
+                yield self.render(batch, **kwargs)
 
 class DisplayWindow():
     def __init__(
         self,
-        smoke_density,  # Can be NumPy array or Taichi field.
+        smoke_density,  # Can be NumPy array or Taichi field. A ti.ndarray, tensor, or anything with __array_interface__ or __dlpack__ is uploaded like a NumPy array, without an intermediate copy where possible.
         smoke_color=None,  # Can be None, NumPy array or Taichi vector field. If left None, uniform white applied.
         index_of_refraction=None,  # Can be None, NumPy array or Taichi vector field.
         point_lights_pos=None,  # Can be None, NumPy array or Taichi vector field. If left None, default lights applied.
         point_lights_intensity=None,  # Can be None, NumPy array or Taichi vector field. If left None, default lights applied.
-        lighting=True,
+        lighting=True,  # True, "march", "sweep" or False. See Scene.
         resolution=(720, 720),
         ray_tracing_stop_threshold=0.01,  # 0 ~ 1
         background=[0.2, 0.2, 0.2],
@@ -280,28 +1081,55 @@ class DisplayWindow():
         smoke_density_factor=1.,
         ray_tracing_step_size_factor=1.,  # The smaller the value here, the higher the ray tracing quality.
         light_ray_tracing_step_size_factor=3.,  # The smaller the value here, the higher the shadow quality.
-        ray_tracing_max_steps=10000  # This only takes effect in scenes where light rays may bend, such as those containing refractive materials.
+        ray_tracing_max_steps=10000,  # This only takes effect in scenes where light rays may bend, such as those containing refractive materials.
+        empty_space_skipping=False,  # Let view rays leap over empty macrocells. Has no effect in scenes with refraction. See Scene. show() rebuilds the macrocells each step when there is a callback.
+        macrocell_size=8,  # Edge length of a macrocell in voxels.
+        light_resolution_factor=1,  # Edge length of a light voxel in voxels. 2 or 4 makes lighting much cheaper. Light is trilinearly interpolated when this is above 1.
+        density_dtype=ti.f32,  # ti.f32 or ti.f16. Only applies when smoke_density is a NumPy array.
+        color_dtype=ti.f32,  # ti.f32, ti.f16 or ti.u8. Only applies when smoke_color is None or a NumPy array. ti.u8 quantizes colors to 256 levels.
+        light_dtype=ti.f32,  # ti.f32 or ti.f16.
+        sparse=False  # Store a NumPy smoke_density in a sparse field, allocating only blocks with nonzero density. A NumPy or default smoke_color then shares its layout. Taichi fields passed in may be sparse regardless.
     ):
         if init_taichi:
             ti.init(arch=taichi_arch)
-        
+
+        smoke_density, smoke_color, index_of_refraction = [e if e is None or isinstance(e, (ti.Field, np.ndarray)) else as_array(e) for e in [smoke_density, smoke_color, index_of_refraction]]
+
+        if sparse and not isinstance(smoke_density, ti.Field):  # Density and color share one sparse layout, so colors are only stored where there is smoke.
+            smoke_density_numpy = smoke_density
+            smoke_color_numpy = smoke_color
+            layout = sparse_layout(smoke_density_numpy.shape)
+            smoke_density = ti.field(dtype=density_dtype)
+            layout.place(smoke_density)
+            smoke_density.volume_shape = tuple(smoke_density_numpy.shape[:3])
+            if not isinstance(smoke_color_numpy, ti.Field):
+                smoke_color = ti.Vector.field(3, dtype=color_dtype)
+                layout.place(smoke_color)
+                smoke_color.volume_shape = smoke_density.volume_shape
+            upload(smoke_density, smoke_density_numpy)
+            if smoke_color_numpy is None:
+                smoke_color.fill(255 if color_dtype == ti.u8 else 1)  # Only fills active voxels
+            elif not isinstance(smoke_color_numpy, ti.Field):
+                upload(smoke_color, smoke_color_numpy, active_only=True)
+
         if not isinstance(smoke_density, ti.Field):
             smoke_density_numpy = smoke_density
-            smoke_density = ti.field(dtype=ti.f32, shape=smoke_density_numpy.shape)
-            smoke_density.from_numpy(smoke_density_numpy)
+            smoke_density = ti.field(dtype=density_dtype, shape=smoke_density_numpy.shape)
+            upload(smoke_density, smoke_density_numpy)
 
         if smoke_color is None:
-            smoke_color = np.ones(list(smoke_density.shape) + [3])
+            smoke_color = ti.Vector.field(3, dtype=color_dtype, shape=smoke_density.shape)
+            smoke_color.fill(255 if color_dtype == ti.u8 else 1)
         if not isinstance(smoke_color, ti.Field):
             smoke_color_numpy = smoke_color
-            smoke_color = ti.Vector.field(3, dtype=ti.f32, shape=smoke_color_numpy.shape[:-1])
-            smoke_color.from_numpy(smoke_color_numpy)
+            smoke_color = ti.Vector.field(3, dtype=color_dtype, shape=smoke_color_numpy.shape[:-1])
+            upload(smoke_color, smoke_color_numpy)
 
         if not index_of_refraction is None:
             if not isinstance(index_of_refraction, ti.Field):
                 index_of_refraction_numpy = index_of_refraction
                 index_of_refraction = ti.field(dtype=ti.f32, shape=index_of_refraction_numpy.shape)
-                index_of_refraction.from_numpy(index_of_refraction_numpy)
+                upload(index_of_refraction, index_of_refraction_numpy)
 
         if point_lights_pos is None:
             point_lights_pos = np.array([[0, 0, 5]], dtype=float)
@@ -329,7 +1157,11 @@ class DisplayWindow():
             smoke_density_factor=smoke_density_factor,
             ray_tracing_step_size_factor=ray_tracing_step_size_factor,
             light_ray_tracing_step_size_factor=light_ray_tracing_step_size_factor,
-            ray_tracing_max_steps=ray_tracing_max_steps)
+            ray_tracing_max_steps=ray_tracing_max_steps,
+            empty_space_skipping=empty_space_skipping,
+            macrocell_size=macrocell_size,
+            light_resolution_factor=light_resolution_factor,
+            light_dtype=light_dtype)
 
         # Window
         self.resolution = tuple(resolution)
@@ -340,6 +1172,26 @@ class DisplayWindow():
         self.cursor_start_pos = (-1, -1)
         self.camera_rotation_speed = 230.  # Unit: degree pre image width or height
         self.camera_zooming_speed = 0.0007
+
+        # Progressive rendering
+        self.interaction_downsample = 4  # Render at 1 / interaction_downsample of the resolution per axis while the camera moves.
+        self.refine_delay = 0.1  # Seconds the camera must stay still before refining, doubling the resolution each frame.
+        self._pixels_low_resolution = {}
+
+        # Temporal accumulation
+        self.max_accumulated_frames = 64  # Stop rendering once this many frames of a still scene are averaged.
+        self._accumulated_pixels = ti.Vector.field(3, dtype=ti.f32, shape=resolution)
+
+    def render_frame(self, downsample=1):  # Render into self.pixels, at 1 / downsample of the window resolution per axis if downsample > 1.
+        if downsample <= 1:
+            self.scene.render(self.pixels)
+            return
+        resolution = tuple(max(1, e // downsample) for e in self.resolution)
+        if not resolution in self._pixels_low_resolution:
+            self._pixels_low_resolution[resolution] = ti.Vector.field(3, dtype=ti.f32, shape=resolution)
+        pixels_low_resolution = self._pixels_low_resolution[resolution]
+        self.scene.render(pixels_low_resolution)
+        _upscale(pixels_low_resolution, self.pixels)
     
     def mouse_pressed_event(self, pos):
         pass
@@ -357,19 +1209,49 @@ class DisplayWindow():
             update_light_each_step=False,
             callback=None,  # Users can update smoke density, rotate camera etc. each step by assigning this callback function.
             image_process=None,  # Users can edit the rendering result before it displayed in the window each step by assigning this callback function.
-            enable_mouse_rotating=True
+            enable_mouse_rotating=True,
+            progressive=False,  # Render at reduced resolution while the camera moves, then refine to full resolution once it stops.
+            skip_unchanged_frames=None,  # Only render when Scene.version changes. None enables this when there is no callback and light is not updated each step. With a callback, call scene.mark_volume_dirty() after changing the volume.
+            temporal_accumulation=False  # Jitter view rays and average frames while the scene is still. Allows a larger ray_tracing_step_size_factor without banding. With a callback, call scene.mark_volume_dirty() after changing the volume.
         ):
+        if skip_unchanged_frames is None:
+            skip_unchanged_frames = callback is None and not update_light_each_step
+        if temporal_accumulation:
+            self.scene.jitter = True
         self.scene.update_light()  # Calculate light and shadow
 
         gui = ti.GUI(title, res=self.resolution)
         iteration = 0
+        camera_state = None
+        camera_change_time = time.time()
+        downsample = 1
+        rendered = None  # Scene version and downsampling of the image on screen
+        accumulated_frames = 0
         while gui.running:
             if update_light_each_step:
                 self.scene.update_light()
-            self.scene.render(self.pixels)
-            if not image_process is None:
-                image_process(iteration, self.pixels)
-            gui.set_image(self.pixels)
+            elif not callback is None:  # The callback may have changed the smoke density.
+                self.scene.update_macrocells()
+            if progressive:
+                if self.scene.get_camera_state() != camera_state:
+                    camera_state = self.scene.get_camera_state()
+                    camera_change_time = time.time()
+                    downsample = self.interaction_downsample
+                elif downsample > 1 and time.time() - camera_change_time >= self.refine_delay:
+                    downsample //= 2
+            changed = rendered != (self.scene.version, downsample)
+            accumulate = temporal_accumulation and downsample == 1
+            if changed:
+                accumulated_frames = 0
+            if not skip_unchanged_frames or changed or accumulate and accumulated_frames < self.max_accumulated_frames:
+                rendered = (self.scene.version, downsample)
+                self.render_frame(downsample)
+                if accumulate:
+                    _accumulate(self.pixels, self._accumulated_pixels, min(accumulated_frames, self.max_accumulated_frames - 1))
+                    accumulated_frames += 1
+                if not image_process is None:
+                    image_process(iteration, self.pixels)
+                gui.set_image(self.pixels)
             gui.show()
 
             # Manage mouse events
@@ -398,7 +1280,7 @@ def plot_volume(
     index_of_refraction=None,  # Can be None, NumPy array or Taichi vector field.
     point_lights_pos=None,  # Can be None, NumPy array or Taichi vector field. If left None, default lights applied.
     point_lights_intensity=None,  # Can be None, NumPy array or Taichi vector field. If left None, default lights applied.
-    lighting=True,
+    lighting=True,  # True, "march", "sweep" or False. See Scene.
     resolution=(720, 720),
     ray_tracing_stop_threshold=0.01,  # 0 ~ 1
     background=[0.2, 0.2, 0.2],
@@ -408,6 +1290,13 @@ def plot_volume(
     ray_tracing_step_size_factor=1.,  # The smaller the value here, the higher the ray tracing quality.
     light_ray_tracing_step_size_factor=3.,  # The smaller the value here, the higher the shadow quality.
     ray_tracing_max_steps=10000,  # This only takes effect in scenes where light rays may bend, such as those containing refractive materials.
+    empty_space_skipping=False,  # Let view rays leap over empty macrocells. Has no effect in scenes with refraction. See Scene.
+    macrocell_size=8,  # Edge length of a macrocell in voxels.
+    light_resolution_factor=1,  # Edge length of a light voxel in voxels. 2 or 4 makes lighting much cheaper. Light is trilinearly interpolated when this is above 1.
+    density_dtype=ti.f32,  # ti.f32 or ti.f16. See DisplayWindow.
+    color_dtype=ti.f32,  # ti.f32, ti.f16 or ti.u8. See DisplayWindow.
+    light_dtype=ti.f32,  # ti.f32 or ti.f16.
+    sparse=False,  # Store a NumPy smoke_density in a sparse field. See DisplayWindow.
     camera_phi=0,
     camera_theta=0,
     camera_distance=3,
@@ -416,7 +1305,10 @@ def plot_volume(
     update_light_each_step=False,
     callback=None,  # Users can update smoke density, rotate camera etc. each step by assigning this callback function.
     image_process=None,  # Users can edit the rendering result before it displayed in the window each step by assigning this callback function.
-    enable_mouse_rotating=True
+    enable_mouse_rotating=True,
+    progressive=False,  # Render at reduced resolution while the camera moves, then refine to full resolution once it stops.
+    skip_unchanged_frames=None,  # Only render when something changed. See DisplayWindow.show.
+    temporal_accumulation=False  # Jitter view rays and average frames while the scene is still. See DisplayWindow.show.
 ):
     window = DisplayWindow(
         smoke_density=smoke_density,
@@ -433,7 +1325,14 @@ def plot_volume(
         smoke_density_factor=smoke_density_factor,
         ray_tracing_step_size_factor=ray_tracing_step_size_factor,
         light_ray_tracing_step_size_factor=light_ray_tracing_step_size_factor,
-        ray_tracing_max_steps=ray_tracing_max_steps
+        ray_tracing_max_steps=ray_tracing_max_steps,
+        empty_space_skipping=empty_space_skipping,
+        macrocell_size=macrocell_size,
+        light_resolution_factor=light_resolution_factor,
+        density_dtype=density_dtype,
+        color_dtype=color_dtype,
+        light_dtype=light_dtype,
+        sparse=sparse
     )
     window.scene.set_camera_phi(camera_phi)
     window.scene.set_camera_theta(camera_theta)
@@ -444,5 +1343,8 @@ def plot_volume(
         update_light_each_step=update_light_each_step,
         callback=callback,
         image_process=image_process,
-        enable_mouse_rotating=enable_mouse_rotating
+        enable_mouse_rotating=enable_mouse_rotating,
+        progressive=progressive,
+        skip_unchanged_frames=skip_unchanged_frames,
+        temporal_accumulation=temporal_accumulation
     )
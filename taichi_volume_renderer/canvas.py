@@ -1,6 +1,7 @@
 import numpy as np
 import taichi as ti
-from .math import compute_covariance_inv, rotation_matrix_to_quaternion, rotation_quaternion_to_matrix, quaternion_multiply
+from .io import sparse_layout, as_array, StagingPool
+from .math import load_color, store_color, compute_covariance_inv, rotation_matrix_to_quaternion, rotation_quaternion_to_matrix, quaternion_multiply
 
 def construct_frame(x, y=None):
     x /= np.linalg.norm(x)
@@ -14,13 +15,46 @@ def construct_frame(x, y=None):
             y = np.cross(z, x)
             return x, y, z
 
-def empty_canvas(resolution):
+# Drawing functions return the region they may have changed, as integer voxel bounds ((x_start, y_start, z_start), (x_end, y_end, z_end))
+# with exclusive ends. Pass it to Scene.update_light(region=...) to relight only that part of the scene. draw_particles only returns
+# it with return_region=True, since it has to read the particles back from the device.
+
+def bounding_region(smoke_density_taichi, lower, upper):  # Region of voxels touched by anything inside the box [lower, upper], clipped to the canvas
+    shape = np.array(smoke_density_taichi.shape)
+    start = np.clip(np.floor(np.array(lower, dtype=float)).astype(int), 0, shape)
+    end = np.clip(np.floor(np.array(upper, dtype=float)).astype(int) + 2, 0, shape)  # Anti-aliased drawing also touches the next voxel.
+    end = np.maximum(start, end)
+    return tuple(int(e) for e in start), tuple(int(e) for e in end)
+
+def merge_regions(*regions):  # Smallest region containing all given regions. None entries are ignored.
+    regions = [e for e in regions if not e is None]
+    if len(regions) == 0:
+        return None
+    start = np.min([e[0] for e in regions], axis=0)
+    end = np.max([e[1] for e in regions], axis=0)
+    return tuple(int(e) for e in start), tuple(int(e) for e in end)
+
+def empty_canvas(
+    resolution,  # int for a cubic canvas, or a tuple of 3 ints.
+    density_dtype=ti.f32,  # ti.f32 or ti.f16
+    color_dtype=ti.f32,  # ti.f32, ti.f16 or ti.u8
+    sparse=False,  # Allocate memory block by block only where something is drawn.
+    block_size=8
+):
     if type(resolution) == int:
-        smoke = ti.field(dtype=float, shape=[resolution, resolution, resolution])
-        smoke_color = ti.Vector.field(3, dtype=float, shape=smoke.shape)
-        smoke_color.from_numpy(np.ones(list(smoke_color.shape) + [3]))
-        return smoke, smoke_color
-    raise TypeError("Unsupported type of resolution: " + str(type(resolution)))@ti.kernel
+        resolution = (resolution, resolution, resolution)
+    if not isinstance(resolution, (tuple, list)) or len(resolution) != 3:
+        raise TypeError("Unsupported type of resolution: " + str(type(resolution)))
+    if sparse:  # Density and color share one layout, so drawing activates both.
+        smoke = ti.field(dtype=density_dtype)
+        smoke_color = ti.Vector.field(3, dtype=color_dtype)
+        sparse_layout(resolution, block_size).place(smoke, smoke_color)
+        smoke.volume_shape = smoke_color.volume_shape = tuple(resolution)
+    else:
+        smoke = ti.field(dtype=density_dtype, shape=tuple(resolution))
+        smoke_color = ti.Vector.field(3, dtype=color_dtype, shape=smoke.shape)
+        smoke_color.fill(255 if color_dtype == ti.u8 else 1)
+    return smoke, smoke_color
 
 @ti.kernel
 def clean(
@@ -29,7 +63,7 @@ def clean(
     ):
     for I in ti.grouped(smoke_density_taichi):
         smoke_density_taichi[I] = 0
-        smoke_color_taichi[I] = ti.Vector([1, 1, 1])
+        store_color(smoke_color_taichi, I, ti.Vector([1., 1., 1.]))
 
 @ti.kernel
 def multiply(
@@ -37,7 +71,7 @@ def multiply(
     k: float
 ):
     for I in ti.grouped(taichi_field):
-        taichi_field[I] *= k
+        store_color(taichi_field, I, load_color(taichi_field, I) * k)
 
 @ti.kernel
 def clip_kernel(
@@ -46,7 +80,7 @@ def clip_kernel(
     max: float
 ):
     for I in ti.grouped(taichi_field):
-        taichi_field[I] = ti.math.clamp(taichi_field[I], min, max)
+        store_color(taichi_field, I, ti.math.clamp(load_color(taichi_field, I), min, max))
 
 def clip(
     taichi_field,
@@ -61,14 +95,99 @@ def gamma(
     power: float
 ):
     for I in ti.grouped(taichi_field):
-        taichi_field[I] = taichi_field[I] ** power
+        store_color(taichi_field, I, load_color(taichi_field, I) ** power)
 
 @ti.func
 def mix(color_1, density_1, color_2, density_2):
     return (color_1 * density_1 + color_2 * density_2) / (density_1 + density_2)
 
+# Batched drawing functions rasterize many primitives in one kernel launch. Primitives are given as NumPy arrays (or Taichi fields) with
+# one row per primitive; densities and colors may be single values or one per primitive. The work of all primitives is flattened into one
+# parallel loop: offsets[i] is the index of the first work item of primitive i, so large and small primitives are spread evenly.
+# Density is added with atomics, but color is mixed with a plain load and store. Where primitives drawn in one launch overlap, the color
+# of some of them can be lost, leaving a color that does not match the accumulated density. Pass premultiplied=True to accumulate color
+# with atomics as well (see premultiply_color), or draw overlapping primitives in separate calls.
+
+def _batch(a, n, width=None):  # Broadcast a value or an array to a contiguous float32 array with one row per primitive
+    if isinstance(a, ti.Field):
+        a = a.to_numpy()
+    shape = (n,) if width is None else (n, width)
+    return np.ascontiguousarray(np.broadcast_to(np.asarray(a, dtype=np.float32), shape))
+
+def _offsets(counts):
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    if offsets[-1] >= 2 ** 31:
+        raise ValueError("Too many voxels in one batch. Split the primitives into several batches.")
+    return offsets.astype(np.int32)
+
+def _voxel_boxes(smoke_density_taichi, start, end):  # Integer boxes [start, end) clipped to the canvas, and their offsets
+    shape = np.array(smoke_density_taichi.shape)
+    start = np.clip(start, 0, shape).astype(np.int32)
+    end = np.clip(end, 0, shape).astype(np.int32)
+    sizes = np.maximum(end - start, 0).astype(np.int32)
+    return start, sizes, _offsets(np.prod(sizes, axis=-1, dtype=np.int64))
+
+@ti.func
+def _find_primitive(offsets: ti.template(), k):  # type: ignore # Binary search for i with offsets[i] <= k < offsets[i + 1]
+    lower = 0
+    upper = offsets.shape[0] - 1
+    while upper - lower > 1:
+        middle = (lower + upper) // 2
+        if offsets[middle] <= k:
+            lower = middle
+        else:
+            upper = middle
+    return lower
+
+@ti.func
+def _box_voxel(starts: ti.template(), sizes: ti.template(), offsets: ti.template(), k):  # type: ignore # Primitive and voxel of the k-th work item of a batch of voxel boxes
+    i = _find_primitive(offsets, k)
+    j = k - offsets[i]
+    I = ti.Vector([starts[i, 0] + j // (sizes[i, 1] * sizes[i, 2]), starts[i, 1] + j // sizes[i, 2] % sizes[i, 1], starts[i, 2] + j % sizes[i, 2]])
+    return i, I
+
+@ti.func
+def _fill_voxel(smoke_density_taichi, smoke_color_taichi, I, density, color):
+    store_color(smoke_color_taichi, I, mix(load_color(smoke_color_taichi, I), smoke_density_taichi[I], color, density))
+    smoke_density_taichi[I] += density
+
+@ti.func
+def _deposit(smoke_density_taichi, smoke_color_taichi, I, density, color, premultiplied: ti.template()):  # type: ignore
+    if ti.static(premultiplied):  # A plain scatter-add, so parallel deposits need no ordering.
+        smoke_color_taichi[I] += ti.cast(color * density, smoke_color_taichi.dtype)
+        smoke_density_taichi[I] += density
+    else:
+        _fill_voxel(smoke_density_taichi, smoke_color_taichi, I, density, color)
+
+# Premultiplied accumulation: the color field holds density times color instead of color. Colors drawn with premultiplied=True are then
+# added with atomics and no longer depend on the order of deposits. Call premultiply_color before drawing and normalize_color afterwards.
+
 @ti.kernel
-def fill_rectangle(  # Fill rectangle
+def premultiply_color(
+    smoke_density_taichi: ti.template(),  # type: ignore
+    smoke_color_taichi: ti.template()  # type: ignore
+):
+    for I in ti.grouped(smoke_density_taichi):
+        smoke_color_taichi[I] = ti.cast(smoke_color_taichi[I] * smoke_density_taichi[I], smoke_color_taichi.dtype)
+
+@ti.kernel
+def normalize_color(
+    smoke_density_taichi: ti.template(),  # type: ignore
+    smoke_color_taichi: ti.template()  # type: ignore
+):
+    for I in ti.grouped(smoke_density_taichi):
+        color = ti.Vector([1., 1., 1.])
+        if smoke_density_taichi[I] > 0:
+            color = smoke_color_taichi[I] / smoke_density_taichi[I]
+        smoke_color_taichi[I] = ti.cast(color, smoke_color_taichi.dtype)
+
+def _check_premultiplied(smoke_color_taichi):
+    if smoke_color_taichi.dtype == ti.u8:
+        raise ValueError("Premultiplied colors need a floating-point color field.")
+
+@ti.kernel
+def _fill_rectangle_kernel(
     smoke_density_taichi: ti.template(),  # type: ignore
     smoke_color_taichi: ti.template(),  # type: ignore
     start: ti.math.vec3,  # type: ignore
@@ -81,11 +200,57 @@ def fill_rectangle(  # Fill rectangle
     start_int = ti.math.max(0, start_int)
     end_int = ti.math.min(smoke_density_taichi.shape, end_int)
     for I in ti.grouped(ti.ndrange([start_int.x, end_int.x], [start_int.y, end_int.y], [start_int.z, end_int.z])):
-        smoke_color_taichi[I] = mix(smoke_color_taichi[I], smoke_density_taichi[I], color, density)
+        store_color(smoke_color_taichi, I, mix(load_color(smoke_color_taichi, I), smoke_density_taichi[I], color, density))
         smoke_density_taichi[I] += density
 
+def fill_rectangle(  # Fill rectangle
+    smoke_density_taichi,
+    smoke_color_taichi,
+    start,
+    scale,
+    density,
+    color
+):
+    _fill_rectangle_kernel(smoke_density_taichi, smoke_color_taichi, start, scale, density, color)
+    return bounding_region(smoke_density_taichi, start, np.array(start, dtype=float) + scale)
+
 @ti.kernel
-def fill_disk(  # Fill disk (No anti-aliasing)
+def _fill_rectangles_kernel(
+    smoke_density_taichi: ti.template(),  # type: ignore
+    smoke_color_taichi: ti.template(),  # type: ignore
+    starts: ti.types.ndarray(),  # type: ignore
+    sizes: ti.types.ndarray(),  # type: ignore
+    offsets: ti.types.ndarray(),  # type: ignore
+    total: int,
+    densities: ti.types.ndarray(),  # type: ignore
+    colors: ti.types.ndarray(),  # type: ignore
+    premultiplied: ti.template()  # type: ignore
+    ):
+    for k in range(total):
+        i, I = _box_voxel(starts, sizes, offsets, k)
+        _deposit(smoke_density_taichi, smoke_color_taichi, I, densities[i], ti.Vector([colors[i, 0], colors[i, 1], colors[i, 2]]), premultiplied)
+
+def fill_rectangles(  # Fill many rectangles in one kernel launch
+    smoke_density_taichi,
+    smoke_color_taichi,
+    starts,  # [n, 3]
+    scales,  # [n, 3] or a single scale
+    densities,  # [n] or a single density
+    colors,  # [n, 3] or a single color
+    premultiplied=False  # smoke_color_taichi holds density times color. See premultiply_color.
+):
+    starts = _batch(starts, len(starts), 3)
+    if len(starts) == 0:
+        return None
+    if premultiplied:
+        _check_premultiplied(smoke_color_taichi)
+    ends = starts + _batch(scales, len(starts), 3)
+    voxel_starts, sizes, offsets = _voxel_boxes(smoke_density_taichi, np.round(starts), np.round(ends))
+    _fill_rectangles_kernel(smoke_density_taichi, smoke_color_taichi, voxel_starts, sizes, offsets, int(offsets[-1]), _batch(densities, len(starts)), _batch(colors, len(starts), 3), premultiplied)
+    return bounding_region(smoke_density_taichi, np.min(np.minimum(starts, ends), axis=0), np.max(np.maximum(starts, ends), axis=0))
+
+@ti.kernel
+def _fill_disk_kernel(
     smoke_density_taichi: ti.template(),  # type: ignore
     smoke_color_taichi: ti.template(),  # type: ignore
     center: ti.math.vec3,  # type: ignore
@@ -100,9 +265,58 @@ def fill_disk(  # Fill disk (No anti-aliasing)
 
     for I in ti.grouped(ti.ndrange([start.x, end.x], [start.y, end.y], [start.z, end.z])):
         if (I - center).norm() <= radius:
-            smoke_color_taichi[I] = mix(smoke_color_taichi[I], smoke_density_taichi[I], color, density)
+            store_color(smoke_color_taichi, I, mix(load_color(smoke_color_taichi, I), smoke_density_taichi[I], color, density))
             smoke_density_taichi[I] += density
 
+def fill_disk(  # Fill disk (No anti-aliasing)
+    smoke_density_taichi,
+    smoke_color_taichi,
+    center,
+    radius,
+    density,
+    color
+):
+    _fill_disk_kernel(smoke_density_taichi, smoke_color_taichi, center, radius, density, color)
+    return bounding_region(smoke_density_taichi, np.array(center, dtype=float) - radius, np.array(center, dtype=float) + radius)
+
+@ti.kernel
+def _fill_disks_kernel(
+    smoke_density_taichi: ti.template(),  # type: ignore
+    smoke_color_taichi: ti.template(),  # type: ignore
+    starts: ti.types.ndarray(),  # type: ignore
+    sizes: ti.types.ndarray(),  # type: ignore
+    offsets: ti.types.ndarray(),  # type: ignore
+    total: int,
+    centers: ti.types.ndarray(),  # type: ignore
+    radii: ti.types.ndarray(),  # type: ignore
+    densities: ti.types.ndarray(),  # type: ignore
+    colors: ti.types.ndarray(),  # type: ignore
+    premultiplied: ti.template()  # type: ignore
+    ):
+    for k in range(total):
+        i, I = _box_voxel(starts, sizes, offsets, k)
+        if (I - ti.Vector([centers[i, 0], centers[i, 1], centers[i, 2]])).norm() <= radii[i]:
+            _deposit(smoke_density_taichi, smoke_color_taichi, I, densities[i], ti.Vector([colors[i, 0], colors[i, 1], colors[i, 2]]), premultiplied)
+
+def fill_disks(  # Fill many disks in one kernel launch (No anti-aliasing)
+    smoke_density_taichi,
+    smoke_color_taichi,
+    centers,  # [n, 3]
+    radii,  # [n] or a single radius
+    densities,  # [n] or a single density
+    colors,  # [n, 3] or a single color
+    premultiplied=False  # smoke_color_taichi holds density times color. See premultiply_color.
+):
+    centers = _batch(centers, len(centers), 3)
+    if len(centers) == 0:
+        return None
+    if premultiplied:
+        _check_premultiplied(smoke_color_taichi)
+    radii = _batch(radii, len(centers))
+    starts, sizes, offsets = _voxel_boxes(smoke_density_taichi, np.floor(centers - radii[:, np.newaxis]), np.ceil(centers + radii[:, np.newaxis]))
+    _fill_disks_kernel(smoke_density_taichi, smoke_color_taichi, starts, sizes, offsets, int(offsets[-1]), centers, radii, _batch(densities, len(centers)), _batch(colors, len(centers), 3), premultiplied)
+    return bounding_region(smoke_density_taichi, np.min(centers - radii[:, np.newaxis], axis=0), np.max(centers + radii[:, np.newaxis], axis=0))
+
 @ti.func
 def _draw_point_scalar(
     smoke_density_taichi,
@@ -151,7 +365,8 @@ def _draw_point(
     smoke_color_taichi,
     point,
     density,
-    color
+    color,
+    premultiplied: ti.template()  # type: ignore
 ):
     point_int = int(point)
     point_fraction = point - point_int
@@ -159,43 +374,35 @@ def _draw_point(
         strength = density * (1 - point_fraction.x) * (1 - point_fraction.y) * (1 - point_fraction.z)
         if strength > 0:
             I_000 = point_int.x, point_int.y, point_int.z
-            smoke_color_taichi[I_000] = mix(smoke_color_taichi[I_000], smoke_density_taichi[I_000], color, strength)
-            smoke_density_taichi[I_000] += strength
+            _deposit(smoke_density_taichi, smoke_color_taichi, I_000, strength, color, premultiplied)
         strength = density * (1 - point_fraction.x) * (1 - point_fraction.y) * point_fraction.z
         if strength > 0:
             I_001 = point_int.x, point_int.y, point_int.z + 1
-            smoke_color_taichi[I_001] = mix(smoke_color_taichi[I_001], smoke_density_taichi[I_001], color, strength)
-            smoke_density_taichi[I_001] += strength
+            _deposit(smoke_density_taichi, smoke_color_taichi, I_001, strength, color, premultiplied)
         strength = density * (1 - point_fraction.x) * point_fraction.y * (1 - point_fraction.z)
         if strength > 0:
             I_010 = point_int.x, point_int.y + 1, point_int.z
-            smoke_color_taichi[I_010] = mix(smoke_color_taichi[I_010], smoke_density_taichi[I_010], color, strength)
-            smoke_density_taichi[I_010] += strength
+            _deposit(smoke_density_taichi, smoke_color_taichi, I_010, strength, color, premultiplied)
         strength = density * (1 - point_fraction.x) * point_fraction.y * point_fraction.z
         if strength > 0:
             I_011 = point_int.x, point_int.y + 1, point_int.z + 1
-            smoke_color_taichi[I_011] = mix(smoke_color_taichi[I_011], smoke_density_taichi[I_011], color, strength)
-            smoke_density_taichi[I_011] += strength
+            _deposit(smoke_density_taichi, smoke_color_taichi, I_011, strength, color, premultiplied)
         strength = density * point_fraction.x * (1 - point_fraction.y) * (1 - point_fraction.z)
         if strength > 0:
             I_100 = point_int.x + 1, point_int.y, point_int.z
-            smoke_color_taichi[I_100] = mix(smoke_color_taichi[I_100], smoke_density_taichi[I_100], color, strength)
-            smoke_density_taichi[I_100] += strength
+            _deposit(smoke_density_taichi, smoke_color_taichi, I_100, strength, color, premultiplied)
         strength = density * point_fraction.x * (1 - point_fraction.y) * point_fraction.z
         if strength > 0:
             I_101 = point_int.x + 1, point_int.y, point_int.z + 1
-            smoke_color_taichi[I_101] = mix(smoke_color_taichi[I_101], smoke_density_taichi[I_101], color, strength)
-            smoke_density_taichi[I_101] += strength
+            _deposit(smoke_density_taichi, smoke_color_taichi, I_101, strength, color, premultiplied)
         strength = density * point_fraction.x * point_fraction.y * (1 - point_fraction.z)
         if strength > 0:
             I_110 = point_int.x + 1, point_int.y + 1, point_int.z
-            smoke_color_taichi[I_110] = mix(smoke_color_taichi[I_110], smoke_density_taichi[I_110], color, strength)
-            smoke_density_taichi[I_110] += strength
+            _deposit(smoke_density_taichi, smoke_color_taichi, I_110, strength, color, premultiplied)
         strength = density * point_fraction.x * point_fraction.y * point_fraction.z
         if strength > 0:
             I_111 = point_int.x + 1, point_int.y + 1, point_int.z + 1
-            smoke_color_taichi[I_111] = mix(smoke_color_taichi[I_111], smoke_density_taichi[I_111], color, strength)
-            smoke_density_taichi[I_111] += strength
+            _deposit(smoke_density_taichi, smoke_color_taichi, I_111, strength, color, premultiplied)
 
 @ti.kernel
 def _draw_line_simple_kernel(  # Draw single-pixel-wide line (Anti-aliasing)
@@ -214,7 +421,7 @@ def _draw_line_simple_kernel(  # Draw single-pixel-wide line (Anti-aliasing)
     point_strength = density * length / (point_num - 1)
     for i in ti.ndrange(point_num if end_point else point_num - 1):
         t = float(i) / (point_num - 1)
-        _draw_point(smoke_density_taichi, smoke_color_taichi, start * (1 - t) + end * t, point_strength, color)
+        _draw_point(smoke_density_taichi, smoke_color_taichi, start * (1 - t) + end * t, point_strength, color, False)
 
 def draw_line_simple(  # Draw single-pixel-wide line (Anti-aliasing)
     smoke_density_taichi,
@@ -226,6 +433,52 @@ def draw_line_simple(  # Draw single-pixel-wide line (Anti-aliasing)
     step=0.5
     ):
     _draw_line_simple_kernel(smoke_density_taichi, smoke_color_taichi, start, end, density, color, True, step)
+    return bounding_region(smoke_density_taichi, np.minimum(start, end), np.maximum(start, end))
+
+@ti.kernel
+def _draw_lines_simple_kernel(  # Draw many single-pixel-wide lines (Anti-aliasing)
+    smoke_density_taichi: ti.template(),  # type: ignore
+    smoke_color_taichi: ti.template(),  # type: ignore
+    starts: ti.types.ndarray(),  # type: ignore
+    ends: ti.types.ndarray(),  # type: ignore
+    point_nums: ti.types.ndarray(),  # type: ignore
+    offsets: ti.types.ndarray(),  # type: ignore
+    total: int,
+    densities: ti.types.ndarray(),  # type: ignore
+    colors: ti.types.ndarray(),  # type: ignore
+    premultiplied: ti.template()  # type: ignore
+    ):
+    for k in range(total):
+        i = _find_primitive(offsets, k)
+        start = ti.Vector([starts[i, 0], starts[i, 1], starts[i, 2]])
+        end = ti.Vector([ends[i, 0], ends[i, 1], ends[i, 2]])
+        t = float(k - offsets[i]) / (point_nums[i] - 1)
+        point_strength = densities[i] * (end - start).norm() / (point_nums[i] - 1)
+        _draw_point(smoke_density_taichi, smoke_color_taichi, start * (1 - t) + end * t, point_strength, ti.Vector([colors[i, 0], colors[i, 1], colors[i, 2]]), premultiplied)
+
+def _draw_segments_simple(smoke_density_taichi, smoke_color_taichi, starts, ends, densities, colors, end_points, step, premultiplied):
+    lengths = np.sqrt(np.sum((ends - starts) ** 2, axis=-1))
+    point_nums = np.maximum(2, np.ceil(lengths / np.float32(step))).astype(np.int32)
+    offsets = _offsets(np.where(end_points, point_nums, point_nums - 1))
+    _draw_lines_simple_kernel(smoke_density_taichi, smoke_color_taichi, starts, ends, point_nums, offsets, int(offsets[-1]), densities, colors, premultiplied)
+    return bounding_region(smoke_density_taichi, np.min(np.minimum(starts, ends), axis=0), np.max(np.maximum(starts, ends), axis=0))
+
+def draw_lines_simple(  # Draw many single-pixel-wide lines in one kernel launch (Anti-aliasing)
+    smoke_density_taichi,
+    smoke_color_taichi,
+    starts,  # [n, 3]
+    ends,  # [n, 3]
+    densities,  # [n] or a single density
+    colors,  # [n, 3] or a single color
+    step=0.5,
+    premultiplied=False  # smoke_color_taichi holds density times color. See premultiply_color.
+):
+    starts = _batch(starts, len(starts), 3)
+    if len(starts) == 0:
+        return None
+    if premultiplied:
+        _check_premultiplied(smoke_color_taichi)
+    return _draw_segments_simple(smoke_density_taichi, smoke_color_taichi, starts, _batch(ends, len(starts), 3), _batch(densities, len(starts)), _batch(colors, len(starts), 3), np.ones(len(starts), dtype=bool), step, premultiplied)
 
 def draw_polyline_simple(  # Draw single-pixel-wide line (Anti-aliasing)
     smoke_density_taichi,
@@ -235,15 +488,178 @@ def draw_polyline_simple(  # Draw single-pixel-wide line (Anti-aliasing)
     color,
     step=0.5
 ):
-    if len(polyline) < 2:
-        return
-    for i in range(len(polyline) - 2):
-        _draw_line_simple_kernel(smoke_density_taichi, smoke_color_taichi, polyline[i], polyline[i + 1], density, color, False, step)
-    _draw_line_simple_kernel(smoke_density_taichi, smoke_color_taichi, polyline[-2], polyline[-1], density, color, True, step)
+    return draw_polylines_simple(smoke_density_taichi, smoke_color_taichi, [polyline], density, color, step)
+
+def draw_polylines_simple(  # Draw many single-pixel-wide polylines, e.g. streamlines, in one kernel launch (Anti-aliasing)
+    smoke_density_taichi,
+    smoke_color_taichi,
+    polylines,  # List of [m, 3] arrays
+    densities,  # One density per polyline, or a single density
+    colors,  # One color per polyline, or a single color
+    step=0.5,
+    premultiplied=False  # smoke_color_taichi holds density times color. See premultiply_color.
+):
+    polylines = [_batch(e, len(e), 3) for e in polylines]
+    segment_nums = np.array([max(len(e) - 1, 0) for e in polylines])
+    if np.sum(segment_nums) == 0:
+        return None
+    if premultiplied:
+        _check_premultiplied(smoke_color_taichi)
+    starts = np.concatenate([e[:-1] for e in polylines])
+    ends = np.concatenate([e[1:] for e in polylines])
+    end_points = np.zeros(len(starts), dtype=bool)
+    end_points[np.cumsum(segment_nums)[segment_nums > 0] - 1] = True  # Only the last segment of each polyline draws its end point.
+    densities = np.repeat(_batch(densities, len(polylines)), segment_nums)
+    colors = np.repeat(_batch(colors, len(polylines), 3), segment_nums, axis=0)
+    return _draw_segments_simple(smoke_density_taichi, smoke_color_taichi, starts, ends, densities, colors, end_points, step, premultiplied)
 
-# TODO: fill_cylinder
+@ti.func
+def _capped_cone_distance(p, a, b, ra, rb):  # Signed distance to the cone frustum with flat caps from a (radius ra) to b (radius rb)
+    distance = 1e9
+    baba = ti.math.dot(b - a, b - a)
+    if baba > 0:
+        rba = rb - ra
+        papa = ti.math.dot(p - a, p - a)
+        paba = ti.math.dot(p - a, b - a) / baba
+        x = ti.sqrt(ti.max(papa - paba * paba * baba, 0.))
+        cax = ti.max(0., x - (ra if paba < 0.5 else rb))
+        cay = ti.abs(paba - 0.5) - 0.5
+        f = ti.math.clamp((rba * (x - ra) + paba * baba) / (rba * rba + baba), 0., 1.)
+        cbx = x - ra - f * rba
+        cby = paba - f
+        sign = -1. if cbx < 0 and cay < 0 else 1.
+        distance = sign * ti.sqrt(ti.min(cax * cax + cay * cay * baba, cbx * cbx + cby * cby * baba))
+    return distance
 
-def draw_line(  # Draw line (Anti-aliasing)
+@ti.func
+def _round_cone_distance(p, a, b, ra, rb):  # Signed distance to the hull of the spheres at a (radius ra) and b (radius rb)
+    ba = b - a
+    l2 = ti.math.dot(ba, ba)
+    rr = ra - rb
+    a2 = l2 - rr * rr
+    distance = 0.
+    if a2 <= 0:  # One sphere contains the other.
+        distance = (p - a).norm() - ra if ra > rb else (p - b).norm() - rb
+    else:
+        pa = p - a
+        y = ti.math.dot(pa, ba)
+        z = y - l2
+        x2 = (pa * l2 - ba * y).norm_sqr()
+        y2 = y * y * l2
+        z2 = z * z * l2
+        k = ti.math.sign(rr) * rr * rr * x2
+        if ti.math.sign(z) * a2 * z2 > k:
+            distance = ti.sqrt(x2 + z2) / l2 - rb
+        elif ti.math.sign(y) * a2 * y2 < k:
+            distance = ti.sqrt(x2 + y2) / l2 - ra
+        else:
+            distance = (ti.sqrt(x2 * a2 / l2) + y * rr) / l2 - ra
+    return distance
+
+@ti.kernel
+def _fill_cones_kernel(  # Anti-aliasing
+    smoke_density_taichi: ti.template(),  # type: ignore
+    smoke_color_taichi: ti.template(),  # type: ignore
+    axes: ti.types.ndarray(),  # type: ignore
+    slice_starts: ti.types.ndarray(),  # type: ignore
+    widths: ti.types.ndarray(),  # type: ignore
+    offsets: ti.types.ndarray(),  # type: ignore
+    total: int,
+    starts: ti.types.ndarray(),  # type: ignore
+    ends: ti.types.ndarray(),  # type: ignore
+    start_radii: ti.types.ndarray(),  # type: ignore
+    end_radii: ti.types.ndarray(),  # type: ignore
+    densities: ti.types.ndarray(),  # type: ignore
+    colors: ti.types.ndarray(),  # type: ignore
+    round_caps: ti.template(),  # type: ignore
+    premultiplied: ti.template()  # type: ignore
+):
+    for k in range(total):
+        i = _find_primitive(offsets, k)
+        j = k - offsets[i]
+        start = ti.Vector([starts[i, 0], starts[i, 1], starts[i, 2]])
+        end = ti.Vector([ends[i, 0], ends[i, 1], ends[i, 2]])
+        direction = end - start
+        reach = ti.max(start_radii[i], end_radii[i]) + 0.5  # Coverage reaches half a voxel beyond the surface.
+
+        # Voxels are visited slice by slice along the main axis of the primitive. In each slice only the rectangle around the part of the
+        # axis within reach is visited, so the cost scales with the covered volume.
+        I = ti.Vector([-1, -1, -1])
+        for q in ti.static(range(3)):
+            if axes[i] == q:
+                b, c = ti.static((q + 1) % 3, (q + 2) % 3)
+                s = slice_starts[i] + j // (widths[i, 0] * widths[i, 1])
+                t_0, t_1 = 0., 1.
+                if direction[q] != 0:
+                    t_0 = (s - reach - start[q]) / direction[q]
+                    t_1 = (s + reach - start[q]) / direction[q]
+                    t_0, t_1 = ti.math.clamp(ti.min(t_0, t_1), 0., 1.), ti.math.clamp(ti.max(t_0, t_1), 0., 1.)
+                p_0 = start + direction * t_0
+                p_1 = start + direction * t_1
+                I[q] = s
+                I[b] = int(ti.floor(ti.min(p_0[b], p_1[b]) - reach)) + j // widths[i, 1] % widths[i, 0]
+                I[c] = int(ti.floor(ti.min(p_0[c], p_1[c]) - reach)) + j % widths[i, 1]
+                if I[b] > ti.max(p_0[b], p_1[b]) + reach or I[c] > ti.max(p_0[c], p_1[c]) + reach:
+                    I[q] = -1
+        if 0 <= I.x < smoke_density_taichi.shape[0] and 0 <= I.y < smoke_density_taichi.shape[1] and 0 <= I.z < smoke_density_taichi.shape[2]:
+            distance = 0.
+            if ti.static(round_caps):
+                distance = _round_cone_distance(float(I), start, end, start_radii[i], end_radii[i])
+            else:
+                distance = _capped_cone_distance(float(I), start, end, start_radii[i], end_radii[i])
+            coverage = ti.math.clamp(0.5 - distance, 0., 1.)  # Fraction of the voxel inside, estimated from the signed distance
+            if coverage > 0:
+                _deposit(smoke_density_taichi, smoke_color_taichi, I, densities[i] * coverage, ti.Vector([colors[i, 0], colors[i, 1], colors[i, 2]]), premultiplied)
+
+def _fill_cones(smoke_density_taichi, smoke_color_taichi, starts, ends, start_radii, end_radii, densities, colors, round_caps, premultiplied):
+    n = len(starts)
+    if premultiplied:
+        _check_premultiplied(smoke_color_taichi)
+    starts = _batch(starts, n, 3)
+    ends = _batch(ends, n, 3)
+    start_radii = _batch(start_radii, n)
+    end_radii = _batch(end_radii, n)
+    reach = np.maximum(start_radii, end_radii)[:, np.newaxis] + 0.5
+    lower = np.minimum(starts, ends) - reach
+    upper = np.maximum(starts, ends) + reach
+    shape = np.array(smoke_density_taichi.shape)
+
+    direction = np.abs(ends - starts)
+    axes = np.argmax(direction, axis=-1)
+    rows = np.arange(n)
+    slice_starts = np.clip(np.floor(lower[rows, axes]), 0, shape[axes]).astype(np.int32)
+    slice_nums = np.clip(np.ceil(upper[rows, axes]) + 1, 0, shape[axes]) - slice_starts
+    main_direction = np.maximum(direction[rows, axes], 1e-30)
+    widths = np.stack([
+        np.ceil(direction[rows, (axes + e) % 3] * np.minimum(1, 2 * reach[:, 0] / main_direction) + 2 * reach[:, 0] + 1e-3) + 2
+        for e in [1, 2]], axis=-1).astype(np.int32)
+    counts = np.maximum(slice_nums, 0) * widths[:, 0] * widths[:, 1]
+    counts[np.any((upper < 0) | (lower >= shape), axis=-1)] = 0  # Outside the canvas
+    offsets = _offsets(counts.astype(np.int64))
+    _fill_cones_kernel(
+        smoke_density_taichi, smoke_color_taichi,
+        axes.astype(np.int32), slice_starts, widths, offsets, int(offsets[-1]),
+        starts, ends, start_radii, end_radii, _batch(densities, n), _batch(colors, n, 3),
+        round_caps,
+        premultiplied)
+    return bounding_region(smoke_density_taichi, np.min(lower, axis=0), np.max(upper, axis=0))
+
+def fill_cones(  # Fill many cone frustums with flat caps in one kernel launch (Anti-aliasing)
+    smoke_density_taichi,
+    smoke_color_taichi,
+    starts,  # [n, 3]
+    ends,  # [n, 3]
+    start_radii,  # [n] or a single radius
+    end_radii,  # [n] or a single radius
+    densities,  # [n] or a single density
+    colors,  # [n, 3] or a single color
+    premultiplied=False  # smoke_color_taichi holds density times color. See premultiply_color.
+):
+    if len(starts) == 0:
+        return None
+    return _fill_cones(smoke_density_taichi, smoke_color_taichi, starts, ends, start_radii, end_radii, densities, colors, False, premultiplied)
+
+def fill_cylinder(  # Fill cylinder (Anti-aliasing)
     smoke_density_taichi,
     smoke_color_taichi,
     start,
@@ -252,12 +668,91 @@ def draw_line(  # Draw line (Anti-aliasing)
     density,
     color
 ):
-    assert radius == 1  # TODO
-    draw_line_simple(smoke_density_taichi, smoke_color_taichi, start, end, density, color)
+    return fill_cones(smoke_density_taichi, smoke_color_taichi, [start], [end], radius, radius, density, color)
 
-# TODO: fill_cone
+def fill_cone(  # Fill cone with its base at start and its apex at end (Anti-aliasing)
+    smoke_density_taichi,
+    smoke_color_taichi,
+    start,
+    end,
+    radius,
+    density,
+    color
+):
+    return fill_cones(smoke_density_taichi, smoke_color_taichi, [start], [end], radius, 0, density, color)
+
+def draw_lines(  # Draw many thick lines with round caps in one kernel launch (Anti-aliasing)
+    smoke_density_taichi,
+    smoke_color_taichi,
+    starts,  # [n, 3]
+    ends,  # [n, 3]
+    radii,  # [n] or a single radius
+    densities,  # [n] or a single density
+    colors,  # [n, 3] or a single color
+    premultiplied=False  # smoke_color_taichi holds density times color. See premultiply_color.
+):
+    if len(starts) == 0:
+        return None
+    return _fill_cones(smoke_density_taichi, smoke_color_taichi, starts, ends, radii, radii, densities, colors, True, premultiplied)
 
-# TODO: draw_arrow
+def draw_line(  # Draw line (Anti-aliasing). Radii up to 1 draw a single-pixel-wide line with draw_line_simple. Larger radii draw a line with round caps, see draw_lines.
+    smoke_density_taichi,
+    smoke_color_taichi,
+    start,
+    end,
+    radius,
+    density,
+    color
+):
+    if radius <= 1:
+        return draw_line_simple(smoke_density_taichi, smoke_color_taichi, start, end, density, color)
+    return draw_lines(smoke_density_taichi, smoke_color_taichi, [start], [end], radius, density, color)
+
+def draw_arrows(  # Draw many arrows, e.g. glyphs of a vector field, in one kernel launch (Anti-aliasing)
+    smoke_density_taichi,
+    smoke_color_taichi,
+    starts,  # [n, 3]
+    ends,  # [n, 3], the tips of the arrows
+    radii,  # [n] or a single shaft radius
+    densities,  # [n] or a single density
+    colors,  # [n, 3] or a single color
+    head_radius=2.,  # In multiples of the shaft radius
+    head_length=3.,  # In multiples of the shaft radius. Short arrows are all head.
+    premultiplied=False  # smoke_color_taichi holds density times color. See premultiply_color.
+):
+    n = len(starts)
+    if n == 0:
+        return None
+    starts = _batch(starts, n, 3)
+    ends = _batch(ends, n, 3)
+    radii = _batch(radii, n)
+    lengths = np.sqrt(np.sum((ends - starts) ** 2, axis=-1))
+    head_fractions = np.clip(head_length * radii / np.maximum(lengths, 1e-30), 0, 1)[:, np.newaxis]
+    necks = ends + (starts - ends) * head_fractions
+    return _fill_cones(
+        smoke_density_taichi,
+        smoke_color_taichi,
+        np.concatenate([starts, necks]),
+        np.concatenate([necks, ends]),
+        np.concatenate([radii, radii * head_radius]),
+        np.concatenate([radii, np.zeros(n, dtype=np.float32)]),
+        np.tile(_batch(densities, n), 2),
+        np.tile(_batch(colors, n, 3), [2, 1]),
+        False,
+        premultiplied)
+
+def draw_arrow(  # Draw arrow (Anti-aliasing)
+    smoke_density_taichi,
+    smoke_color_taichi,
+    start,
+    end,
+    radius,
+    density,
+    color,
+    head_radius=2.,
+    head_length=3.
+):
+    return draw_arrows(smoke_density_taichi, smoke_color_taichi, [start], [end], radius, density, color, head_radius, head_length)
 
 # TODO: draw_circle
 
@@ -282,7 +777,7 @@ def _draw_helix_kernel(
     point_strength = density * length / (point_num - 1)
     for i in ti.ndrange(point_num):
         t = float(i) / (point_num - 1)
-        _draw_point(smoke_density_taichi, smoke_color_taichi, start + x * (t * height) + y * (radius * ti.cos(2 * ti.math.pi * rounds * t)) + z * (radius * ti.sin(2 * ti.math.pi * rounds * t)), point_strength, color)
+        _draw_point(smoke_density_taichi, smoke_color_taichi, start + x * (t * height) + y * (radius * ti.cos(2 * ti.math.pi * rounds * t)) + z * (radius * ti.sin(2 * ti.math.pi * rounds * t)), point_strength, color, False)
 
 def draw_helix(  # Draw helix (Anti-aliasing)
     smoke_density_taichi: ti.template(),  # type: ignore
@@ -314,6 +809,7 @@ def draw_helix(  # Draw helix (Anti-aliasing)
         density,
         color,
         step)
+    return bounding_region(smoke_density_taichi, np.minimum(start.to_numpy(), end.to_numpy()) - radius, np.maximum(start.to_numpy(), end.to_numpy()) + radius)
 
 
 # TODO: draw_cubic_bezier_curve
@@ -323,7 +819,7 @@ def draw_helix(  # Draw helix (Anti-aliasing)
 # TODO: draw_spline
 
 @ti.kernel
-def fill_convex(
+def _fill_convex_kernel(
     smoke_density_taichi: ti.template(),  # type: ignore
     smoke_color_taichi: ti.template(),  # type: ignore
     center: ti.math.vec3,  # type: ignore
@@ -344,79 +840,141 @@ def fill_convex(
             if ti.math.dot(relative_location, face_vectors[i]) > 1:
                 inside = False
         if inside:
-            smoke_color_taichi[I] = mix(smoke_color_taichi[I], smoke_density_taichi[I], color, density)
+            store_color(smoke_color_taichi, I, mix(load_color(smoke_color_taichi, I), smoke_density_taichi[I], color, density))
             smoke_density_taichi[I] += density
 
-def fill_platonic_solid(
+def fill_convex(  # Fill the convex polyhedron {x : dot(x - center, face_vectors[i]) <= 1 for all i} (No anti-aliasing)
     smoke_density_taichi,
     smoke_color_taichi,
     center,
-    radius,
-    face_num,
+    face_vectors,  # Taichi vector field
+    radius_consider,  # Only voxels within this distance along each axis are considered.
     density,
-    color,
-    transform=None
+    color
 ):
-    if transform is None:
-        transform = np.eye(3)
-
-    phi = (1 + np.sqrt(5)) / 2
-    face_vectors = {
-        4: [
-            [1, 1, 1],
-            [-1, -1, 1],
-            [-1, 1, -1],
-            [1, -1, -1]
-        ],
-        6:[
-            [1, 0, 0], [-1, 0, 0],
-            [0, 1, 0], [0, -1, 0],
-            [0, 0, 1], [0, 0, -1]
-        ],
-        8:[
-            [1, 1, 1],
-            [1, 1, -1],
-            [1, -1, 1],
-            [1, -1, -1],
-            [-1, 1, 1],
-            [-1, 1, -1],
-            [-1, -1, 1],
-            [-1, -1, -1]
-        ],
-        12:[
-            [0, 1, phi], [0, -1, phi], [0, 1, -phi], [0, -1, -phi],
-            [1, phi, 0], [-1, phi, 0], [1, -phi, 0], [-1, -phi, 0],
-            [phi, 0, 1], [-phi, 0, 1], [phi, 0, -1], [-phi, 0, -1]
-        ],
-        20:[
-            [1, 1, 1], [1, 1, -1], [1, -1, 1], [1, -1, -1],
-            [-1, 1, 1], [-1, 1, -1], [-1, -1, 1], [-1, -1, -1],
-            [0, 1 / phi, phi], [0, 1 / phi, -phi], [0, -1 / phi, phi], [0, -1 / phi, -phi],
-            [phi, 0, 1 / phi], [phi, 0, -1 / phi], [-phi, 0, 1 / phi], [-phi, 0, -1 / phi],
-            [1 / phi, phi, 0], [1 / phi, -phi, 0], [-1 / phi, phi, 0], [-1 / phi, -phi, 0]
-        ]
-    }[face_num]
-    face_vectors = np.array(face_vectors, dtype=float)
-    face_vectors /= np.sum(face_vectors ** 2, axis=-1)[:, np.newaxis] ** 0.5  # Normalize
-    face_vectors /= radius
-    face_vectors @= np.linalg.inv(transform)
-    face_vectors_taichi = ti.Vector.field(3, ti.f32, shape=[len(face_vectors)])
-    face_vectors_taichi.from_numpy(face_vectors)
-
-    fill_convex(
-        smoke_density_taichi,
-        smoke_color_taichi,
-        center,
-        face_vectors_taichi,
-        radius * np.max(np.linalg.eigvals(transform)) * {  # Vertex-to-center to face-center-to-center distance ratio in Platonic solids
+    _fill_convex_kernel(smoke_density_taichi, smoke_color_taichi, center, face_vectors, radius_consider, density, color)
+    return bounding_region(smoke_density_taichi, np.array(center, dtype=float) - radius_consider, np.array(center, dtype=float) + radius_consider)
+
+_platonic_solids = {}
+
+def _platonic_solid(face_num):  # Unit face normals and the vertex-to-center to face-center-to-center distance ratio
+    if not face_num in _platonic_solids:
+        phi = (1 + np.sqrt(5)) / 2
+        face_vectors = {
+            4: [
+                [1, 1, 1],
+                [-1, -1, 1],
+                [-1, 1, -1],
+                [1, -1, -1]
+            ],
+            6:[
+                [1, 0, 0], [-1, 0, 0],
+                [0, 1, 0], [0, -1, 0],
+                [0, 0, 1], [0, 0, -1]
+            ],
+            8:[
+                [1, 1, 1],
+                [1, 1, -1],
+                [1, -1, 1],
+                [1, -1, -1],
+                [-1, 1, 1],
+                [-1, 1, -1],
+                [-1, -1, 1],
+                [-1, -1, -1]
+            ],
+            12:[
+                [0, 1, phi], [0, -1, phi], [0, 1, -phi], [0, -1, -phi],
+                [1, phi, 0], [-1, phi, 0], [1, -phi, 0], [-1, -phi, 0],
+                [phi, 0, 1], [-phi, 0, 1], [phi, 0, -1], [-phi, 0, -1]
+            ],
+            20:[
+                [1, 1, 1], [1, 1, -1], [1, -1, 1], [1, -1, -1],
+                [-1, 1, 1], [-1, 1, -1], [-1, -1, 1], [-1, -1, -1],
+                [0, 1 / phi, phi], [0, 1 / phi, -phi], [0, -1 / phi, phi], [0, -1 / phi, -phi],
+                [phi, 0, 1 / phi], [phi, 0, -1 / phi], [-phi, 0, 1 / phi], [-phi, 0, -1 / phi],
+                [1 / phi, phi, 0], [1 / phi, -phi, 0], [-1 / phi, phi, 0], [-1 / phi, -phi, 0]
+            ]
+        }[face_num]
+        face_vectors = np.array(face_vectors, dtype=float)
+        face_vectors /= np.sum(face_vectors ** 2, axis=-1)[:, np.newaxis] ** 0.5  # Normalize
+        ratio = {
             4: 3,
             6: 3 ** 0.5,
             8: 3 ** 0.5,
             12: 3 ** 0.5 / phi * ((5 - 5 ** 0.5) / 2) ** 0.5,
             20: 3 ** 0.5 / phi
-        }[face_num],
-        density,
-        color)
+        }[face_num]
+        _platonic_solids[face_num] = face_vectors.astype(np.float32), ratio
+    return _platonic_solids[face_num]
+
+def fill_platonic_solid(
+    smoke_density_taichi,
+    smoke_color_taichi,
+    center,
+    radius,
+    face_num,
+    density,
+    color,
+    transform=None
+):
+    return fill_platonic_solids(smoke_density_taichi, smoke_color_taichi, [center], radius, face_num, density, color, transform)
+
+@ti.kernel
+def _fill_convexes_kernel(
+    smoke_density_taichi: ti.template(),  # type: ignore
+    smoke_color_taichi: ti.template(),  # type: ignore
+    starts: ti.types.ndarray(),  # type: ignore
+    sizes: ti.types.ndarray(),  # type: ignore
+    offsets: ti.types.ndarray(),  # type: ignore
+    total: int,
+    centers: ti.types.ndarray(),  # type: ignore
+    inverse_transforms: ti.types.ndarray(),  # type: ignore
+    face_vectors: ti.types.ndarray(),  # type: ignore
+    densities: ti.types.ndarray(),  # type: ignore
+    colors: ti.types.ndarray(),  # type: ignore
+    premultiplied: ti.template()  # type: ignore
+):
+    for k in range(total):
+        i, I = _box_voxel(starts, sizes, offsets, k)
+        relative_location = I - ti.Vector([centers[i, 0], centers[i, 1], centers[i, 2]])
+        local_location = ti.Vector([0., 0., 0.])
+        for a, b in ti.static(ti.ndrange(3, 3)):
+            local_location[a] += inverse_transforms[i, a, b] * relative_location[b]
+        inside = True
+        for j in range(face_vectors.shape[0]):
+            if local_location.x * face_vectors[j, 0] + local_location.y * face_vectors[j, 1] + local_location.z * face_vectors[j, 2] > 1:
+                inside = False
+        if inside:
+            _deposit(smoke_density_taichi, smoke_color_taichi, I, densities[i], ti.Vector([colors[i, 0], colors[i, 1], colors[i, 2]]), premultiplied)
+
+def fill_platonic_solids(  # Fill many Platonic solids of the same kind in one kernel launch (No anti-aliasing)
+    smoke_density_taichi,
+    smoke_color_taichi,
+    centers,  # [n, 3]
+    radii,  # [n] or a single radius
+    face_num,  # 4, 6, 8, 12 or 20
+    densities,  # [n] or a single density
+    colors,  # [n, 3] or a single color
+    transforms=None,  # [n, 3, 3] or a single 3x3 matrix
+    premultiplied=False  # smoke_color_taichi holds density times color. See premultiply_color.
+):
+    centers = _batch(centers, len(centers), 3)
+    if len(centers) == 0:
+        return None
+    if premultiplied:
+        _check_premultiplied(smoke_color_taichi)
+    radii = _batch(radii, len(centers))
+    if transforms is None:
+        transforms = np.eye(3)
+    transforms = np.broadcast_to(np.asarray(transforms, dtype=float), (len(centers), 3, 3))
+    face_vectors, ratio = _platonic_solid(face_num)
+    inverse_transforms = np.ascontiguousarray(np.linalg.inv(transforms) / radii[:, np.newaxis, np.newaxis], dtype=np.float32)
+    radii_consider = radii * np.linalg.norm(transforms, ord=2, axis=(-2, -1)) * ratio  # Only voxels within this distance along each axis are considered.
+    lower = centers - radii_consider[:, np.newaxis]
+    upper = centers + radii_consider[:, np.newaxis]
+    starts, sizes, offsets = _voxel_boxes(smoke_density_taichi, np.floor(lower), np.ceil(upper))
+    _fill_convexes_kernel(smoke_density_taichi, smoke_color_taichi, starts, sizes, offsets, int(offsets[-1]), centers, inverse_transforms, face_vectors, _batch(densities, len(centers)), _batch(colors, len(centers), 3), premultiplied)
+    return bounding_region(smoke_density_taichi, np.min(lower, axis=0), np.max(upper, axis=0))
 
 # TODO: Plot function
 
@@ -424,18 +982,20 @@ def fill_platonic_solid(
 def _draw_identical_particles_scalar_kernel(
     field_taichi: ti.template(),  # type: ignore
     particles_taichi: ti.template(),  # type: ignore
+    n: int,
     density: float
 ):
-    for point in particles_taichi:
-        _draw_point_scalar(field_taichi, point, density)
+    for i in range(n):
+        _draw_point_scalar(field_taichi, particles_taichi[i], density)
 
 @ti.kernel
 def _draw_particles_scalar_kernel(
     field_taichi: ti.template(),  # type: ignore
     particles_taichi: ti.template(),  # type: ignore
+    n: int,
     densities_taichi: ti.template(),  # type: ignore
 ):
-    for i in ti.ndrange(particles_taichi.shape[0]):
+    for i in range(n):
         _draw_point_scalar(field_taichi, particles_taichi[i], densities_taichi[i])
 
 @ti.kernel
@@ -443,22 +1003,45 @@ def _draw_identical_particles_kernel(  # Draw particles with single color and de
     smoke_density_taichi: ti.template(),  # type: ignore
     smoke_color_taichi: ti.template(),  # type: ignore
     particles_taichi: ti.template(),  # type: ignore
+    n: int,
     density: float,
-    color: ti.math.vec3  # type: ignore
+    color: ti.math.vec3,  # type: ignore
+    premultiplied: ti.template()  # type: ignore
 ):
-    for point in particles_taichi:
-        _draw_point(smoke_density_taichi, smoke_color_taichi, point, density, color)
+    for i in range(n):
+        _draw_point(smoke_density_taichi, smoke_color_taichi, particles_taichi[i], density, color, premultiplied)
 
 @ti.kernel
 def _draw_particles_kernel(  # Draw particles (Anti-aliasing)
     smoke_density_taichi: ti.template(),  # type: ignore
     smoke_color_taichi: ti.template(),  # type: ignore
     particles_taichi: ti.template(),  # type: ignore
+    n: int,
     densities_taichi: ti.template(),  # type: ignore
     colors_taichi: ti.template(),  # type: ignore
+    premultiplied: ti.template()  # type: ignore
 ):
-    for i in ti.ndrange(particles_taichi.shape[0]):
-        _draw_point(smoke_density_taichi, smoke_color_taichi, particles_taichi[i], densities_taichi[i], colors_taichi[i])
+    for i in range(n):
+        _draw_point(smoke_density_taichi, smoke_color_taichi, particles_taichi[i], densities_taichi[i], colors_taichi[i], premultiplied)
+
+@ti.kernel
+def _bounding_box_kernel(
+    particles_taichi: ti.template(),  # type: ignore
+    n: int
+) -> ti.types.matrix(2, 3, ti.f32):  # type: ignore
+    lower = ti.Vector([np.inf, np.inf, np.inf])
+    upper = -lower
+    for i in range(n):
+        ti.atomic_min(lower, particles_taichi[i])
+        ti.atomic_max(upper, particles_taichi[i])
+    return ti.Matrix.rows([lower, upper])
+
+def _particles_region(smoke_density_taichi, particles, n):  # Region touched by the first n particles. Reads the bounding box back from the device.
+    lower, upper = _bounding_box_kernel(particles, n).to_numpy()
+    return bounding_region(smoke_density_taichi, lower, upper)
+
+# NumPy arrays, ti.ndarrays and tensors passed to drawing functions are copied into these fields, which are reused from call to call.
+_staging = StagingPool()
 
 def is_vector(a):
     if isinstance(a, list) and len(a) == 3:  # List
@@ -477,49 +1060,295 @@ def is_vector(a):
 
 def draw_particles(  # Draw particles (Anti-aliasing)
     smoke_density_taichi,
-    particles,
+    particles,  # Taichi vector field, NumPy array, ti.ndarray or tensor of shape [n, 3]
     smoke_color_taichi=None,
     densities=1.,
     colors=[1, 1, 1],
+    premultiplied=False,  # smoke_color_taichi holds density times color. See premultiply_color.
+    return_region=False  # Return the region that may have changed. Waits for the device to compute the bounding box of the particles.
 ):
     if not isinstance(particles, ti.Field):
-        particles_numpy = particles
-        particles = ti.Vector.field(3, dtype=ti.f32, shape=particles.shape[:-1])
-        particles.from_numpy(particles_numpy)
+        particles = as_array(particles)
+    n = particles.shape[0]
+    if n == 0:
+        return None
+    if premultiplied and not smoke_color_taichi is None:
+        _check_premultiplied(smoke_color_taichi)
+
+    if not isinstance(particles, ti.Field):
+        particles = _staging.stage('particles', particles, vector=True)
+    region = _particles_region(smoke_density_taichi, particles, n) if return_region else None
+
     if not type(densities) in [int, float]:
-        if not isinstance(densities, ti.Field):  # Numpy array
-            densities_numpy = densities
-            densities = ti.field(dtype=ti.f32, shape=densities.shape)
-            densities.from_numpy(densities_numpy)
+        if not isinstance(densities, ti.Field):  # Array
+            densities = _staging.stage('densities', densities)
     if not is_vector(colors):
-        if not isinstance(colors, ti.Field):  # Numpy array
-            colors_numpy = colors
-            colors = ti.Vector.field(3, dtype=ti.f32, shape=colors.shape[:-1])
-            colors.from_numpy(colors_numpy)
+        if not isinstance(colors, ti.Field):  # Array
+            colors = _staging.stage('colors', colors, vector=True)
     if not smoke_color_taichi is None:
         if isinstance(densities, ti.Field) ^ isinstance(colors, ti.Field):
             if isinstance(densities, ti.Field):  # colors is a value. Need to convert to a constant taichi field.
-                colors_numpy = np.zeros([particles.shape[0], 3])
-                for i in range(3):
-                    colors_numpy[:, i] = colors[i]
-                colors = ti.Vector.field(3, dtype=ti.f32, shape=colors_numpy.shape[:-1])
-                colors.from_numpy(colors_numpy)
+                color = colors
+                colors = _staging.field('colors', ti.f32, 3, n)
+                colors.fill(color)
             else:  # densities is a value. Need to convert to a constant taichi field.
-                densities_numpy = np.zeros(particles.shape[0])
-                densities_numpy.fill(densities)
-                densities = ti.field(dtype=ti.f32, shape=densities_numpy.shape)
-                densities.from_numpy(densities_numpy)
+                density = densities
+                densities = _staging.field('densities', ti.f32, 0, n)
+                densities.fill(density)
 
     if smoke_color_taichi is None:
         if type(densities) in [int, float]:
-            _draw_identical_particles_scalar_kernel(smoke_density_taichi, particles, densities)
+            _draw_identical_particles_scalar_kernel(smoke_density_taichi, particles, n, densities)
         else:
-            _draw_particles_scalar_kernel(smoke_density_taichi, particles, densities)
+            _draw_particles_scalar_kernel(smoke_density_taichi, particles, n, densities)
     else:
         if type(densities) in [int, float]:
-            _draw_identical_particles_kernel(smoke_density_taichi, smoke_color_taichi, particles, densities, colors)
+            _draw_identical_particles_kernel(smoke_density_taichi, smoke_color_taichi, particles, n, densities, colors, premultiplied)
+        else:
+            _draw_particles_kernel(smoke_density_taichi, smoke_color_taichi, particles, n, densities, colors, premultiplied)
+    return region
+
+@ti.func
+def _draw_point_exclusive(  # Same weights as _draw_point, but with plain loads and stores instead of atomics. The caller must own the voxels.
+    smoke_density_taichi,
+    smoke_color_taichi,
+    point,
+    density,
+    color,
+    with_color: ti.template(),  # type: ignore
+    premultiplied: ti.template()  # type: ignore
+):
+    point_int = int(point)
+    point_fraction = point - point_int
+    for offset in ti.static(ti.grouped(ti.ndrange(2, 2, 2))):
+        weight = offset * point_fraction + (1 - offset) * (1 - point_fraction)
+        strength = density * weight.x * weight.y * weight.z
+        if strength > 0:
+            I = point_int + offset
+            if ti.static(with_color and premultiplied):
+                smoke_color_taichi[I] = smoke_color_taichi[I] + ti.cast(color * strength, smoke_color_taichi.dtype)
+            elif ti.static(with_color):
+                store_color(smoke_color_taichi, I, mix(load_color(smoke_color_taichi, I), smoke_density_taichi[I], color, strength))
+            smoke_density_taichi[I] = smoke_density_taichi[I] + strength
+
+# Binned deposition. Particles are sorted by brick with a counting sort, then bricks two apart along every axis deposit
+# their particles in parallel. Each brick sums its particles in a thread-local tile and writes every voxel of the tile
+# once, so the canvas sees one load and store per touched voxel instead of one atomic per particle corner. Per-brick and
+# per-particle buffers are ndarrays, so every BinnedDeposition with the same brick size shares the compiled kernels.
+
+_Indices = ti.types.ndarray(dtype=ti.i32, ndim=1)
+
+@ti.func
+def _brick_of_point(smoke_density_taichi: ti.template(), brick_size, grid_shape, point):  # type: ignore # Index of the brick holding the voxel of point, or -1 outside the canvas
+    brick = -1
+    point_int = int(point)
+    if point_int.x >= 0 and point_int.x < smoke_density_taichi.shape[0] - 1 and point_int.y >= 0 and point_int.y < smoke_density_taichi.shape[1] - 1 and point_int.z >= 0 and point_int.z < smoke_density_taichi.shape[2] - 1:
+        b = point_int // brick_size
+        brick = (b.x * grid_shape[1] + b.y) * grid_shape[2] + b.z
+    return brick
+
+@ti.kernel
+def _bin_count(
+    smoke_density_taichi: ti.template(),  # type: ignore
+    particles: ti.template(),  # type: ignore
+    n: int,
+    brick_size: int,
+    grid_shape: ti.math.ivec3,  # type: ignore
+    bricks: _Indices,  # type: ignore
+    counts: _Indices  # type: ignore
+):
+    for b in range(counts.shape[0]):
+        counts[b] = 0
+    for i in range(n):
+        bricks[i] = _brick_of_point(smoke_density_taichi, brick_size, grid_shape, particles[i])
+        if bricks[i] >= 0:
+            ti.atomic_add(counts[bricks[i]], 1)
+
+@ti.kernel
+def _bin_scan(
+    counts: _Indices,  # type: ignore
+    starts: _Indices,  # type: ignore # Particles of brick b are sorted[starts[b]:starts[b + 1]].
+    cursors: _Indices,  # type: ignore
+    block_starts: _Indices,  # type: ignore # One entry per block of bricks, plus one
+    block: int  # Bricks per block
+):  # Block-wise exclusive prefix sum of counts. Blocks are summed in parallel, then only the block totals are scanned in order.
+    brick_num = counts.shape[0]
+    for k in range(block_starts.shape[0] - 1):
+        total = 0
+        for b in range(k * block, ti.min((k + 1) * block, brick_num)):
+            total += counts[b]
+            starts[b + 1] = total
+        block_starts[k + 1] = total
+    block_starts[0] = 0
+    starts[0] = 0
+    ti.loop_config(serialize=True)
+    for k in range(block_starts.shape[0] - 1):
+        block_starts[k + 1] += block_starts[k]
+    for b in range(brick_num):
+        starts[b + 1] += block_starts[b // block]
+        cursors[b] = starts[b + 1] - counts[b]
+
+@ti.kernel
+def _bin_scatter(
+    n: int,
+    bricks: _Indices,  # type: ignore
+    cursors: _Indices,  # type: ignore
+    sorted_particles: _Indices  # type: ignore
+):
+    for i in range(n):
+        if bricks[i] >= 0:
+            sorted_particles[ti.atomic_add(cursors[bricks[i]], 1)] = i
+
+@ti.kernel
+def _bin_deposit(
+    smoke_density_taichi: ti.template(),  # type: ignore
+    smoke_color_taichi: ti.template(),  # type: ignore # Unused without colors
+    with_color: ti.template(),  # type: ignore
+    brick_size: ti.template(),  # type: ignore
+    grid_shape: ti.math.ivec3,  # type: ignore
+    parity: ti.math.ivec3,  # type: ignore
+    starts: _Indices,  # type: ignore
+    sorted_particles: _Indices,  # type: ignore
+    particles: ti.template(),  # type: ignore
+    density: float,
+    color: ti.math.vec3,  # type: ignore
+    densities: ti.template(),  # type: ignore
+    colors: ti.template(),  # type: ignore
+    per_particle: ti.template(),  # type: ignore
+    premultiplied: ti.template()  # type: ignore
+):
+    # Each brick accumulates its particles in a thread-local tile covering its voxels and one layer of the next bricks, then writes
+    # every touched voxel once. Bricks two apart along every axis never share a voxel, so the writes need no atomics.
+    tile_width = ti.static(brick_size + 1)
+    for B in ti.grouped(ti.ndrange((grid_shape[0] + 1 - parity.x) // 2, (grid_shape[1] + 1 - parity.y) // 2, (grid_shape[2] + 1 - parity.z) // 2)):
+        brick = B * 2 + parity
+        b = (brick.x * grid_shape[1] + brick.y) * grid_shape[2] + brick.z
+        if starts[b] < starts[b + 1]:
+            origin = brick * brick_size
+            tile_density = ti.Vector.zero(ti.f32, tile_width ** 3)
+            tile_color = ti.Matrix.zero(ti.f32, tile_width ** 3, 3)  # Density times color. Sequential mixing adds up to the same weighted mean.
+            for k in range(starts[b], starts[b + 1]):
+                i = sorted_particles[k]
+                point_density = density
+                point_color = color
+                if ti.static(per_particle):
+                    point_density = densities[i]
+                    point_color = colors[i]
+                point_int = int(particles[i])
+                point_fraction = particles[i] - point_int
+                local = point_int - origin
+                for offset in ti.static(ti.grouped(ti.ndrange(2, 2, 2))):
+                    weight = offset * point_fraction + (1 - offset) * (1 - point_fraction)
+                    strength = point_density * weight.x * weight.y * weight.z
+                    if strength > 0:
+                        J = local + offset
+                        t = (J.x * tile_width + J.y) * tile_width + J.z
+                        tile_density[t] += strength
+                        if ti.static(with_color):
+                            for c in ti.static(range(3)):
+                                tile_color[t, c] += point_color[c] * strength
+            for t in range(tile_width ** 3):
+                if tile_density[t] > 0:
+                    I = origin + ti.Vector([t // (tile_width * tile_width), t // tile_width % tile_width, t % tile_width])
+                    if ti.static(with_color and premultiplied):
+                        smoke_color_taichi[I] = smoke_color_taichi[I] + ti.cast(ti.Vector([tile_color[t, 0], tile_color[t, 1], tile_color[t, 2]]), smoke_color_taichi.dtype)
+                    elif ti.static(with_color):
+                        total = smoke_density_taichi[I] + tile_density[t]
+                        store_color(smoke_color_taichi, I, (load_color(smoke_color_taichi, I) * smoke_density_taichi[I] + ti.Vector([tile_color[t, 0], tile_color[t, 1], tile_color[t, 2]])) / total)
+                    smoke_density_taichi[I] = smoke_density_taichi[I] + tile_density[t]
+
+class BinnedDeposition():  # Draws large numbers of particles with the same result as draw_particles. Particles are sorted by brick with a counting sort, then each brick accumulates its particles in a local tile and writes it back once without atomics.
+    def __init__(
+        self,
+        smoke_density_taichi,
+        smoke_color_taichi=None,
+        brick_size=4,  # Edge length of a brick in voxels. The tile of a brick holds (brick_size + 1) ** 3 voxels in local memory.
+        capacity=2 ** 16  # Initial number of particles. Buffers grow when more particles are drawn.
+    ):
+        self.smoke_density_taichi = smoke_density_taichi
+        self.smoke_color_taichi = smoke_color_taichi
+        self.brick_size = brick_size
+        self.grid_shape = tuple(max(1, -(-(n - 1) // brick_size)) for n in smoke_density_taichi.shape)  # Particles start in voxels [0, n - 2].
+        brick_num = int(np.prod(self.grid_shape))
+        self._block = max(1, int(np.ceil(np.sqrt(brick_num))))  # Bricks per block of the prefix sum, balancing the parallel and the ordered pass
+        self._counts = ti.ndarray(ti.i32, shape=brick_num)
+        self._starts = ti.ndarray(ti.i32, shape=brick_num + 1)
+        self._cursors = ti.ndarray(ti.i32, shape=brick_num)
+        self._block_starts = ti.ndarray(ti.i32, shape=-(-brick_num // self._block) + 1)
+        self._bricks = ti.ndarray(ti.i32, shape=capacity)  # Brick of each particle
+        self._sorted_particles = ti.ndarray(ti.i32, shape=capacity)  # Particle indices sorted by brick
+
+    def _reserve(self, n):  # Grow the per-particle buffers to at least n entries
+        if self._bricks.shape[0] < n:
+            capacity = max(n, 2 * self._bricks.shape[0])
+            self._bricks = ti.ndarray(ti.i32, shape=capacity)
+            self._sorted_particles = ti.ndarray(ti.i32, shape=capacity)
+
+    def draw_particles(  # See draw_particles. Particles outside the canvas are skipped.
+        self,
+        particles,  # Taichi vector field, NumPy array, ti.ndarray or tensor of shape [n, 3]
+        densities=1.,
+        colors=[1, 1, 1],
+        premultiplied=False,  # smoke_color_taichi holds density times color. See premultiply_color.
+        return_region=False
+    ):
+        if not isinstance(particles, ti.Field):
+            particles = as_array(particles)
+        n = particles.shape[0]
+        if n == 0:
+            return None
+        if premultiplied and not self.smoke_color_taichi is None:
+            _check_premultiplied(self.smoke_color_taichi)
+        if not isinstance(particles, ti.Field):
+            particles = _staging.stage('particles', particles, vector=True)
+        region = _particles_region(self.smoke_density_taichi, particles, n) if return_region else None
+
+        per_particle = not type(densities) in [int, float] or (not self.smoke_color_taichi is None and not is_vector(colors))
+        density = 1.
+        color = [1, 1, 1]
+        if per_particle:
+            if type(densities) in [int, float]:
+                density = densities
+                densities = _staging.field('densities', ti.f32, 0, n)
+                densities.fill(density)
+            elif not isinstance(densities, ti.Field):  # Array
+                densities = _staging.stage('densities', densities)
+            if is_vector(colors):
+                color = colors
+                colors = _staging.field('colors', ti.f32, 3, n)
+                colors.fill(color)
+            elif not isinstance(colors, ti.Field):  # Array
+                colors = _staging.stage('colors', colors, vector=True)
         else:
-            _draw_particles_kernel(smoke_density_taichi, smoke_color_taichi, particles, densities, colors)
+            density = densities
+            color = colors
+            densities = _staging.field('densities', ti.f32, 0, 1)  # Unused
+            colors = _staging.field('colors', ti.f32, 3, 1)
+
+        self._reserve(n)
+        with_color = not self.smoke_color_taichi is None
+        grid_shape = ti.Vector(self.grid_shape)
+        _bin_count(self.smoke_density_taichi, particles, n, self.brick_size, grid_shape, self._bricks, self._counts)
+        _bin_scan(self._counts, self._starts, self._cursors, self._block_starts, self._block)
+        _bin_scatter(n, self._bricks, self._cursors, self._sorted_particles)
+        for parity in np.ndindex(2, 2, 2):
+            _bin_deposit(
+                self.smoke_density_taichi,
+                self.smoke_color_taichi if with_color else self.smoke_density_taichi,
+                with_color,
+                self.brick_size,
+                grid_shape,
+                ti.Vector(parity),
+                self._starts,
+                self._sorted_particles,
+                particles,
+                density,
+                color,
+                densities,
+                colors,
+                per_particle,
+                premultiplied)
+        return region
 
 # TODO: def gaussian_blur(smoke_density_taichi, smoke_color_taichi, radius)
 
@@ -529,14 +1358,16 @@ def draw_particles(  # Draw particles (Anti-aliasing)
 def _gaussian_splatting_kernel(
     smoke: ti.template(),  # type: ignore
     smoke_color: ti.template(),  # type: ignore
+    n: int,
     positions: ti.template(),  # type: ignore
     rotations: ti.template(),  # type: ignore
     scales: ti.template(),  # type: ignore
     colors: ti.template(),  # type: ignore
-    opacities: ti.template()  # type: ignore
+    opacities: ti.template(),  # type: ignore
+    premultiplied: ti.template()  # type: ignore
 ):    
     # Render each particle
-    for i in ti.ndrange(positions.shape[0]):
+    for i in range(n):
         pos = positions[i]
         scale = scales[i]
         
@@ -558,7 +1389,7 @@ def _gaussian_splatting_kernel(
             density = opacities[i] * ti.exp(-0.5 * delta.dot(inv_cov3d @ delta))
             
             # Mix
-            _draw_point(smoke, smoke_color, I, density, colors[i])
+            _draw_point(smoke, smoke_color, I, density, colors[i], premultiplied)
 
 def gaussian_splatting(  # Render Gaussian splatting data (Tested with data exported from Jawset Postshot)
     smoke,
@@ -568,8 +1399,11 @@ def gaussian_splatting(  # Render Gaussian splatting data (Tested with data expo
     rotation_matrix=None,
     rotation_quaternion=None,
     y_upward=False,
-    scaling=1
+    scaling=1,
+    premultiplied=False  # smoke_color holds density times color. See premultiply_color.
 ):
+    if premultiplied:
+        _check_premultiplied(smoke_color)
     if not rotation_matrix is None:
         rotation_matrix = np.array(rotation_matrix, dtype=float)
         rotation_quaternion = rotation_matrix_to_quaternion(rotation_matrix)
@@ -587,23 +1421,24 @@ def gaussian_splatting(  # Render Gaussian splatting data (Tested with data expo
         rotation_quaternion = rotation_matrix_to_quaternion(rotation_matrix)
 
     particle_num = len(data['positions'])
-    positions = ti.Vector.field(3, ti.f32, shape=[particle_num])
-    rotations = ti.Vector.field(4, ti.f32, shape=[particle_num])
-    scales = ti.Vector.field(3, ti.f32, shape=[particle_num])
-    colors = ti.Vector.field(3, ti.f32, shape=[particle_num])
-    opacities = ti.field(ti.f32, shape=[particle_num])
-
-    positions.from_numpy((data['positions'] @ rotation_matrix.T * scaling + offset))
-    rotations.from_numpy(quaternion_multiply(rotation_quaternion, data['rotations'].T).T)
-    scales.from_numpy(data['scales'] * scaling)
-    colors.from_numpy(data['sh_coeffs'][:, 0])
-    opacities.from_numpy(data['opacities'])
+    if particle_num == 0:
+        return None
+    positions_numpy = data['positions'] @ rotation_matrix.T * scaling + offset
+    radii = np.max(data['scales'], axis=-1) * (3.0 * scaling)
+    positions = _staging.stage('positions', positions_numpy, vector=True)
+    rotations = _staging.stage('rotations', quaternion_multiply(rotation_quaternion, data['rotations'].T).T, vector=True)
+    scales = _staging.stage('scales', data['scales'] * scaling, vector=True)
+    colors = _staging.stage('colors', data['sh_coeffs'][:, 0], vector=True)
+    opacities = _staging.stage('opacities', data['opacities'])
 
     _gaussian_splatting_kernel(
         smoke,
         smoke_color,
+        particle_num,
         positions,
         rotations,
         scales,
         colors,
-        opacities)
+        opacities,
+        premultiplied)
+    return bounding_region(smoke, np.min(positions_numpy - radii[:, np.newaxis], axis=0), np.max(positions_numpy + radii[:, np.newaxis], axis=0))
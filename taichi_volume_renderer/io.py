@@ -1,6 +1,745 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import zipfile
+import zlib
+from collections import OrderedDict
 import numpy as np
+import taichi as ti
 from .math import sigmoid
 
+_SPARSE_SNODE_TYPES = (ti._lib.core.SNodeType.pointer, ti._lib.core.SNodeType.bitmasked, ti._lib.core.SNodeType.dynamic, ti._lib.core.SNodeType.hash)
+
+def is_sparse(field):  # Whether the field lies under a pointer, bitmasked, dynamic or hash SNode, so that only active cells are stored.
+    snode = field.parent()
+    while snode is not None and snode.ptr is not None:
+        if snode.ptr.type in _SPARSE_SNODE_TYPES:
+            return True
+        snode = snode.parent()
+    return False
+
+def sparse_layout(  # Returns a bitmasked SNode covering shape, for placing sparse fields. Fields placed on the same SNode share active voxels.
+    shape,
+    block_size=8  # Edge length of a block in voxels. Memory is allocated block by block.
+):
+    # The block size and the number of blocks along each axis are rounded up to powers of two, as struct-for loops over
+    # pointer SNodes of other sizes miss cells. Set volume_shape on the fields placed on it, see volume_shape.
+    block_size = 1 << (block_size - 1).bit_length()
+    return ti.root.pointer(ti.ijk, [1 << (-(-n // block_size) - 1).bit_length() for n in shape]).bitmasked(ti.ijk, block_size)
+
+def volume_shape(field):  # Shape of the volume stored in a field. Fields whose shape is rounded up, such as those placed on sparse_layout, keep the true shape in a volume_shape attribute.
+    return tuple(getattr(field, 'volume_shape', field.shape)[:3])
+
+@ti.func
+def _chunk_value(chunk: ti.template(), i, j, k, n: ti.template()):  # type: ignore
+    if ti.static(n == 0):
+        return chunk[i, j, k]
+    else:
+        return ti.Vector([chunk[i, j, k, c] for c in ti.static(range(n))])
+
+@ti.kernel
+def _upload_chunk(
+    field: ti.template(),  # type: ignore
+    chunk: ti.types.ndarray(),  # type: ignore
+    origin: ti.math.ivec3,  # type: ignore
+    n: ti.template(),  # type: ignore
+    quantize: ti.template(),  # type: ignore
+    skip_zeros: ti.template(),  # type: ignore
+    active_only: ti.template()  # type: ignore
+):
+    for i, j, k in ti.ndrange(chunk.shape[0], chunk.shape[1], chunk.shape[2]):
+        I = origin + ti.Vector([i, j, k])
+        value = _chunk_value(chunk, i, j, k, n)
+        write = True
+        if ti.static(active_only):
+            write = ti.is_active(field.parent(), I)
+        elif ti.static(skip_zeros):
+            if ti.static(n > 0):
+                write = (value != 0).any()
+            else:
+                write = value != 0
+        if write:
+            if ti.static(quantize):
+                field[I] = ti.cast(ti.round(ti.math.clamp(value, 0., 1.) * 255.), field.dtype)
+            else:
+                field[I] = ti.cast(value, field.dtype)
+
+def as_array(a):  # View array-like data as a NumPy array, ti.ndarray or tensor that kernels take as an ndarray argument, copying only when necessary
+    if isinstance(a, ti.Ndarray) or type(a).__module__.split('.')[0] in ['torch', 'paddle']:  # Passed to kernels without a copy on the same device
+        return a
+    if isinstance(a, np.ndarray):
+        return np.ascontiguousarray(a)
+    if not hasattr(a, '__array_interface__') and hasattr(a, '__dlpack__'):  # Host DLPack tensors are viewed without a copy.
+        return np.ascontiguousarray(np.from_dlpack(a))
+    return np.ascontiguousarray(np.asarray(a))
+
+def _is_floating(dtype):  # For NumPy, Taichi and tensor dtypes
+    try:
+        return np.issubdtype(dtype, np.floating)
+    except TypeError:
+        return str(dtype).split('.')[-1].startswith('f')
+
+def upload(  # Copy a 3D array into a Taichi field chunk by chunk, converting the dtype on device. Floats are mapped from 0 ~ 1 to 0 ~ 255 for u8 fields.
+    field,
+    array,  # Shape field.shape for scalar fields, or field.shape + (n,) for vector fields. May also cover part of the field, see origin. NumPy arrays are copied chunk by chunk; a ti.ndarray, a tensor or anything with __array_interface__ or __dlpack__ in one go.
+    chunk_size=None,  # Slices along the first axis per chunk. By default about 16M values.
+    active_only=False,  # Only write voxels that are already active, e.g. colors sharing a sparse layout with an uploaded density.
+    origin=(0, 0, 0),  # Index in the field of array[0, 0, 0]
+    skip_zeros=None  # Leave zero voxels unwritten. By default True for sparse fields, so that empty space stays inactive.
+):
+    n = field.n if isinstance(field, ti.MatrixField) else 0
+    quantize = field.dtype == ti.u8 and _is_floating(array.dtype)
+    sparse = is_sparse(field)
+    if skip_zeros is None:
+        skip_zeros = sparse
+    if not isinstance(array, np.ndarray):
+        _upload_chunk(field, as_array(array), ti.Vector(origin), n, quantize, skip_zeros, active_only and sparse)
+        return
+    if chunk_size is None:
+        chunk_size = max(1, 2 ** 24 // max(1, int(np.prod(array.shape[1:]))))
+    for start in range(0, array.shape[0], chunk_size):
+        chunk_origin = ti.Vector([origin[0] + start, origin[1], origin[2]])
+        _upload_chunk(field, np.ascontiguousarray(array[start:start + chunk_size]), chunk_origin, n, quantize, skip_zeros, active_only and sparse)
+
+@ti.kernel
+def _stage_kernel(
+    field: ti.template(),  # type: ignore
+    array: ti.types.ndarray(),  # type: ignore
+    n: ti.template()  # type: ignore
+):
+    for i in range(array.shape[0]):
+        if ti.static(n == 0):
+            field[i] = ti.cast(array[i], field.dtype)
+        else:
+            for c in ti.static(range(n)):
+                field[i][c] = ti.cast(array[i, c], field.dtype)
+
+class StagingPool():  # Reusable Taichi fields for per-frame host data such as particles. Fields are kept per name, dtype and vector width, and grow geometrically, so repeated uploads do not allocate.
+    def __init__(
+        self,
+        growth=2.  # Factor by which a field grows when it is too small
+    ):
+        self.growth = growth
+        self._fields = {}
+
+    def field(  # A field with at least rows entries. Entries beyond those written by the caller hold stale data.
+        self,
+        name,  # Fields used at the same time need different names.
+        dtype,
+        n,  # Vector width, or 0 for a scalar field
+        rows
+    ):
+        key = (name, dtype, n)
+        field = self._fields.get(key)
+        if field is None or field.shape[0] < rows:
+            capacity = rows if field is None else max(rows, int(np.ceil(field.shape[0] * self.growth)))
+            field = ti.field(dtype, shape=capacity) if n == 0 else ti.Vector.field(n, dtype, shape=capacity)
+            self._fields[key] = field
+        return field
+
+    def stage(  # Copy an array of shape [rows], or [rows, n] for vectors, into the pooled field of this name and return the field.
+        self,
+        name,
+        array,  # NumPy array, ti.ndarray, tensor, or anything with __array_interface__ or __dlpack__. Read by the copy kernel in place where the backend allows.
+        dtype=ti.f32,
+        vector=False
+    ):
+        array = as_array(array)
+        n = array.shape[-1] if vector else 0
+        field = self.field(name, dtype, n, array.shape[0])
+        if array.shape[0] > 0:
+            _stage_kernel(field, array, n)
+        return field
+
+def _open_npz_member(path, key=None):  # Memory-map an array stored without compression in a .npz file. Compressed arrays have to be read.
+    with zipfile.ZipFile(path) as archive:
+        names = [e for e in archive.namelist() if e.endswith('.npy')]
+        name = names[0] if key is None else key + '.npy'
+        info = archive.getinfo(name)
+        if info.compress_type != zipfile.ZIP_STORED:
+            return np.load(path)[name[:-4]]
+    with open(path, 'rb') as file:
+        file.seek(info.header_offset)
+        local_header = file.read(30)
+        name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+        file.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(file)
+        read_array_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_array_header(file)
+        offset = file.tell()
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran_order else 'C')
+
+def open_volume(  # Memory-map a volume stored in a .npy, .npz or raw file, without reading it.
+    path,
+    shape=None,  # Required for raw files.
+    dtype=np.float32,  # For raw files
+    offset=0,  # Header size in bytes, for raw files
+    order='C',  # For raw files. 'F' if the first axis varies fastest.
+    key=None  # Array name in .npz files. By default the first array.
+):
+    if str(path).endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    if str(path).endswith('.npz'):
+        return _open_npz_member(path, key)
+    if shape is None:
+        raise ValueError("shape is required for raw volume files")
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=tuple(shape), order=order)
+
+def load_volume(  # Load a volume into a Taichi field chunk by chunk, so host memory peaks at about one chunk rather than a few copies of the volume. Returns the field.
+    source,  # Path to a .npy, .npz or raw file, or a NumPy array such as a memmap. Trailing axes beyond the first 3, e.g. RGB, are kept.
+    field=None,  # Target field. If None, one is created.
+    dtype=ti.f32,  # Of the created field: ti.f32, ti.f16 or ti.u8
+    crop=None,  # ((x_start, x_end), (y_start, y_end), (z_start, z_end)) in voxels of the source, applied before downsampling.
+    downsample=1,  # Average downsample ** 3 voxels into one. Voxels left over at the far ends are dropped.
+    sparse=False,  # Create a sparse field, storing only blocks with nonzero voxels.
+    chunk_size=None,  # Source slices along the first axis read per chunk. By default about 16M values.
+    shape=None,  # For raw files. See open_volume.
+    raw_dtype=np.float32,
+    offset=0,
+    order='C',
+    key=None  # Array name in .npz files
+):
+    array = source if isinstance(source, np.ndarray) else open_volume(source, shape, raw_dtype, offset, order, key)
+    if not crop is None:
+        array = array[tuple(slice(start, end) for start, end in crop)]
+    output_shape = tuple(n // downsample for n in array.shape[:3])
+    array = array[:output_shape[0] * downsample, :output_shape[1] * downsample, :output_shape[2] * downsample]
+    n = array.shape[3] if array.ndim > 3 else 0
+    if field is None:
+        if sparse:
+            field = ti.field(dtype=dtype) if n == 0 else ti.Vector.field(n, dtype=dtype)
+            sparse_layout(output_shape).place(field)
+            field.volume_shape = output_shape
+        else:
+            field = ti.field(dtype=dtype, shape=output_shape) if n == 0 else ti.Vector.field(n, dtype=dtype, shape=output_shape)
+
+    if chunk_size is None:
+        chunk_size = max(1, 2 ** 24 // max(1, int(np.prod(array.shape[1:]))))
+    chunk_size = max(downsample, chunk_size // downsample * downsample)
+    for start in range(0, array.shape[0], chunk_size):
+        chunk = array[start:start + chunk_size]
+        if downsample > 1:
+            chunk = np.asarray(chunk, dtype=np.float32)
+            chunk = chunk.reshape(chunk.shape[0] // downsample, downsample, output_shape[1], downsample, output_shape[2], downsample, *chunk.shape[3:]).mean(axis=(1, 3, 5))
+        upload(field, chunk, chunk_size=chunk.shape[0], origin=(start // downsample, 0, 0))
+    return field
+
+@ti.kernel
+def _fill_brick_color(smoke_color: ti.template(), brick: ti.math.ivec3, brick_size: int, color: ti.math.vec3):  # type: ignore
+    for I in ti.grouped(ti.ndrange(brick_size, brick_size, brick_size)):
+        smoke_color[brick * brick_size + I] = color
+
+@ti.kernel
+def _evict_brick(bricks: ti.template(), brick: ti.math.ivec3):  # type: ignore
+    ti.deactivate(bricks, brick)
+
+class BrickedVolume():  # Out-of-core volume. Fixed-size bricks are read from a memory-mapped array as they become visible, and at most max_resident_bricks of them stay on the device, evicting the least recently used.
+    def __init__(
+        self,
+        source,  # Path to a .npy or raw file, or a NumPy array such as a memmap.
+        brick_size=32,  # Edge length of a brick in voxels. Rounded up to a power of two, see sparse_layout.
+        max_resident_bricks=1024,
+        shape=None,  # For raw files. See open_volume.
+        dtype=np.float32,
+        offset=0,
+        density_dtype=ti.f32,  # ti.f32 or ti.f16
+        color=(1., 1., 1.)  # Uniform smoke color
+    ):
+        self.array = source if isinstance(source, np.ndarray) else open_volume(source, shape, dtype, offset)
+        self.brick_size = brick_size = 1 << (brick_size - 1).bit_length()
+        self.max_resident_bricks = max_resident_bricks
+        self.color = tuple(color)
+        self.grid_shape = tuple(-(-n // brick_size) for n in self.array.shape[:3])
+
+        # Pass smoke_density and smoke_color to Scene or DisplayWindow. Bricks live in pointer cells, so device memory is bounded by
+        # max_resident_bricks rather than the size of the volume. The field shape is rounded up to a power of two bricks per axis,
+        # see sparse_layout, and the fields keep the shape of the source as volume_shape.
+        self.smoke_density = ti.field(dtype=density_dtype)
+        self.smoke_color = ti.Vector.field(3, dtype=ti.f32)
+        self._bricks = ti.root.pointer(ti.ijk, [1 << (n - 1).bit_length() for n in self.grid_shape])
+        self._bricks.dense(ti.ijk, brick_size).place(self.smoke_density, self.smoke_color)
+        self.smoke_density.volume_shape = self.smoke_color.volume_shape = tuple(self.array.shape[:3])
+
+        self._resident = OrderedDict()  # Resident brick indices, least recently used first
+        self._empty = np.zeros(self.grid_shape, dtype=bool)  # Bricks known to hold no smoke, which are never made resident
+
+    def visible_bricks(  # Indices of the bricks in the view frustum of scene, nearest first
+        self,
+        scene,
+        aspect=1.  # Width / height of the rendered image
+    ):
+        phi, theta, distance, fov = scene.get_camera_state()
+        camera_pos = distance * np.array([np.cos(phi) * np.cos(theta), np.sin(phi) * np.cos(theta), np.sin(theta)])
+        u = np.array([-np.sin(phi), np.cos(phi), 0])
+        v = np.array([-np.cos(phi) * np.sin(theta), -np.sin(phi) * np.sin(theta), np.cos(theta)])
+        direction = -camera_pos / distance
+
+        bricks = np.indices(self.grid_shape).reshape(3, -1).T
+        shape = np.array(self.array.shape[:3])
+        centers = (bricks + 0.5) * self.brick_size / shape - 0.5  # The volume fills the unit cube
+        radius = 0.5 * np.linalg.norm(self.brick_size / shape)
+        w = centers - camera_pos
+        depth = w @ direction
+        half_height = fov / 2
+        half_width = half_height * aspect
+        visible = depth > -radius
+        visible &= np.abs(w @ u) <= depth * half_width + radius * np.sqrt(1 + half_width ** 2)
+        visible &= np.abs(w @ v) <= depth * half_height + radius * np.sqrt(1 + half_height ** 2)
+        return bricks[visible][np.argsort(depth[visible], kind='stable')]
+
+    def stream(  # Make the visible bricks nearest to the camera of scene resident. Returns the number of bricks read. If the resident set changed, the light of scene is updated.
+        self,
+        scene,
+        aspect=1.,
+        max_loads=None  # Limit the bricks read per call, to keep interactive frame rates. Call again to continue.
+    ):
+        loads = 0
+        changed = False
+        wanted = 0
+        for brick in self.visible_bricks(scene, aspect):
+            if wanted >= self.max_resident_bricks:
+                break
+            key = tuple(int(e) for e in brick)
+            if self._empty[key]:
+                continue
+            if key in self._resident:
+                self._resident.move_to_end(key)
+                wanted += 1
+                continue
+            if not max_loads is None and loads >= max_loads:
+                continue
+            start = brick * self.brick_size
+            data = self.array[start[0]:start[0] + self.brick_size, start[1]:start[1] + self.brick_size, start[2]:start[2] + self.brick_size]
+            loads += 1
+            if not np.any(data):
+                self._empty[key] = True
+                continue
+            if len(self._resident) >= self.max_resident_bricks:
+                _evict_brick(self._bricks, ti.Vector(self._resident.popitem(last=False)[0]))
+            upload(self.smoke_density, data, origin=start, skip_zeros=False)
+            _fill_brick_color(self.smoke_color, ti.Vector(key), self.brick_size, ti.Vector(self.color))
+            self._resident[key] = None
+            wanted += 1
+            changed = True
+        while len(self._resident) > self.max_resident_bricks:  # max_resident_bricks was lowered
+            _evict_brick(self._bricks, ti.Vector(self._resident.popitem(last=False)[0]))
+            changed = True
+        if changed:
+            scene.update_light()
+        return loads
+
+class _VDBStream():  # Little-endian reader over a memory-mapped VDB file
+    def __init__(self, buffer, position=0):
+        self.buffer = buffer
+        self.position = position
+
+    def read(self, size):
+        data = self.buffer[self.position:self.position + size]
+        self.position += size
+        return data
+
+    def unpack(self, format):
+        values = struct.unpack_from(format, self.buffer, self.position)
+        self.position += struct.calcsize(format)
+        return values
+
+    def string(self):
+        length, = self.unpack('<I')
+        return bytes(self.read(length)).decode()
+
+    def mask(self, size):  # NodeMask of size bits, as a bool array
+        return np.unpackbits(np.frombuffer(self.read(size // 8), dtype=np.uint8), bitorder='little').astype(bool)
+
+# VDB compression flags and per-buffer metadata
+_VDB_COMPRESS_ZIP = 1
+_VDB_COMPRESS_ACTIVE_MASK = 2
+_VDB_COMPRESS_BLOSC = 4
+_VDB_NO_MASK_OR_INACTIVE_VALS = 0
+_VDB_NO_MASK_AND_ONE_INACTIVE_VAL = 2
+_VDB_MASK_AND_NO_INACTIVE_VALS = 3
+_VDB_MASK_AND_ONE_INACTIVE_VAL = 4
+_VDB_MASK_AND_TWO_INACTIVE_VALS = 5
+_VDB_NO_MASK_AND_ALL_VALS = 6
+
+def _read_vdb_data(stream, dtype, count, compression):
+    size = np.dtype(dtype).itemsize * count
+    if compression & (_VDB_COMPRESS_BLOSC | _VDB_COMPRESS_ZIP):
+        compressed_size, = stream.unpack('<q')
+        if compressed_size <= 0:  # Stored uncompressed
+            data = stream.read(-compressed_size)
+        elif compression & _VDB_COMPRESS_BLOSC:
+            try:
+                import blosc
+            except ImportError:
+                raise ImportError("This VDB file is blosc compressed. Install blosc by 'pip install blosc'.")
+            data = blosc.decompress(bytes(stream.read(compressed_size)))
+        else:
+            data = zlib.decompress(stream.read(compressed_size))
+    else:
+        data = stream.read(size)
+    return np.frombuffer(data, dtype=dtype, count=count)
+
+def _read_vdb_values(stream, value_mask, compression, background, half):  # io::readCompressedValues. Returns values of all len(value_mask) cells.
+    metadata, = stream.unpack('<b')
+    inactive_values = [background if metadata == _VDB_NO_MASK_OR_INACTIVE_VALS else -background, background]  # Where the selection mask is off and on
+    if metadata in (_VDB_NO_MASK_AND_ONE_INACTIVE_VAL, _VDB_MASK_AND_ONE_INACTIVE_VAL, _VDB_MASK_AND_TWO_INACTIVE_VALS):
+        inactive_values[0], = stream.unpack('<f')
+        if metadata == _VDB_MASK_AND_TWO_INACTIVE_VALS:
+            inactive_values[1], = stream.unpack('<f')
+    selection_mask = None
+    if metadata in (_VDB_MASK_AND_NO_INACTIVE_VALS, _VDB_MASK_AND_ONE_INACTIVE_VAL, _VDB_MASK_AND_TWO_INACTIVE_VALS):
+        selection_mask = stream.mask(len(value_mask))
+    count = len(value_mask)
+    if compression & _VDB_COMPRESS_ACTIVE_MASK and metadata != _VDB_NO_MASK_AND_ALL_VALS:
+        count = int(np.count_nonzero(value_mask))
+    values = _read_vdb_data(stream, np.float16 if half else np.float32, count, compression).astype(np.float32)
+    if count != len(value_mask):  # Only active values were stored
+        all_values = np.full(len(value_mask), inactive_values[0], dtype=np.float32)
+        if not selection_mask is None:
+            all_values[selection_mask] = inactive_values[1]
+        all_values[value_mask] = values
+        values = all_values
+    return values
+
+def _read_vdb_internal_node(stream, origin, log2_dims, compression, background, half, leaves, tiles):  # Reads the topology below an internal node, appending leaf origins and value masks, and active tiles as (origin, size, value).
+    log2_dim = log2_dims[0]
+    child_log2_size = sum(log2_dims[1:])
+    size = 1 << (3 * log2_dim)
+    child_mask = stream.mask(size)
+    value_mask = stream.mask(size)
+    values = _read_vdb_values(stream, value_mask, compression, background, half)
+    cells = np.arange(size)
+    offsets = np.stack([cells >> (2 * log2_dim), (cells >> log2_dim) & ((1 << log2_dim) - 1), cells & ((1 << log2_dim) - 1)], axis=-1) << child_log2_size
+    for n in np.nonzero(value_mask & ~child_mask)[0]:
+        tiles.append((origin + offsets[n], 1 << child_log2_size, values[n]))
+    for n in np.nonzero(child_mask)[0]:
+        if len(log2_dims) == 2:  # Children are leaves. Their topology is just the value mask.
+            leaves.append((origin + offsets[n], stream.mask(1 << (3 * log2_dims[1]))))
+        else:
+            _read_vdb_internal_node(stream, origin + offsets[n], log2_dims[1:], compression, background, half, leaves, tiles)
+
+@ti.kernel
+def _scatter_vdb_values(
+    field: ti.template(),  # type: ignore
+    values: ti.types.ndarray(),  # type: ignore  # (N, leaf_dim ** 3)
+    origins: ti.types.ndarray(),  # type: ignore  # (N, 3), in voxels of the output before downsampling
+    leaf_dim: int,
+    axes: ti.template(),  # type: ignore
+    factor: int
+):
+    for n, i in ti.ndrange(values.shape[0], values.shape[1]):
+        value = values[n, i]
+        if value != 0:
+            local = ti.Vector([i // (leaf_dim * leaf_dim), i // leaf_dim % leaf_dim, i % leaf_dim])
+            I = ti.Vector([origins[n, 0], origins[n, 1], origins[n, 2]]) + ti.Vector([local[axes[0]], local[axes[1]], local[axes[2]]])
+            if (I >= 0).all() and (I < ti.Vector(field.shape) * factor).all():
+                field[I // factor] += value / factor ** 3
+
+def read_vdb(  # Read a float grid from an OpenVDB file into a Taichi field, without pyopenvdb or a dense NumPy intermediate. Returns the field.
+    path,
+    grid=None,  # Grid name. By default the first float grid.
+    downsample=1,  # Average downsample ** 3 voxels into one
+    sparse=False,  # Write into a sparse field, allocating only blocks with nonzero values.
+    dtype=ti.f32,  # ti.f32 or ti.f16
+    axes=(0, 1, 2),  # Permutation of the axes as in np.transpose. Use (0, 2, 1) for Y-up files from Houdini.
+    cubic=True,  # Pad the shorter axes, centering the grid, so that voxels stay cubic when rendered.
+    batch_size=65536  # Leaves uploaded per kernel launch
+):
+    with open(path, 'rb') as file:
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    stream = _VDBStream(buffer)
+    magic, file_version, _, _, has_grid_offsets = stream.unpack('<qIIIB')
+    if magic != 0x56444220:
+        raise ValueError("Not a VDB file: " + str(path))
+    if file_version < 222 or not has_grid_offsets:
+        raise ValueError("Unsupported VDB file version: " + str(file_version))
+    stream.read(36)  # UUID
+    for _ in range(stream.unpack('<I')[0]):  # File metadata
+        stream.string()
+        stream.string()
+        stream.read(stream.unpack('<I')[0])
+
+    # Grid descriptors are followed by their grids.
+    for _ in range(stream.unpack('<I')[0]):
+        name = stream.string().split('\x1e')[0]
+        grid_type = stream.string()
+        stream.string()  # Instance parent
+        grid_position, _, end_position = stream.unpack('<qqq')
+        tree_type = grid_type.split('_')
+        if tree_type[1] == 'float' and (grid is None or name == grid):
+            break
+        stream.position = end_position
+    else:
+        raise ValueError("No float grid" + ("" if grid is None else " named " + str(grid)) + " in " + str(path))
+    log2_dims = [int(e) for e in tree_type[2:] if e.isdigit()]
+    half = grid_type.endswith('_HalfFloat')
+
+    stream.position = grid_position
+    compression, = stream.unpack('<I')
+    metadata = {}
+    for _ in range(stream.unpack('<I')[0]):
+        key = stream.string()
+        value_type = stream.string()
+        value = stream.read(stream.unpack('<I')[0])
+        if value_type == 'vec3i':
+            metadata[key] = np.frombuffer(value, dtype='<i4')
+        elif value_type == 'bool':
+            metadata[key] = value[0] != 0
+    half = half or metadata.get('is_saved_as_half_float', False)
+    map_type = stream.string()
+    map_sizes = {'AffineMap': 128, 'UnitaryMap': 128, 'ScaleMap': 120, 'UniformScaleMap': 120, 'ScaleTranslateMap': 144, 'UniformScaleTranslateMap': 144, 'TranslationMap': 24}
+    if not map_type in map_sizes:
+        raise ValueError("Unsupported VDB transform: " + map_type)
+    stream.read(map_sizes[map_type])
+
+    # Topology
+    stream.unpack('<i')  # Buffer count
+    background, tile_count, child_count = stream.unpack('<fII')
+    leaves = []
+    tiles = []
+    for _ in range(tile_count):
+        x, y, z, value, active = stream.unpack('<iiif?')
+        if active:
+            tiles.append((np.array([x, y, z]), 1 << sum(log2_dims), value))
+    for _ in range(child_count):
+        origin = np.array(stream.unpack('<iii'))
+        _read_vdb_internal_node(stream, origin, log2_dims, compression, background, half, leaves, tiles)
+
+    # Output layout
+    if 'file_bbox_min' in metadata:
+        index_min = metadata['file_bbox_min']
+        index_max = metadata['file_bbox_max']
+    elif len(leaves) > 0:
+        index_min = np.min([e[0] for e in leaves], axis=0)
+        index_max = np.max([e[0] for e in leaves], axis=0) + (1 << log2_dims[-1]) - 1
+    else:
+        index_min = index_max = np.zeros(3, dtype=int)
+    extent = (index_max - index_min + 1)[list(axes)]
+    padded_extent = np.full(3, extent.max()) if cubic else extent
+    padding = (padded_extent - extent) // 2
+    shape = tuple(int(e) for e in -(-padded_extent // downsample))
+    if sparse:
+        field = ti.field(dtype=dtype)
+        sparse_layout(shape).place(field)
+        field.volume_shape = shape
+    else:
+        field = ti.field(dtype=dtype, shape=shape)
+
+    def output_origins(origins):  # Index space origins to output voxels before downsampling
+        return ((np.array(origins) - index_min)[:, list(axes)] + padding).astype(np.int32)
+
+    # Leaf buffers follow the topology in the same order.
+    leaf_dim = 1 << log2_dims[-1]
+    for start in range(0, len(leaves), batch_size):
+        batch = leaves[start:start + batch_size]
+        values = np.empty((len(batch), leaf_dim ** 3), dtype=np.float32)
+        for i in range(len(batch)):
+            value_mask = stream.mask(leaf_dim ** 3)
+            values[i] = _read_vdb_values(stream, value_mask, compression, background, half)
+        _scatter_vdb_values(field, values, output_origins([e[0] for e in batch]), leaf_dim, axes, downsample)
+    for origin, size, value in tiles:  # Active tiles, split into leaf-sized pieces within the bounding box
+        start = np.maximum(index_min - origin, 0) // leaf_dim * leaf_dim
+        end = np.minimum(index_max + 1 - origin, size)
+        if value == 0 or np.any(start >= end):
+            continue
+        offsets = np.stack(np.meshgrid(*[np.arange(start[a], end[a], leaf_dim) for a in range(3)], indexing='ij'), axis=-1).reshape(-1, 3)
+        values = np.full((len(offsets), leaf_dim ** 3), value, dtype=np.float32)
+        _scatter_vdb_values(field, values, output_origins(origin + offsets), leaf_dim, axes, downsample)
+    return field
+
+_PLY_TYPES = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'
+}
+
+def _sigmoid_inplace(x):
+    np.negative(x, out=x)
+    np.exp(x, out=x)
+    x += 1
+    np.reciprocal(x, out=x)
+
+def read_gaussian_ply(  # Read Gaussian splatting data from a binary PLY file, memory-mapping its body. Returns the same dictionary as parse_gaussian_splatting_data.
+    path,
+    sh_degree=0,  # Spherical harmonics degree to load. 0 only loads the base color, which is all canvas.gaussian_splatting uses. None loads all.
+    dtype=np.float32  # np.float32 or np.float16
+):
+    with open(path, 'rb') as file:
+        if file.readline().strip() != b'ply':
+            raise ValueError("Not a PLY file: " + str(path))
+        byte_order = None
+        elements = []  # [name, count, [(property, dtype)]]
+        while True:
+            line = file.readline()
+            if line == b'':
+                raise ValueError("Unexpected end of PLY header: " + str(path))
+            words = line.decode('ascii').split()
+            if len(words) == 0 or words[0] in ('comment', 'obj_info'):
+                continue
+            if words[0] == 'end_header':
+                break
+            if words[0] == 'format':
+                if words[1] == 'ascii':
+                    raise ValueError("ASCII PLY files are not supported. Use plyfile and parse_gaussian_splatting_data instead.")
+                byte_order = '<' if words[1] == 'binary_little_endian' else '>'
+            elif words[0] == 'element':
+                elements.append([words[1], int(words[2]), []])
+            elif words[0] == 'property':
+                if words[1] == 'list':
+                    raise ValueError("List properties are not supported: " + line.decode('ascii').strip())
+                elements[-1][2].append((words[2], byte_order + _PLY_TYPES[words[1]]))
+        offset = file.tell()
+    for name, count, properties in elements:
+        element_dtype = np.dtype(properties)
+        if name == 'vertex':
+            break
+        offset += element_dtype.itemsize * count
+    else:
+        raise ValueError("No vertex element in " + str(path))
+    vertices = np.memmap(path, dtype=element_dtype, mode='r', offset=offset, shape=(count,))
+    names = element_dtype.names
+
+    def columns(keys):  # Gather columns into one float32 array
+        output = np.empty((count, len(keys)), dtype=np.float32)
+        for i, key in enumerate(keys):
+            output[:, i] = vertices[key]
+        return output
+
+    positions = columns(['x', 'y', 'z'])
+    opacities = columns(['opacity'])[:, 0]
+    scales = columns(['scale_0', 'scale_1', 'scale_2'])
+    rotations = columns(['rot_0', 'rot_1', 'rot_2', 'rot_3'])
+
+    # Spherical harmonics. f_rest_* stores all coefficients of the red channel first, then green, then blue.
+    total_rest_count = sum(1 for e in names if e.startswith('f_rest_')) // 3
+    rest_count = total_rest_count if sh_degree is None else min(total_rest_count, (sh_degree + 1) ** 2 - 1)
+    sh_coeffs = np.empty((count, rest_count + 1, 3), dtype=np.float32)
+    sh_coeffs[:, 0] = columns(['f_dc_0', 'f_dc_1', 'f_dc_2'])
+    for c in range(3):
+        for k in range(rest_count):
+            sh_coeffs[:, k + 1, c] = vertices['f_rest_' + str(c * total_rest_count + k)]
+
+    np.exp(scales, out=scales)
+    _sigmoid_inplace(sh_coeffs)
+    _sigmoid_inplace(opacities)
+
+    data = {
+        'positions': positions,
+        'opacities': opacities,
+        'scales': scales,
+        'rotations': rotations,
+        'sh_coeffs': sh_coeffs
+    }
+    if np.dtype(dtype) != np.float32:
+        data = {key: value.astype(dtype) for key, value in data.items()}
+    return data
+
+class Cache():  # On-disk cache of preprocessed data, e.g. parsed splats or voxelized volumes, keyed by source file contents, what is computed from them and parameters.
+    def __init__(
+        self,
+        directory=None,  # By default ~/.cache/taichi_volume_renderer
+        max_size=8 * 2 ** 30  # Bytes. The least recently used entries are deleted beyond this.
+    ):
+        if directory is None:
+            directory = os.path.join(os.path.expanduser('~'), '.cache', 'taichi_volume_renderer')
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        self._hashes_path = os.path.join(directory, 'hashes.json')
+
+    def file_hash(self, path):  # Content hash of a file. Remembered by path, size and modification time, so unchanged files are only read once.
+        status = os.stat(path)
+        identity = '|'.join([os.path.abspath(path), str(status.st_size), str(status.st_mtime_ns)])
+        hashes = {}
+        if os.path.exists(self._hashes_path):
+            with open(self._hashes_path) as file:
+                hashes = json.load(file)
+        if not identity in hashes:
+            digest = hashlib.blake2b(digest_size=16)
+            with open(path, 'rb') as file:
+                for block in iter(lambda: file.read(2 ** 24), b''):
+                    digest.update(block)
+            hashes = {e: h for e, h in hashes.items() if e.rsplit('|', 2)[0] != os.path.abspath(path) and os.path.exists(e.rsplit('|', 2)[0])}  # Forget earlier versions of this file and deleted files
+            hashes[identity] = digest.hexdigest()
+            self._write_atomically(self._hashes_path, lambda file: file.write(json.dumps(hashes).encode()))
+        return hashes[identity]
+
+    def key(self, sources=(), name='', **parameters):  # Cache key from source files, a name for what is computed from them, and parameters. Parameters must have stable reprs, e.g. numbers, strings, tuples or NumPy arrays.
+        if isinstance(sources, (str, os.PathLike)):
+            sources = [sources]
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr(name).encode())
+        for source in sources:
+            digest.update(self.file_hash(source).encode())
+        for name in sorted(parameters):
+            value = parameters[name]
+            if isinstance(value, np.ndarray):
+                value = (value.dtype.str, value.shape, value.tobytes())
+            digest.update(repr((name, value)).encode())
+        return digest.hexdigest()
+
+    def load(self, key):  # Returns a dictionary of memory-mapped arrays, or None if not cached.
+        path = os.path.join(self.directory, key + '.npz')
+        if not os.path.exists(path):
+            return None
+        os.utime(path)  # Mark as recently used
+        with zipfile.ZipFile(path) as archive:
+            names = [e[:-4] for e in archive.namelist()]
+        return {name: open_volume(path, key=name) for name in names}
+
+    def store(self, key, data):  # data is a dictionary of NumPy arrays or Taichi fields. Arrays are stored uncompressed so that they can be memory-mapped.
+        data = {name: value.to_numpy() if isinstance(value, ti.Field) else np.asarray(value) for name, value in data.items()}
+        self._write_atomically(os.path.join(self.directory, key + '.npz'), lambda file: np.savez(file, **data))
+        self.evict()
+
+    def fetch(  # Load from the cache, or call create(), which returns a dictionary of arrays, and store the result.
+        self,
+        create,
+        sources=(),  # Paths of the files create() reads
+        name=None,  # Distinguishes data computed differently from the same sources. By default the module and qualified name of create.
+        **parameters  # Everything else create() depends on
+    ):
+        if name is None:
+            name = create.__module__ + '.' + create.__qualname__
+        key = self.key(sources, name, **parameters)
+        data = self.load(key)
+        if data is None:
+            self.store(key, create())
+            data = self.load(key)
+        return data
+
+    def evict(self):  # Delete the least recently used entries until the cache fits in max_size. Entries still memory-mapped on Windows are kept.
+        entries = [os.path.join(self.directory, e) for e in os.listdir(self.directory) if e.endswith('.npz')]
+        entries.sort(key=lambda e: os.stat(e).st_mtime)
+        total_size = sum(os.stat(e).st_size for e in entries)
+        for entry in entries[:-1]:  # Always keep the newest entry
+            if total_size <= self.max_size:
+                break
+            size = os.stat(entry).st_size
+            if self._remove(entry):
+                total_size -= size
+
+    def clear(self):  # Delete all entries except those still memory-mapped on Windows
+        for entry in os.listdir(self.directory):
+            if entry.endswith('.npz') or entry == 'hashes.json':
+                self._remove(os.path.join(self.directory, entry))
+
+    def _remove(self, path):  # Returns whether the file was deleted. Windows refuses to delete files that are memory-mapped, e.g. by arrays returned from load().
+        try:
+            os.remove(path)
+        except PermissionError:
+            return False
+        return True
+
+    def _write_atomically(self, path, write):  # Write to a temporary file first, so that an interrupted write never leaves a corrupt entry.
+        temporary_path = path + '.' + str(os.getpid()) + '.tmp'
+        with open(temporary_path, 'wb') as file:
+            write(file)
+        os.replace(temporary_path, path)
+
 def parse_gaussian_splatting_data(ply_data):
     vertices = ply_data['vertex']
     
@@ -13,20 +752,12 @@ def parse_gaussian_splatting_data(ply_data):
     rotations = np.vstack([vertices['rot_0'], vertices['rot_1'], vertices['rot_2'], vertices['rot_3']]).T  # Rotation quaternions (N, 4)
     
     # Extracting Spherical Harmonics (SH) coefficients:
-    sh_coeffs = []
-    i = 0
-    while True:
-        if i < 3:  # First 3 coefficients are DC terms (base color)
-            key = f'f_dc_{i}'
-        else:  # Remaining coefficients represent higher-frequency components
-            key = f'f_rest_{i-3}'
-        if not key in vertices:
-            break
-        sh_coeffs.append(vertices[key])
-        i += 1
-    
-    sh_coeffs =np.array(sh_coeffs).T
-    sh_coeffs = np.reshape(sh_coeffs, (sh_coeffs.shape[0], -1, 3))  # RGB triplets (3 channels) (N, -, 3)
+    dc = np.vstack([vertices['f_dc_0'], vertices['f_dc_1'], vertices['f_dc_2']]).T  # First 3 coefficients are DC terms (base color) (N, 3)
+    rest = []  # Remaining coefficients represent higher-frequency components
+    while f'f_rest_{len(rest)}' in vertices:
+        rest.append(vertices[f'f_rest_{len(rest)}'])
+    rest = np.array(rest, dtype=dc.dtype).T.reshape(len(dc), 3, -1)  # All coefficients of the red channel first, then green, then blue (N, 3, -)
+    sh_coeffs = np.concatenate([dc[:, np.newaxis], rest.transpose(0, 2, 1)], axis=1)  # RGB triplets (3 channels) (N, -, 3)
 
     scales = np.exp(scales)
     sh_coeffs = sigmoid(sh_coeffs)
@@ -78,3 +78,31 @@ def compute_covariance_inv(rotation, scale):  # type: ignore
     # Σ = RSSᵀRᵀ
     # Here is Σ^{-1}
     return R @ S_squared_inv @ R.transpose()
+
+@ti.func
+def ray_box_intersection(origin, direction, box_min, box_max):  # Slab test. Returns the distances at which the ray enters and exits the box. The ray misses the box if entry >= exit.
+    t_enter = -np.inf
+    t_exit = np.inf
+    for a in ti.static(range(3)):
+        if direction[a] != 0:
+            t_0 = (box_min[a] - origin[a]) / direction[a]
+            t_1 = (box_max[a] - origin[a]) / direction[a]
+            t_enter = ti.max(t_enter, ti.min(t_0, t_1))
+            t_exit = ti.min(t_exit, ti.max(t_0, t_1))
+        elif origin[a] < box_min[a] or origin[a] > box_max[a]:
+            t_enter = np.inf
+    return t_enter, t_exit
+
+@ti.func
+def load_color(color_field, I):  # u8 color fields store 0 ~ 1 as 0 ~ 255.
+    color = ti.cast(color_field[I], ti.f32)
+    if ti.static(color_field.dtype == ti.u8):
+        color /= 255.
+    return color
+
+@ti.func
+def store_color(color_field, I, color):
+    if ti.static(color_field.dtype == ti.u8):
+        color_field[I] = ti.cast(ti.round(ti.math.clamp(color, 0., 1.) * 255.), ti.u8)
+    else:
+        color_field[I] = ti.cast(color, color_field.dtype)